@@ -1,21 +1,77 @@
-from flask import Flask, render_template, jsonify, abort, request, url_for, redirect, session
+import json
+
+import click
+from flask import (
+    Flask,
+    render_template,
+    stream_template,
+    jsonify,
+    abort,
+    request,
+    url_for,
+    redirect,
+    session,
+    get_template_attribute,
+    stream_with_context,
+    before_render_template,
+    template_rendered,
+)
 from config import Config
 from app.models import (
     get_random_annotations,
+    pick_focused_annotation_id,
+    get_next_review,
     get_books_with_annotations,
-    get_book_annotations,
+    stream_book_annotations,
     get_favorited_annotations,
-    get_all_annotations,
     get_recent_books,
     get_flashback_annotations,
-    get_highlights_with_notes,
+    stream_highlights_with_notes,
+    get_focused_annotations,
+    search_annotations,
+    SEARCH_LIMIT,
+    FLASHBACK_PER_YEAR,
+    get_snapshot,
+    get_live_feed,
+    get_annotations_by_id,
+    get_related_annotations,
+    get_filtered_annotation_ids,
+    unload_library,
+    stream_export,
+    sync_index,
 )
-from app.utils import is_favorite, toggle_favorite, to_datetime, generate_calibre_url, update_last_read
+from app.utils import (
+    is_favorite,
+    toggle_favorite,
+    to_datetime,
+    generate_calibre_url,
+    update_last_read,
+    grade_review,
+    apply_state_operations,
+    mark_read,
+    STATE_OPERATIONS,
+)
+from app.state import migrate_legacy_state
+from app.db import pool_stats, release_connections
+from app.libraries import LibraryDispatcher
+from app.caching import conditional, uncacheable
+from app.fragments import highlight_component
+from app.export import FORMATS as EXPORT_FORMATS, date_range, export_chunks, export_filename
+from app.review import GRADES as REVIEW_GRADES
+from app import metrics
 
 app = Flask(__name__)
 app.config.from_object(Config)
+# Open /events streams don't keep their library from being unloaded.
+app.wsgi_app = LibraryDispatcher(app, unload_library, untracked=("/events",))
 app.jinja_env.filters["to_datetime"] = to_datetime
 app.jinja_env.filters["generate_calibre_url"] = generate_calibre_url
+app.jinja_env.globals["highlight_component"] = highlight_component
+app.before_request(metrics.start_request)
+app.after_request(metrics.finish_request)
+app.teardown_appcontext(release_connections)
+before_render_template.connect(metrics.template_started, app)
+template_rendered.connect(metrics.template_finished, app)
 
 
 def get_filter_params():
@@ -25,14 +81,44 @@ def get_filter_params():
     return favorite_filter, read_filter
 
 
+STREAM_CHUNK_SIZE = 8 * 1024
+MAX_API_PAGE_SIZE = 1000
+
+
+def stream_page(template_name, **context):
+    """Render a page with stream_template, sending it in chunks of about
+    STREAM_CHUNK_SIZE rather than one per template fragment."""
+    fragments = stream_template(template_name, **context)
+
+    def chunks():
+        buffer, size = [], 0
+        for fragment in fragments:
+            buffer.append(fragment)
+            size += len(fragment)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        yield "".join(buffer)
+
+    return app.response_class(chunks(), mimetype="text/html")
+
+
+def get_page_params():
+    after = request.args.get("after")
+    limit = request.args.get("limit", app.config["PAGE_SIZE"] or 100, type=int)
+    return after, max(1, min(limit, MAX_API_PAGE_SIZE))
+
+
 @app.route("/", methods=["GET"])
+@uncacheable
 def index():
     favorite_filter, read_filter = get_filter_params()
-    annotations = get_random_annotations(favorite_filter, read_filter)
+    annotations = get_random_annotations(favorite_filter, read_filter, session.get("resurface", False))
     return render_template("index.html", annotations=annotations, favorite_filter=favorite_filter, read_filter=read_filter)
 
 
 @app.route("/books", methods=["GET"])
+@conditional(daily=True)
 def books_list():
     books = get_books_with_annotations()
     recent_books = get_recent_books()
@@ -45,13 +131,49 @@ def books_list():
     )
 
 
+@app.route("/flashback", methods=["GET"])
+@conditional(daily=True)
+def flashback():
+    # Half a year either way already covers every day of the year.
+    days = min(max(request.args.get("days", app.config["FLASHBACK_DAYS"], type=int), 0), 183)
+    flashback_data = get_flashback_annotations(days, FLASHBACK_PER_YEAR)
+    return render_template("flashback.html", flashback_data=flashback_data)
+
+
 @app.route("/book/<int:book_id>", methods=["GET"])
+@conditional(uses_filters=True)
 def book_annotations(book_id):
     favorite_filter, read_filter = get_filter_params()
-    book_data = get_book_annotations(book_id, favorite_filter, read_filter)
+    book_data = stream_book_annotations(book_id, favorite_filter, read_filter, limit=app.config["PAGE_SIZE"] or None)
     if book_data is None:
         abort(404)
-    return render_template("book.html", book_data=book_data, favorite_filter=favorite_filter, read_filter=read_filter)
+    return stream_page("book.html", book_data=book_data, favorite_filter=favorite_filter, read_filter=read_filter)
+
+
+@app.route("/api/book/<int:book_id>", methods=["GET"])
+@conditional(uses_filters=True)
+def book_annotations_api(book_id):
+    favorite_filter, read_filter = get_filter_params()
+    after, limit = get_page_params()
+    try:
+        book_data = stream_book_annotations(book_id, favorite_filter, read_filter, after, limit)
+    except ValueError:
+        abort(400)
+    if book_data is None:
+        abort(404)
+
+    annotations = [
+        {**annotation, "html": str(highlight_component(annotation, show_title=False))}
+        for annotation in book_data["annotations"]
+    ]
+    return jsonify(
+        {
+            "book_id": book_id,
+            "book_title": book_data["book_title"],
+            "annotations": annotations,
+            "next": book_data["annotations"].next_cursor,
+        }
+    )
 
 
 @app.route("/toggle_favorite/<int:annotation_id>", methods=["POST"])
@@ -66,7 +188,87 @@ def update_last_read_route(annotation_id):
     return jsonify({"success": True, "new_timestamp": new_timestamp})
 
 
+MAX_STATE_BATCH = 1000
+
+
+@app.route("/api/state", methods=["POST"])
+def state_batch_api():
+    """Apply {"operations": [{"op": ..., "id": ...}, ...]} in one write."""
+    data = request.get_json(silent=True)
+    operations = data.get("operations") if isinstance(data, dict) else None
+    if not isinstance(operations, list) or len(operations) > MAX_STATE_BATCH:
+        abort(400, f"operations must be a list of at most {MAX_STATE_BATCH}")
+    batch = []
+    for operation in operations:
+        if (
+            not isinstance(operation, dict)
+            or operation.get("op") not in STATE_OPERATIONS
+            or type(operation.get("id")) is not int
+        ):
+            abort(400, f"each operation needs an integer id and an op, one of {', '.join(STATE_OPERATIONS)}")
+        batch.append((operation["op"], operation["id"]))
+    return jsonify({"success": True, "states": apply_state_operations(batch)})
+
+
+def marked_read(annotation_ids):
+    new_timestamp = mark_read(annotation_ids)
+    return jsonify({"success": True, "count": len(annotation_ids), "new_timestamp": new_timestamp})
+
+
+@app.route("/mark_read", methods=["POST"])
+def mark_filtered_read():
+    """Mark every highlight that passes the session filters as read."""
+    return marked_read(get_filtered_annotation_ids(None, *get_filter_params()))
+
+
+@app.route("/book/<int:book_id>/mark_read", methods=["POST"])
+def mark_book_read(book_id):
+    if get_snapshot().book_rows(book_id) is None:
+        abort(404)
+    return marked_read(get_filtered_annotation_ids(book_id, *get_filter_params()))
+
+
+def graded(annotation_id, grade):
+    if grade not in REVIEW_GRADES:
+        abort(400, f"grade must be one of {', '.join(REVIEW_GRADES)}")
+    if get_snapshot().row_of(annotation_id) is None:
+        abort(404)
+    return grade_review(annotation_id, grade)
+
+
+@app.route("/review", methods=["GET"])
+@uncacheable
+def review():
+    include_new = request.args.get("new", 0, type=int) == 1
+    return render_template(
+        "review.html", review=get_next_review(include_new), include_new=include_new, grades=REVIEW_GRADES
+    )
+
+
+@app.route("/review/<int:annotation_id>", methods=["POST"])
+def grade_review_route(annotation_id):
+    graded(annotation_id, request.form.get("grade"))
+    return redirect(url_for("review", new=request.form.get("new", type=int)))
+
+
+@app.route("/api/review", methods=["GET"])
+@uncacheable
+def review_api():
+    review = get_next_review(request.args.get("new", 0, type=int) == 1)
+    if review["annotation"] is not None:
+        review["annotation"]["html"] = str(highlight_component(review["annotation"]))
+    return jsonify(review)
+
+
+@app.route("/api/review/<int:annotation_id>", methods=["POST"])
+def grade_review_api(annotation_id):
+    grade = (request.get_json(silent=True) or request.form).get("grade")
+    record = graded(annotation_id, grade)
+    return jsonify({key: record[key] for key in ("due", "interval", "ease", "last_read")})
+
+
 @app.route("/favorites", methods=["GET"])
+@conditional()
 def favorites():
     favorited_annotations = get_favorited_annotations()
     return render_template(
@@ -75,44 +277,55 @@ def favorites():
 
 
 @app.route("/focused", methods=["GET"])
+@uncacheable
 def focused_view():
     book_id = request.args.get("book_id", type=int)
     annotation_id = request.args.get("annotation_id", type=int)
     index = request.args.get("index", 0, type=int)
+    if request.args.get("random", type=int):
+        annotation_id = pick_focused_annotation_id(book_id, session.get("resurface", False))
 
-    if book_id:
-        book_data = get_book_annotations(book_id)
-        if book_data is None:
-            abort(404)
-        annotations = book_data["annotations"]
-        book_title = book_data["book_title"]
-    else:
-        annotations = get_all_annotations()
-        book_title = "All Books"
-
-    total = len(annotations)
-
-    if annotation_id:
-        index = next(
-            (i for i, a in enumerate(annotations) if a["id"] == annotation_id), 0
-        )
-    elif index < 0:
-        index = 0
-    elif index >= total:
-        index = total - 1
-
-    current_annotation = annotations[index]
+    focused = get_focused_annotations(book_id, annotation_id, index)
+    if focused is None:
+        abort(404)
 
     return render_template(
         "focused.html",
-        annotation=current_annotation,
-        index=index,
-        total=total,
+        annotation=focused["annotation"],
+        index=focused["index"],
+        total=focused["total"],
         book_id=book_id,
-        book_title=book_title,
+        book_title=focused["book_title"],
+        related=get_related_annotations(focused["annotation"]["id"]),
     )
 
 
+@app.route("/api/focused", methods=["GET"])
+@conditional()
+def focused_api():
+    book_id = request.args.get("book_id", type=int)
+    annotation_id = request.args.get("annotation_id", type=int)
+    index = request.args.get("index", 0, type=int)
+
+    focused = get_focused_annotations(book_id, annotation_id, index)
+    if focused is None:
+        abort(404)
+
+    for key in ("annotation", "previous", "next"):
+        if focused[key] is not None:
+            focused[key]["html"] = str(highlight_component(focused[key]))
+    return jsonify(focused)
+
+
+@app.route("/api/related/<int:annotation_id>", methods=["GET"])
+def related_api(annotation_id):
+    if get_snapshot().row_of(annotation_id) is None:
+        abort(404)
+    related = get_related_annotations(annotation_id)
+    related_highlights = get_template_attribute("macros.html", "related_highlights")
+    return jsonify({"annotations": related, "html": str(related_highlights(related))})
+
+
 @app.route("/focus/<int:annotation_id>", methods=["GET"])
 def focus_annotation(annotation_id):
     book_id = request.args.get("book_id", type=int)
@@ -122,10 +335,150 @@ def focus_annotation(annotation_id):
 
 
 @app.route("/highlights_with_notes", methods=["GET"])
+@conditional(uses_filters=True)
 def highlights_with_notes():
     favorite_filter, read_filter = get_filter_params()
-    annotations = get_highlights_with_notes(favorite_filter, read_filter)
-    return render_template("highlights_with_notes.html", annotations=annotations, favorite_filter=favorite_filter, read_filter=read_filter)
+    annotations = stream_highlights_with_notes(favorite_filter, read_filter, limit=app.config["PAGE_SIZE"] or None)
+    return stream_page("highlights_with_notes.html", annotations=annotations, favorite_filter=favorite_filter, read_filter=read_filter)
+
+
+@app.route("/api/highlights_with_notes", methods=["GET"])
+@conditional(uses_filters=True)
+def highlights_with_notes_api():
+    favorite_filter, read_filter = get_filter_params()
+    after, limit = get_page_params()
+    try:
+        annotations = stream_highlights_with_notes(favorite_filter, read_filter, after, limit)
+    except ValueError:
+        abort(400)
+
+    book_section = get_template_attribute("macros.html", "book_section")
+    books = [
+        {"book_id": book_id, "book_title": book_data["book_title"], "html": str(book_section(book_id, book_data))}
+        for book_id, book_data in annotations.by_book()
+    ]
+    return jsonify({"books": books, "next": annotations.next_cursor})
+
+
+@app.route("/search", methods=["GET"])
+@conditional(uses_filters=True)
+def search():
+    favorite_filter, read_filter = get_filter_params()
+    query = request.args.get("q", "")
+    page = max(request.args.get("page", 1, type=int), 1)
+    # One result more than shown, to know whether there is a next page.
+    annotations = search_annotations(
+        query, favorite_filter, read_filter, SEARCH_LIMIT + 1, (page - 1) * SEARCH_LIMIT
+    )
+    return render_template(
+        "search.html",
+        query=query,
+        annotations=annotations[:SEARCH_LIMIT],
+        page=page,
+        has_more=len(annotations) > SEARCH_LIMIT,
+        favorite_filter=favorite_filter,
+        read_filter=read_filter,
+    )
+
+
+LIVE_HEARTBEAT = 15
+# Milliseconds before pages reconnect once their library was unloaded, so
+# open pages don't load it again right away.
+LIVE_UNLOADED_RETRY = 60_000
+# Syncs touching more highlights than this tell pages to reload instead.
+LIVE_MAX_HIGHLIGHTS = 50
+
+
+def server_sent_event(event, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+def live_changes(changes):
+
+    def rendered(annotation_ids):
+        return [
+            {
+                "id": annotation["id"],
+                "book_id": annotation["book_id"],
+                "html": str(highlight_component(annotation)),
+                "book_html": str(highlight_component(annotation, show_title=False)),
+            }
+            for annotation in get_annotations_by_id(annotation_ids)
+        ]
+
+    return {
+        "added": rendered(changes["added"]),
+        "changed": rendered(changes["changed"]),
+        "deleted": changes["deleted"],
+    }
+
+
+@app.route("/events", methods=["GET"])
+def live_events():
+    """Highlights added, changed and deleted in Calibre, as Server-Sent
+    Events, from the version of the library the client last saw."""
+    feed = get_live_feed()
+    version = get_snapshot().version
+    after = request.headers.get("Last-Event-ID", version, type=int)
+
+    def events():
+        nonlocal after
+        yield "retry: 5000\n\n"
+        # A client ahead of the index has seen one that was since rebuilt.
+        syncs = None if after > version else []
+        while syncs is not None:
+            syncs = feed.wait(after, LIVE_HEARTBEAT)
+            if feed.closed:
+                yield f"retry: {LIVE_UNLOADED_RETRY}\n\n"
+                return
+            if not syncs:
+                if syncs is not None:
+                    yield ": keep-alive\n\n"
+                continue
+            for sync_version, changes in syncs:
+                if changes is None or len(changes["added"]) + len(changes["changed"]) > LIVE_MAX_HIGHLIGHTS:
+                    syncs = None
+                    break
+                yield server_sent_event("sync", live_changes(changes), sync_version)
+                after = sync_version
+        yield server_sent_event("reload", {})
+
+    response = app.response_class(stream_with_context(events()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/export", methods=["GET"])
+def export():
+    """All highlights with their state, as a download. Streamed straight
+    from the index, so it takes the same memory for any library size."""
+    format = request.args.get("format", "ndjson")
+    compress = request.args.get("gzip") == "1"
+    if format not in EXPORT_FORMATS:
+        abort(400)
+    try:
+        since, until = date_range(request.args.get("since"), request.args.get("until"))
+    except ValueError:
+        abort(400)
+    annotations = stream_export(
+        request.args.get("book_id", type=int),
+        since,
+        until,
+        request.args.get("favorites") == "1",
+        request.args.get("notes") == "1",
+    )
+
+    _, mimetype, _ = EXPORT_FORMATS[format]
+    response = app.response_class(
+        stream_with_context(export_chunks(annotations, format, compress)),
+        mimetype="application/gzip" if compress else mimetype,
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename={export_filename(format, compress)}"
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 
 @app.route('/apply_filters')
@@ -146,5 +499,53 @@ def apply_filters():
         session['favorite_filter'] = True
     elif favorite_filter == 'non_favorites':
         session['favorite_filter'] = False
+
+    pick = request.args.get('pick')
+    if pick == 'any':
+        session.pop('resurface', None)
+    elif pick == 'resurface':
+        session['resurface'] = True
     
-    return '', 204  # No content response
\ No newline at end of file
+    return '', 204  # No content response
+
+
+@app.route("/stats/db", methods=["GET"])
+def db_stats():
+    return jsonify(pool_stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_view():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.cli.command("migrate-state")
+def migrate_state_command():
+    """Convert a pre-journal state.json to the journaled format."""
+    migrated = migrate_legacy_state(app.config["STATE_FILE"])
+    if migrated is None:
+        click.echo("Nothing to migrate.")
+    else:
+        click.echo(f"Migrated state for {migrated} annotations.")
+
+
+@app.cli.command("export")
+@click.option("--format", "format", type=click.Choice(sorted(EXPORT_FORMATS)), default="ndjson")
+@click.option("--book-id", type=int, help="Only this book's highlights.")
+@click.option("--since", help="Only highlights made on or after this date (YYYY-MM-DD).")
+@click.option("--until", help="Only highlights made on or before this date (YYYY-MM-DD).")
+@click.option("--favorites", is_flag=True, help="Only favorites.")
+@click.option("--notes", is_flag=True, help="Only highlights with notes.")
+@click.option("--gzip", "compress", is_flag=True, help="Compress the output with gzip.")
+@click.option("--output", "-o", type=click.File("wb"), default="-", help="File to write to, stdout by default.")
+def export_command(format, book_id, since, until, favorites, notes, compress, output):
+    """Export highlights with their favorite and last read state."""
+    try:
+        since, until = date_range(since, until)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    # Only the index is read, so there's no need to load a snapshot.
+    sync_index()
+    annotations = stream_export(book_id, since, until, favorites, notes, sync=False)
+    for chunk in export_chunks(annotations, format, compress):
+        output.write(chunk)
@@ -0,0 +1,90 @@
+import hashlib
+import math
+import os
+from datetime import date, datetime, timezone
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+
+from app.db import calibre_change_counter
+from app.libraries import current_library
+from app.models import get_snapshot
+from app.state import get_state_store
+
+
+def data_version():
+    """Everything a rendered page depends on, besides the request itself."""
+    store = get_state_store()
+    return ":".join(
+        (
+            calibre_change_counter(current_library().db_path),
+            str(get_snapshot().version),
+            store.version,
+        )
+    )
+
+
+def last_modified():
+    db_path = current_library().db_path
+    paths = [db_path, f"{db_path}-wal"]
+    store = get_state_store()
+    paths += [store.snapshot_file, store.journal_file]
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            pass
+    # HTTP dates are in whole seconds; rounding up keeps it from predating
+    # the change.
+    return datetime.fromtimestamp(math.ceil(max(mtimes, default=0)), timezone.utc)
+
+
+def conditional(cache_control="private, no-cache", daily=False, uses_filters=False):
+    """Answer conditional GETs for a view that is a pure function of its
+    URL, the library and the state (plus the session filters if
+    uses_filters, and today's date if daily).
+
+    The ETag is computed before the view runs, so a matching If-None-Match
+    gets a 304 without running any of the view's queries. Last-Modified is
+    only informational: at whole seconds it can't tell apart two changes
+    within the same second, so If-Modified-Since alone never gets a 304.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            parts = [data_version(), request.full_path]
+            if uses_filters:
+                parts.append(f"{session.get('favorite_filter')}/{session.get('read_filter')}")
+            if daily:
+                parts.append(date.today().isoformat())
+            etag = hashlib.sha1("|".join(parts).encode()).hexdigest()
+            modified = last_modified()
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            response.last_modified = modified
+            response.headers["Cache-Control"] = cache_control
+            if uses_filters:
+                response.vary.add("Cookie")
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def uncacheable(view):
+    """For views that show something random on every request."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    return wrapper
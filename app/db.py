@@ -0,0 +1,249 @@
+import os
+import sqlite3
+import threading
+import weakref
+
+from flask import current_app
+
+from app.libraries import current_library
+
+
+class _Slot:
+    # Holds one connection. sqlite3 connections can't be weakly referenced,
+    # so the pool tracks these instead; a slot checked out by a thread that
+    # exits without releasing it is collected and its connection closed.
+    __slots__ = ("conn", "generation", "__weakref__")
+
+    def __init__(self, conn, generation):
+        self.conn = conn
+        self.generation = generation
+
+
+class ConnectionPool:
+    """Long-lived connections to a single SQLite database, reused across
+    requests.
+
+    A thread checks a connection out the first time it asks for one and
+    keeps it until release(), which runs as each request ends and puts it
+    back among up to max_idle idle connections for the next request,
+    whichever thread serves it. Reusing connections keeps SQLite's page
+    cache warm and lets the sqlite3 module reuse prepared statements (up to
+    cached_statements per connection), instead of paying for open, schema
+    parse, setup and statement preparation on every request.
+
+    With immutable=True SQLite skips all locking and change detection, so
+    the pool watches the file's mtime/size itself and reopens every
+    connection when it changes.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        readonly=True,
+        mmap_size=0,
+        cache_size=None,
+        query_only=False,
+        immutable=False,
+        cached_statements=256,
+        isolation_level="",
+        max_idle=8,
+    ):
+        self.db_path = db_path
+        self.readonly = readonly
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.query_only = query_only
+        self.immutable = immutable
+        self.cached_statements = cached_statements
+        self.isolation_level = isolation_level
+        self.max_idle = max_idle
+
+        self._setups = []
+        self._local = threading.local()
+        self._idle = []
+        self._slots = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._signature = self._file_signature() if immutable else None
+        self._opened = 0
+        self._reused = 0
+        self._reopened = 0
+
+    def _file_signature(self):
+        signature = []
+        for path in (self.db_path, f"{self.db_path}-wal"):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return signature
+
+    def _open(self):
+        if self.readonly:
+            mode = "ro&immutable=1" if self.immutable else "ro"
+            conn = sqlite3.connect(
+                f"file:{self.db_path}?mode={mode}",
+                uri=True,
+                isolation_level=self.isolation_level,
+                cached_statements=self.cached_statements,
+                check_same_thread=False,
+            )
+        else:
+            conn = sqlite3.connect(
+                f"file:{self.db_path}",
+                uri=True,
+                timeout=30,
+                isolation_level=self.isolation_level,
+                cached_statements=self.cached_statements,
+                check_same_thread=False,
+            )
+        conn.row_factory = sqlite3.Row
+        if self.mmap_size:
+            conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        if self.cache_size is not None:
+            conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        if self.query_only:
+            conn.execute("PRAGMA query_only = 1")
+        for setup in self._setups:
+            setup(conn)
+        return conn
+
+    def add_setup(self, setup):
+        """Run setup(conn) on every connection, reopening existing ones."""
+        with self._lock:
+            if setup not in self._setups:
+                self._setups.append(setup)
+                self._generation += 1
+
+    def connection(self):
+        if self.immutable:
+            signature = self._file_signature()
+            if signature != self._signature:
+                with self._lock:
+                    if signature != self._signature:
+                        self._signature = signature
+                        self._generation += 1
+
+        slot = getattr(self._local, "slot", None)
+        if slot is not None and slot.generation == self._generation:
+            self._reused += 1
+            return slot.conn
+
+        with self._lock:
+            if slot is not None:
+                slot.conn.close()
+                self._reopened += 1
+                slot = None
+            while self._idle:
+                # Most recently used first, as its cache is the warmest.
+                idle = self._idle.pop()
+                if idle.generation == self._generation:
+                    slot = idle
+                    self._reused += 1
+                    break
+                idle.conn.close()
+                self._reopened += 1
+            if slot is None:
+                slot = _Slot(self._open(), self._generation)
+                self._slots.add(slot)
+                self._opened += 1
+            self._local.slot = slot
+        return slot.conn
+
+    def release(self):
+        """Give back the connection the current thread checked out, if any."""
+        slot = getattr(self._local, "slot", None)
+        if slot is None:
+            return
+        self._local.slot = None
+        if slot.conn.in_transaction:
+            slot.conn.rollback()
+        with self._lock:
+            if slot.generation == self._generation and len(self._idle) < self.max_idle:
+                self._idle.append(slot)
+                return
+        slot.conn.close()
+
+    def close(self):
+        """Close the idle connections, and the checked out ones as they are
+        given back."""
+        with self._lock:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+        for slot in idle:
+            slot.conn.close()
+
+    def stats(self):
+        return {
+            "db_path": self.db_path,
+            "immutable": self.immutable,
+            "connections": len(self._slots),
+            "idle": len(self._idle),
+            "opened": self._opened,
+            "reopened": self._reopened,
+            "reused": self._reused,
+        }
+
+
+def calibre_change_counter(db_path):
+    """Calibre's database change counter, read straight from the file.
+
+    SQLite bumps the "file change counter" in the header (bytes 24-27) on
+    every commit in rollback-journal mode. In WAL mode it doesn't, so the WAL
+    file's size and mtime are folded in as well.
+    """
+    with open(db_path, "rb") as f:
+        header = f.read(28)
+    counter = str(int.from_bytes(header[24:28], "big"))
+    try:
+        wal = os.stat(f"{db_path}-wal")
+    except FileNotFoundError:
+        return counter
+    return f"{counter}.{wal.st_mtime_ns}.{wal.st_size}"
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path, key=None, **options):
+    """The pool for db_path, or for key if a database has more than one."""
+    key = key or db_path
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path, **options)
+    return pool
+
+
+def release_pool(key):
+    """Forget the pool for key and close its connections."""
+    with _pools_lock:
+        pool = _pools.pop(key, None)
+    if pool is not None:
+        pool.close()
+
+
+def release_connections(exception=None):
+    """Give back the current thread's connections, at the end of a request."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.release()
+
+
+def get_calibre_pool():
+    config = current_app.config
+    return get_pool(
+        current_library().db_path,
+        mmap_size=config["CALIBRE_MMAP_SIZE"],
+        cache_size=config["CALIBRE_CACHE_SIZE"],
+        query_only=config["CALIBRE_QUERY_ONLY"],
+        immutable=config["CALIBRE_IMMUTABLE"],
+    )
+
+
+def pool_stats():
+    with _pools_lock:
+        return [pool.stats() for pool in _pools.values()]
@@ -0,0 +1,106 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from app.utils import to_datetime
+
+FIELDS = (
+    "id",
+    "book_id",
+    "book_title",
+    "chapter_name",
+    "timestamp",
+    "text",
+    "notes",
+    "is_favorite",
+    "last_read",
+    "spine_index",
+    "start_cfi",
+)
+# Output is sent in pieces of about this size, rather than a line at a time.
+CHUNK_SIZE = 64 * 1024
+# gzip's fastest level: four times as fast as the default here, for output
+# about a fifth larger.
+GZIP_LEVEL = 1
+
+_encode_json = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def ndjson_lines(annotations):
+    for annotation in annotations:
+        yield _encode_json({field: annotation[field] for field in FIELDS}) + "\n"
+
+
+def csv_lines(annotations):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for annotation in annotations:
+        writer.writerow([annotation[field] for field in FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def markdown_lines(annotations):
+    """A section per book, with each highlight as a quote."""
+    for _, book in groupby(annotations, key=itemgetter("book_id")):
+        for index, annotation in enumerate(book):
+            if index == 0:
+                yield f"# {annotation['book_title']}\n\n"
+            yield "".join(f"> {line}\n" for line in annotation["text"].splitlines() or [""]) + "\n"
+            if annotation["notes"]:
+                yield f"{annotation['notes']}\n\n"
+            details = [annotation["chapter_name"], to_datetime(annotation["timestamp"])]
+            if annotation["is_favorite"]:
+                details.append("favorite")
+            yield f"*{' · '.join(filter(None, details))}*\n\n"
+
+
+FORMATS = {
+    "ndjson": (ndjson_lines, "application/x-ndjson", "ndjson"),
+    "csv": (csv_lines, "text/csv", "csv"),
+    "markdown": (markdown_lines, "text/markdown", "md"),
+}
+
+
+def export_chunks(annotations, format, compress=False):
+    """The annotations in the given format, as bytes, CHUNK_SIZE or so at a
+    time; gzipped if compress."""
+    lines, _, _ = FORMATS[format]
+    compressor = zlib.compressobj(GZIP_LEVEL, wbits=31) if compress else None
+    buffer, size = [], 0
+    for line in lines(annotations):
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            chunk = "".join(buffer).encode()
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+            buffer, size = [], 0
+    chunk = "".join(buffer).encode()
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def date_range(since=None, until=None):
+    """Timestamps from the start of day since up to the end of day until, given
+    as YYYY-MM-DD in local time. Raises ValueError for other dates."""
+    if since is not None:
+        since = datetime.strptime(since, "%Y-%m-%d").timestamp()
+    if until is not None:
+        until = (datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1)).timestamp()
+    return since, until
+
+
+def export_filename(format, compress=False):
+    _, _, extension = FORMATS[format]
+    return f"capsule-highlights.{extension}" + (".gz" if compress else "")
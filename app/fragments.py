@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+from flask import current_app, get_template_attribute, has_request_context, request
+from markupsafe import Markup
+
+from app.metrics import FRAGMENT_CACHE_BYTES, FRAGMENT_CACHE_EVICTIONS, FRAGMENT_CACHE_REQUESTS
+
+
+class FragmentCache:
+    """Rendered HTML by key, least recently used first out once the
+    fragments add up to more than max_bytes (counting one byte per
+    character, which is close for this mostly-ASCII markup)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._fragments.get(key)
+            if html is not None:
+                self._fragments.move_to_end(key)
+        FRAGMENT_CACHE_REQUESTS.inc(("miss" if html is None else "hit",))
+        return html
+
+    def put(self, key, html):
+        if len(html) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._fragments.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._fragments[key] = html
+            self.size += len(html)
+            evicted = 0
+            while self.size > self.max_bytes:
+                _, oldest = self._fragments.popitem(last=False)
+                self.size -= len(oldest)
+                evicted += 1
+            size = self.size
+        if evicted:
+            FRAGMENT_CACHE_EVICTIONS.inc((), evicted)
+        FRAGMENT_CACHE_BYTES.set(size)
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_fragment_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FragmentCache(current_app.config["FRAGMENT_CACHE_BYTES"])
+    return _cache
+
+
+def highlight_component(annotation, show_title=True):
+    """The highlight_component macro, cached.
+
+    A highlight renders the same until it is edited in Calibre (which
+    changes its timestamp), its book is renamed or its state changes, so
+    those are the key. Search results mark their matches and aren't cached.
+    """
+    render = get_template_attribute("macros.html", "render_highlight")
+    if annotation.get("text_snippet") or annotation.get("notes_snippet"):
+        return render(annotation, show_title)
+
+    key = (
+        annotation["id"],
+        show_title,
+        annotation["timestamp"],
+        annotation["book_title"],
+        bool(annotation["is_favorite"]),
+        annotation["last_read"],
+        # Links in the markup start with it.
+        request.script_root if has_request_context() else "",
+    )
+    cache = get_fragment_cache()
+    html = cache.get(key)
+    if html is None:
+        html = str(render(annotation, show_title))
+        cache.put(key, html)
+    return Markup(html)
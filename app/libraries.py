@@ -0,0 +1,198 @@
+import os
+import re
+import threading
+import time
+from binascii import hexlify
+from collections import OrderedDict
+
+from flask import current_app, has_request_context, request
+from werkzeug.wsgi import ClosingIterator
+
+# The WSGI environ key the dispatcher stores the name of a request's library
+# under; the default library has none.
+ENVIRON_KEY = "capsule.library"
+NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+# Rough bytes in memory per byte of the state file, for the store's entries
+# and their copy in the state database.
+STATE_MEMORY_FACTOR = 4
+# Seconds a library's memory estimate is reused before its files are
+# looked at again.
+MEMORY_ESTIMATE_INTERVAL = 5
+
+
+class Library:
+    """One Calibre library and where Capsule keeps its state and index."""
+
+    def __init__(self, name, db_path, state_file, index_path):
+        self.name = name
+        self.db_path = db_path
+        self.state_file = state_file
+        self.index_path = index_path
+
+    @property
+    def calibre_id(self):
+        # What calibre:// links call the library: its folder's name, hex
+        # encoded the way Calibre does if it isn't plain. The default library
+        # keeps the id its links have always had.
+        if self.name is None:
+            return "books"
+        library_id = os.path.basename(os.path.dirname(os.path.abspath(self.db_path))).replace(" ", "_")
+        if re.match(r"^[A-Za-z0-9_]+$", library_id):
+            return library_id
+        return "_hex_-" + hexlify(library_id.encode("utf-8")).decode("ascii")
+
+    def memory_estimate(self):
+        """Bytes its loaded snapshot and state take up, judged by the size of
+        the files they are read from."""
+        total = 0
+        for path, factor in (
+            (f"{self.index_path}.snapshot", 1),
+            (self.state_file, STATE_MEMORY_FACTOR),
+            (f"{self.state_file}.journal", STATE_MEMORY_FACTOR),
+        ):
+            try:
+                total += os.path.getsize(path) * factor
+            except OSError:
+                pass
+        return total
+
+
+_libraries = {}
+_libraries_lock = threading.Lock()
+
+
+def get_libraries(app):
+    """The libraries configured for app, by name; the default one is under
+    None."""
+    config = app.config
+    key = (
+        config["DB_PATH"],
+        config["STATE_FILE"],
+        config["INDEX_PATH"],
+        config["LIBRARY_DIR"],
+        tuple(config["LIBRARIES"].items()),
+    )
+    with _libraries_lock:
+        libraries = _libraries.get(key)
+        if libraries is None:
+            libraries = {None: Library(None, *key[:3])}
+            # A library named like a page would take its URLs over.
+            routes = {rule.rule.split("/")[1] for rule in app.url_map.iter_rules()}
+            for name, db_path in config["LIBRARIES"].items():
+                if not NAME.match(name):
+                    raise ValueError(f"Library name {name!r} can only have letters, digits, - and _")
+                if name in routes:
+                    raise ValueError(f"Library name {name!r} is taken by /{name}")
+                directory = os.path.join(config["LIBRARY_DIR"], name)
+                os.makedirs(directory, exist_ok=True)
+                libraries[name] = Library(
+                    name, db_path, os.path.join(directory, "state.json"), os.path.join(directory, "capsule-index.db")
+                )
+            _libraries[key] = libraries
+    return libraries
+
+
+def current_library():
+    """The library of the current request, or the default one outside of
+    requests."""
+    name = request.environ.get(ENVIRON_KEY) if has_request_context() else None
+    return get_libraries(current_app)[name]
+
+
+class LibraryDispatcher:
+    """WSGI middleware serving each extra library under /<name>/.
+
+    The prefix moves from PATH_INFO to SCRIPT_NAME, so url_for and
+    request.script_root carry it into every link. It also keeps the
+    libraries in least recently used order, and once their estimated memory
+    is over LIBRARY_MEMORY_BUDGET calls unload(library) on the oldest with
+    no request in progress (streams count until they close), which is then
+    loaded again by the next request for it. Requests for the paths in
+    untracked, such as long-lived event streams, don't count as in progress
+    and must let go of the library when it is unloaded.
+
+    Unloading runs outside the dispatcher's lock, on the thread of the
+    request that went over the budget; only requests for the library being
+    unloaded wait for it to finish.
+    """
+
+    def __init__(self, app, unload, untracked=()):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.unload = unload
+        self.untracked = frozenset(untracked)
+        self._lock = threading.Lock()
+        self._loaded = OrderedDict()
+        self._in_flight = {}
+        self._unloading = {}
+        self._estimates = {}
+
+    def __call__(self, environ, start_response):
+        libraries = get_libraries(self.app)
+        path = environ.get("PATH_INFO", "")
+        name = path.split("/", 2)[1] if path.startswith("/") else ""
+        if name in libraries:
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + "/" + name
+            environ["PATH_INFO"] = path[len(name) + 1:]
+            environ[ENVIRON_KEY] = name
+        else:
+            name = None
+
+        tracked = environ.get("PATH_INFO", "") not in self.untracked
+        while True:
+            with self._lock:
+                unloading = self._unloading.get(name)
+                if unloading is None:
+                    self._loaded[name] = libraries[name]
+                    self._loaded.move_to_end(name)
+                    if tracked:
+                        self._in_flight[name] = self._in_flight.get(name, 0) + 1
+                    break
+            unloading.wait()
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._finished(name, tracked)
+            raise
+        return ClosingIterator(response, lambda: self._finished(name, tracked))
+
+    def _estimate(self, library, now):
+        # Called with the lock held.
+        estimate = self._estimates.get(library.name)
+        if estimate is None or now - estimate[0] >= MEMORY_ESTIMATE_INTERVAL:
+            estimate = self._estimates[library.name] = (now, library.memory_estimate())
+        return estimate[1]
+
+    def _finished(self, name, tracked=True):
+        unloads = []
+        with self._lock:
+            if tracked:
+                self._in_flight[name] -= 1
+            budget = self.app.config["LIBRARY_MEMORY_BUDGET"]
+            if not budget:
+                return
+            now = time.monotonic()
+            sizes = {name: self._estimate(library, now) for name, library in self._loaded.items()}
+            total = sum(sizes.values())
+            # The most recently used library always stays.
+            for name in list(self._loaded)[:-1]:
+                if total <= budget:
+                    break
+                if self._in_flight.get(name):
+                    continue
+                # Requests for it wait until it is unloaded.
+                self._unloading[name] = threading.Event()
+                self._estimates.pop(name, None)
+                unloads.append((name, self._loaded.pop(name)))
+                total -= sizes[name]
+
+        for name, library in unloads:
+            try:
+                self.unload(library)
+            finally:
+                with self._lock:
+                    self._unloading.pop(name).set()
+
+    def loaded(self):
+        with self._lock:
+            return list(self._loaded)
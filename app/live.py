@@ -0,0 +1,72 @@
+import threading
+from collections import deque
+
+# Syncs remembered for clients that reconnect; one that has missed more is
+# told to reload instead.
+HISTORY = 100
+
+
+class Feed:
+    """The highlights each sync of one library added, changed and deleted,
+    for clients that follow along as they happen.
+
+    Every sync gets the snapshot version it produced. changes is None when
+    the snapshot was re-read without knowing what changed, e.g. because it
+    missed a sync made by another process.
+    """
+
+    def __init__(self, manager):
+        self._syncs = deque(maxlen=HISTORY)
+        self._changed = threading.Condition()
+        self._forgotten = None
+        self.version = None
+        self.closed = False
+        manager.subscribe(self.publish)
+
+    def publish(self, snapshot):
+        with self._changed:
+            if len(self._syncs) == HISTORY:
+                self._forgotten = self._syncs[0][0]
+            self._syncs.append((snapshot.version, snapshot.changes))
+            self.version = snapshot.version
+            self._changed.notify_all()
+
+    def wait(self, after, timeout):
+        """The (version, changes) of syncs newer than version after, waiting up
+        to timeout seconds for one. Returns None if some of them have been
+        forgotten already, and no syncs once the feed is closed."""
+        with self._changed:
+            if self._forgotten is not None and after < self._forgotten:
+                return None
+            self._changed.wait_for(
+                lambda: self.closed or (self.version is not None and self.version > after), timeout
+            )
+            return [] if self.closed else [sync for sync in self._syncs if sync[0] > after]
+
+    def close(self):
+        """Wake everyone waiting, to let go of the library."""
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+def get_feed(manager, poll_interval):
+    """The feed of the library behind manager, which is then checked for
+    changes every poll_interval seconds."""
+    with _feeds_lock:
+        feed = _feeds.get(manager.db_path)
+        if feed is None:
+            feed = _feeds[manager.db_path] = Feed(manager)
+            manager.watch(poll_interval)
+    return feed
+
+
+def release_feed(db_path):
+    with _feeds_lock:
+        feed = _feeds.pop(db_path, None)
+    if feed is not None:
+        feed.close()
@@ -0,0 +1,372 @@
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from flask import current_app, g, has_app_context, request
+
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNTS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000, 50000)
+
+_registry = []
+_local = threading.local()
+# Only one cProfile profiler can be active in the process on Python 3.12+,
+# so requests that overlap one being profiled go unprofiled.
+_profile_lock = threading.Lock()
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labelnames = labelnames
+        # labels -> [per-bucket counts (the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, labels=()):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][bucket] += 1
+            counts[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((labels, (list(buckets), total)) for labels, (buckets, total) in self._values.items())
+        names = (*self.labelnames, "le")
+        for labels, (buckets, total) in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), buckets):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(names, (*labels, bound))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Gauge:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        _registry.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.value}"
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "capsule_request_seconds",
+    "Time to handle a request, including streaming the response.",
+    SECONDS,
+    ("endpoint", "method", "status"),
+)
+REQUEST_SQL_SECONDS = Histogram(
+    "capsule_request_sql_seconds", "Time spent in SQL per request.", SECONDS, ("endpoint",)
+)
+REQUEST_QUERIES = Histogram(
+    "capsule_request_queries", "SQL statements run per request.", COUNTS, ("endpoint",)
+)
+REQUEST_STATE_READS = Histogram(
+    "capsule_request_state_reads", "State store reads per request.", COUNTS, ("endpoint",)
+)
+REQUEST_STATE_WRITES = Histogram(
+    "capsule_request_state_writes", "State store writes per request.", COUNTS, ("endpoint",)
+)
+REQUEST_ROWS = Histogram(
+    "capsule_request_rows_hydrated", "Annotation rows turned into dicts per request.", COUNTS, ("endpoint",)
+)
+SQL_SECONDS = Histogram(
+    "capsule_sql_seconds", "Time spent using a database connection, by call site.", SECONDS, ("call_site",)
+)
+SQL_QUERIES = Counter("capsule_sql_queries_total", "SQL statements run, by call site.", ("call_site",))
+STATE_SECONDS = Histogram(
+    "capsule_state_seconds", "Time of state store operations.", SECONDS, ("operation", "kind")
+)
+TEMPLATE_SECONDS = Histogram(
+    "capsule_template_render_seconds", "Time to render a template.", SECONDS, ("template",)
+)
+FRAGMENT_CACHE_REQUESTS = Counter(
+    "capsule_fragment_cache_requests_total", "Rendered highlight lookups, by result.", ("result",)
+)
+FRAGMENT_CACHE_EVICTIONS = Counter(
+    "capsule_fragment_cache_evictions_total", "Rendered highlights dropped to stay within the size limit."
+)
+FRAGMENT_CACHE_BYTES = Gauge("capsule_fragment_cache_bytes", "Size of the rendered highlights cached.")
+SLOW_PROFILES = Counter(
+    "capsule_slow_request_profiles_total", "Slow requests saved with a cProfile profile.", ("endpoint",)
+)
+UNPROFILED_REQUESTS = Counter(
+    "capsule_unprofiled_requests_total", "Requests not profiled because another one was being profiled."
+)
+
+
+class RequestStats:
+    __slots__ = (
+        "start",
+        "sql_seconds",
+        "queries",
+        "state_reads",
+        "state_writes",
+        "rows",
+        "render_starts",
+        "profile",
+    )
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_seconds = 0.0
+        self.queries = 0
+        self.state_reads = 0
+        self.state_writes = 0
+        self.rows = 0
+        self.render_starts = []
+        self.profile = None
+
+
+def current_stats():
+    return g.get("request_stats") if has_app_context() else None
+
+
+def statements_run():
+    """SQL statements run on this thread so far."""
+    return getattr(_local, "statements", 0)
+
+
+def _count_statement():
+    _local.statements = getattr(_local, "statements", 0) + 1
+
+
+class _CountingCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args):
+        _count_statement()
+        self._cursor.execute(*args)
+        return self
+
+    def executemany(self, *args):
+        _count_statement()
+        self._cursor.executemany(*args)
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection:
+    # Counts statements as they are executed. A trace callback would also
+    # see the statements SQLite runs internally, which FTS5 queries run
+    # thousands of, and calling into Python for each one is slow.
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def cursor(self):
+        return _CountingCursor(self._conn.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class TimedConnection:
+    """A pooled connection that records the time and statements of each
+    `with` block under call_site."""
+
+    def __init__(self, conn, call_site):
+        self.conn = conn
+        self.call_site = call_site
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._statements = statements_run()
+        return _CountingConnection(self.conn.__enter__())
+
+    def __exit__(self, *exc_info):
+        try:
+            return self.conn.__exit__(*exc_info)
+        finally:
+            elapsed = time.perf_counter() - self._start
+            statements = statements_run() - self._statements
+            SQL_SECONDS.observe(elapsed, (self.call_site,))
+            SQL_QUERIES.inc((self.call_site,), statements)
+            stats = current_stats()
+            if stats is not None:
+                stats.sql_seconds += elapsed
+                stats.queries += statements
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def timed_connection(pool, call_site):
+    """A connection from pool, timed under call_site."""
+    return TimedConnection(pool.connection(), call_site)
+
+
+def state_operation(kind):
+    """Time a state store function; kind is "read" or "write". Calls made
+    from inside another timed operation only count toward the outer one."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, "in_state_operation", False):
+                return function(*args, **kwargs)
+            _local.in_state_operation = True
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _local.in_state_operation = False
+                STATE_SECONDS.observe(time.perf_counter() - start, (function.__name__, kind))
+                stats = current_stats()
+                if stats is not None:
+                    if kind == "write":
+                        stats.state_writes += 1
+                    else:
+                        stats.state_reads += 1
+
+        return wrapper
+
+    return decorator
+
+
+def count_rows(rows):
+    stats = current_stats()
+    if stats is not None:
+        stats.rows += rows
+
+
+def start_request():
+    stats = g.request_stats = RequestStats()
+    if not current_app.config["PROFILE_SLOW_REQUESTS"]:
+        return
+    if not _profile_lock.acquire(blocking=False):
+        UNPROFILED_REQUESTS.inc()
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Some other profiler (a debugger, coverage) is already active.
+        _profile_lock.release()
+        UNPROFILED_REQUESTS.inc()
+        return
+    stats.profile = profile
+
+
+def finish_request(response):
+    """Record the request once its response has been sent, which for a
+    streamed response is after the view has returned.
+
+    The profile only covers the view, and is stopped as soon as it returns:
+    a stream can stay open for as long as its page does (the live events of
+    every open tab), and would hold the profiler all that time.
+    """
+    stats = g.get("request_stats")
+    if stats is None:
+        return response
+    endpoint = request.endpoint or "none"
+    method = request.method
+    path = request.full_path.rstrip("?")
+
+    if stats.profile is not None:
+        stats.profile.disable()
+        _profile_lock.release()
+        elapsed = time.perf_counter() - stats.start
+        if elapsed >= current_app.config["PROFILE_SLOW_REQUESTS"]:
+            profile_dir = current_app.config["PROFILE_DIR"]
+            os.makedirs(profile_dir, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{elapsed * 1000:.0f}ms.prof"
+            stats.profile.dump_stats(os.path.join(profile_dir, name))
+            SLOW_PROFILES.inc((endpoint,))
+            current_app.logger.warning(
+                "Slow request %s %s, view took %.0f ms, profile saved as %s",
+                method, path, elapsed * 1000, os.path.join(profile_dir, name),
+            )
+        stats.profile = None
+
+    def record():
+        elapsed = time.perf_counter() - stats.start
+        REQUEST_SECONDS.observe(elapsed, (endpoint, method, str(response.status_code)))
+        REQUEST_SQL_SECONDS.observe(stats.sql_seconds, (endpoint,))
+        REQUEST_QUERIES.observe(stats.queries, (endpoint,))
+        REQUEST_STATE_READS.observe(stats.state_reads, (endpoint,))
+        REQUEST_STATE_WRITES.observe(stats.state_writes, (endpoint,))
+        REQUEST_ROWS.observe(stats.rows, (endpoint,))
+
+    response.call_on_close(record)
+    return response
+
+
+def template_started(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.render_starts.append(time.perf_counter())
+
+
+def template_finished(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.render_starts:
+        TEMPLATE_SECONDS.observe(time.perf_counter() - stats.render_starts.pop(), (template.name,))
@@ -1,364 +1,635 @@
-import sqlite3
 from flask import current_app
-from datetime import datetime, timedelta
-import random
+from datetime import date, datetime
+import base64
+import heapq
 import json
+import logging
+import random
+import sqlite3
+from functools import partial
+from itertools import chain, groupby
+from operator import itemgetter
 
-from app.utils import is_favorite, toggle_favorite, load_state, get_last_read, chapter_array_to_str, is_read
+from markupsafe import Markup, escape
 
+from app.db import calibre_change_counter, get_calibre_pool, release_pool
+from app.libraries import current_library
+from app.live import get_feed, release_feed
+from app.metrics import count_rows, timed_connection
+from app.related import get_related_index, release_related_index
+from app.review import get_review_queue, release_review_queue
+from app.sampling import get_sampler, release_sampler
+from app.sidecar import get_sidecar, release_sidecar
+from app.snapshot import Snapshot, get_snapshot_manager, release_snapshot_manager, snapshot_lock
+from app.state import get_state_store, release_state_store
+from app.state_db import get_state_db, release_state_db, state_filter_sql
+from app.utils import fts_query, get_annotation_states
 
-def get_db_connection():
-    conn = sqlite3.connect(f'file:{current_app.config["DB_PATH"]}?mode=ro', uri=True)
-    conn.row_factory = sqlite3.Row
-    return conn
 
+def get_db_connection(call_site):
+    return timed_connection(get_calibre_pool(), call_site)
 
-def get_random_annotations(favorite_filter=None, read_filter=None):
-    query = """
-    SELECT a.id, JSON_EXTRACT(a.annot_data, '$.highlighted_text') as highlighted_text,
-           JSON_EXTRACT(a.annot_data, '$.notes') as notes,
-           JSON_EXTRACT(a.annot_data, '$.spine_index') as spine_index,
-           JSON_EXTRACT(a.annot_data, '$.start_cfi') as start_cfi,
-           JSON_EXTRACT(a.annot_data, '$.toc_family_titles') as chapter_array,
-           a.timestamp, b.title, b.id as book_id
-    FROM annotations a
-    JOIN books b ON a.book = b.id
-    WHERE JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-    ORDER BY RANDOM()
-    LIMIT 1000;
-    """
 
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query)
-        rows = cur.fetchall()
+def get_index_connection(call_site, sync=True):
+    if sync:
+        get_snapshot()  # make sure the index is synced
+    store = get_state_store()
+    store.refresh()
+    sidecar = get_sidecar(current_library().index_path)
+    sidecar.pool.add_setup(get_state_db(store).attach)
+    return timed_connection(sidecar.pool, call_site)
 
-    annotations = [
-        {
-            "id": row["id"],
-            "text": row["highlighted_text"],
-            "notes": row["notes"],
-            "spine_index": row["spine_index"],
-            "start_cfi": row["start_cfi"],
-            "book_title": row["title"],
-            "book_id": row["book_id"],
-            "timestamp": row["timestamp"],
-            "chapter_name": chapter_array_to_str(row["chapter_array"]),
-            "is_favorite": is_favorite(row["id"]),
-            "last_read": get_last_read(row["id"]),
-        }
-        for row in rows
-    ]
 
-    filtered_annotations = filter_annotations(annotations, favorite_filter, read_filter)
-    return random.sample(filtered_annotations, min(3, len(filtered_annotations)))
+# Annotation fields as the templates expect them, from the index's
+# annotations a joined with the attached state s.
+ANNOTATION_COLUMNS = """
+    a.id, a.text, a.notes, a.spine_index, a.start_cfi, a.title as book_title, a.book_id,
+    a.timestamp, a.chapter as chapter_name, COALESCE(s.favorite, 0) as is_favorite, s.last_read
+"""
 
 
-def get_books_with_annotations():
-    query = """
-    SELECT b.id, b.title, COUNT(a.id) AS annotation_count
-    FROM books b
-    JOIN annotations a ON a.book = b.id
-    WHERE JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-    GROUP BY b.id, b.title
-    ORDER BY b.title;
-    """
+def annotation_from_row(row):
+    return {**dict(row), "is_favorite": bool(row["is_favorite"])}
 
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query)
-        rows = cur.fetchall()
 
-    return [
-        {
-            "book_id": row["id"],
-            "book_title": row["title"],
-            "annotation_count": row["annotation_count"],
-        }
-        for row in rows
-    ]
+def load_snapshot(calibre_pool, sidecar, snapshot_path, previous):
+    """The current snapshot, mapped from snapshot_path.
 
+    Worker processes share the saved snapshot: the first one to load after
+    a change syncs the index and saves a new snapshot, and the others, which
+    wait for it, map that instead of building their own.
+    """
+    with snapshot_lock(snapshot_path):
+        # Read before syncing, so that a change landing during the sync leaves
+        # the saved snapshot looking stale rather than current.
+        source = calibre_change_counter(calibre_pool.db_path)
+        snapshot = Snapshot.load(snapshot_path)
+        if snapshot is not None and snapshot.source == source:
+            with sidecar.connect() as conn:
+                if sidecar.sync_version(conn) != snapshot.version:
+                    snapshot = None
+        else:
+            snapshot = None
+        if snapshot is None:
+            snapshot = build_snapshot(calibre_pool, sidecar, snapshot_path, source, previous)
+            get_related_index(sidecar).refresh(snapshot.version)
+
+    if previous is not None and previous.version == snapshot.version:
+        return previous
+    if previous is None or previous.version != snapshot.version - 1:
+        snapshot.changes = None
+    return snapshot
+
+
+def build_snapshot(calibre_pool, sidecar, snapshot_path, source, previous):
+    with calibre_pool.connection() as calibre:
+        changes = sidecar.sync(calibre)
 
-def get_book_annotations(book_id, favorite_filter=None, read_filter=None):
     query = """
-    SELECT a.id, JSON_EXTRACT(a.annot_data, '$.highlighted_text') as highlighted_text,
-           JSON_EXTRACT(a.annot_data, '$.notes') as notes,
-           JSON_EXTRACT(a.annot_data, '$.spine_index') as spine_index,
-           JSON_EXTRACT(a.annot_data, '$.start_cfi') as start_cfi,
-           JSON_EXTRACT(a.annot_data, '$.toc_family_titles') as chapter_array,
-           a.timestamp, b.title, b.id as book_id
-    FROM annotations a
-    JOIN books b ON a.book = b.id
-    WHERE a.book = ? AND JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-    ORDER BY a.timestamp;
+    SELECT id, book_id, title, text, notes, spine_index, start_cfi, chapter, timestamp
+    FROM annotations
+    ORDER BY id;
     """
 
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query, (book_id,))
-        rows = cur.fetchall()
-
-    if not rows:
+    with sidecar.connect() as conn:
+        version = sidecar.sync_version(conn)
+        if previous is not None and previous.version == version:
+            snapshot = previous
+        else:
+            cur = conn.cursor()
+            cur.execute(query)
+            snapshot = Snapshot(version, cur, changes)
+
+    snapshot.source = source
+    try:
+        snapshot.save(snapshot_path)
+    except OSError:
+        logging.getLogger(__name__).exception("Saving the snapshot to %s failed", snapshot_path)
+        return snapshot
+    # Served from the file like everywhere else, rather than from a private
+    # copy of every highlight.
+    saved = Snapshot.load(snapshot_path)
+    return snapshot if saved is None else saved
+
+
+def restore_snapshot(calibre_pool, sidecar, snapshot_path):
+    """The saved snapshot, if it matches the index, and whether Calibre's
+    database has changed since."""
+    snapshot = Snapshot.load(snapshot_path)
+    if snapshot is None:
         return None
-
-    annotations = [
-        {
-            "book_title": rows[0]["title"],
-            "book_id": rows[0]["book_id"],
-            "id": row["id"],
-            "text": row["highlighted_text"],
-            "notes": row["notes"],
-            "spine_index": row["spine_index"],
-            "start_cfi": row["start_cfi"],
-            "timestamp": row["timestamp"],
-            "chapter_name": chapter_array_to_str(row["chapter_array"]),
-            "is_favorite": is_favorite(row["id"]),
-            "last_read": get_last_read(row["id"]),
-        }
+    with sidecar.connect() as conn:
+        if sidecar.sync_version(conn) != snapshot.version:
+            return None
+    snapshot.changes = None
+    return snapshot, snapshot.source == calibre_change_counter(calibre_pool.db_path)
+
+
+def sync_index():
+    """Bring the index up to date without loading a snapshot, for commands
+    that only read the index."""
+    with get_calibre_pool().connection() as calibre:
+        get_sidecar(current_library().index_path).sync(calibre)
+
+
+def get_current_snapshot_manager():
+    calibre_pool = get_calibre_pool()
+    sidecar = get_sidecar(current_library().index_path)
+    # Derived data like the index, so it lives next to it.
+    snapshot_path = f"{current_library().index_path}.snapshot"
+    loader = partial(load_snapshot, calibre_pool, sidecar, snapshot_path)
+    restore = partial(restore_snapshot, calibre_pool, sidecar, snapshot_path)
+    return get_snapshot_manager(calibre_pool.db_path, loader, restore)
+
+
+def get_snapshot():
+    return get_current_snapshot_manager().current()
+
+
+def unload_library(library):
+    """Let go of everything loaded for library, which the next request for
+    it loads again. The snapshot manager goes before the related index, as
+    a rebuild it waits for can register the index again."""
+    release_feed(library.db_path)
+    release_snapshot_manager(library.db_path)
+    release_pool(library.db_path)
+    for release in (release_review_queue, release_sampler, release_state_db, release_state_store):
+        release(library.state_file)
+    release_related_index(library.index_path)
+    release_sidecar(library.index_path)
+    release_pool(library.index_path)
+    _book_stats.pop(library.index_path, None)
+
+
+def get_live_feed():
+    manager = get_current_snapshot_manager()
+    return get_feed(manager, current_app.config["LIVE_POLL_INTERVAL"])
+
+
+def get_annotations_by_id(annotation_ids):
+    """The highlights with these ids that still exist, in the same order."""
+    snapshot = get_snapshot()
+    rows = (snapshot.row_of(annotation_id) for annotation_id in annotation_ids)
+    return hydrate(snapshot, [row for row in rows if row is not None])
+
+
+def get_related_annotations(annotation_id):
+    """The highlights from other books most like annotation_id, best first.
+    They are worked out in the background, so there are none for a
+    highlight until that has caught up with it."""
+    snapshot = get_snapshot()
+    related = get_related_index(get_sidecar(current_library().index_path))
+    related.refresh(snapshot.version)
+    with get_index_connection("get_related_annotations", sync=False) as conn:
+        annotation_ids = related.neighbours(conn, annotation_id)
+    return get_annotations_by_id(annotation_ids)[: current_app.config["RELATED_COUNT"]]
+
+
+def hydrate(snapshot, rows):
+    count_rows(len(rows))
+    states = get_annotation_states(snapshot.ids[row] for row in rows)
+    return [
+        {**snapshot.annotation(row), **states[snapshot.ids[row]]}
         for row in rows
     ]
 
-    filtered_annotations = filter_annotations(annotations, favorite_filter, read_filter)
 
+def get_random_annotations(favorite_filter=None, read_filter=None, resurface=False):
+    snapshot = get_snapshot()
+    sampler = get_sampler(get_state_store())
+    if resurface:
+        favorite_weight = current_app.config["RESURFACE_FAVORITE_WEIGHT"]
+        rows = sampler.resurface(snapshot, favorite_filter, read_filter, 3, favorite_weight=favorite_weight)
+    else:
+        rows = sampler.sample(snapshot, favorite_filter, read_filter, 3)
+
+    return hydrate(snapshot, rows)
+
+
+def get_next_review(include_new=False):
+    """The highlight to review next: the one due first, if it is due, or
+    else (with include_new) the first new one. next_due is when the first
+    scheduled highlight is due, and scheduled how many there are."""
+    snapshot = get_snapshot()
+    store = get_state_store()
+    queue = get_review_queue(store)
+    top = queue.next_due(snapshot)
+    annotation_id, new = None, False
+    if top is not None and top[0] <= datetime.now().timestamp():
+        annotation_id = top[1]
+    elif include_new:
+        annotation_id = queue.next_new(snapshot, store.entries())
+        new = annotation_id is not None
+
+    annotation = None
+    if annotation_id is not None:
+        annotation = hydrate(snapshot, [snapshot.row_of(annotation_id)])[0]
+        entry = store.get(annotation_id)
+        annotation.update({"due": entry.get("due"), "interval": entry.get("interval"), "ease": entry.get("ease")})
     return {
-        "book_title": rows[0]["title"],
-        "book_id": rows[0]["book_id"],
-        "annotations": filtered_annotations,
+        "annotation": annotation,
+        "new": new,
+        "next_due": top[0] if top else None,
+        "scheduled": len(queue),
     }
 
 
-def get_favorited_annotations():
+def pick_focused_annotation_id(book_id=None, resurface=False):
+    """The id of a random highlight for the focused view, of one book or of
+    all, or None if there is none."""
+    snapshot = get_snapshot()
+    if resurface:
+        favorite_weight = current_app.config["RESURFACE_FAVORITE_WEIGHT"]
+        rows = get_sampler(get_state_store()).resurface(
+            snapshot, k=1, book_id=book_id, favorite_weight=favorite_weight
+        )
+    else:
+        book_rows = snapshot.book_rows(book_id) if book_id else snapshot.recent_order
+        rows = [random.choice(book_rows)] if book_rows else []
+    return snapshot.ids[rows[0]] if rows else None
+
+
+def get_books_with_annotations():
+    return get_book_stats()["books"]
+
+
+# Per-book counts and latest highlight come from the index's book_stats,
+# which its triggers keep current during each sync. The result only changes
+# with the sync version, so it's cached per index until then.
+_book_stats = {}
+RECENT_BOOKS = 3
+
+
+def get_book_stats():
+    index_path = current_library().index_path
+    version = get_snapshot().version
+    cached = _book_stats.get(index_path)
+    if cached is not None and cached["version"] == version:
+        return cached
+
     query = """
-    SELECT a.id, JSON_EXTRACT(a.annot_data, '$.highlighted_text') as highlighted_text,
-           JSON_EXTRACT(a.annot_data, '$.notes') as notes,
-           JSON_EXTRACT(a.annot_data, '$.spine_index') as spine_index,
-           JSON_EXTRACT(a.annot_data, '$.start_cfi') as start_cfi,
-           JSON_EXTRACT(a.annot_data, '$.toc_family_titles') as chapter_array,
-           a.timestamp, b.id as book_id, b.title as book_title
-    FROM annotations a
-    JOIN books b ON a.book = b.id
-    WHERE JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-    ORDER BY b.title, a.timestamp;
+    SELECT book_id, title, annotation_count, latest_annotation
+    FROM book_stats
+    ORDER BY title, book_id;
     """
 
-    with get_db_connection() as conn:
+    with get_index_connection("get_book_stats") as conn:
         cur = conn.cursor()
         cur.execute(query)
         rows = cur.fetchall()
 
-    favorited_annotations = {}
-
+    books = []
+    recent = []
     for row in rows:
-        if is_favorite(row["id"]):
-            book_id = row["book_id"]
-            if book_id not in favorited_annotations:
-                favorited_annotations[book_id] = {
-                    "book_title": row["book_title"],
-                    "annotations": [],
-                }
-            favorited_annotations[book_id]["annotations"].append(
-                {
-                    "id": row["id"],
-                    "book_id": row["book_id"],
-                    "text": row["highlighted_text"],
-                    "notes": row["notes"],
-                    "spine_index": row["spine_index"],
-                    "start_cfi": row["start_cfi"],
-                    "timestamp": row["timestamp"],
-                    "is_favorite": True,
-                    "last_read": get_last_read(row["id"]),
-                    "chapter_name": chapter_array_to_str(row["chapter_array"]),
-                }
-            )
-
-    return favorited_annotations
-
-
-def get_all_annotations(favorite_filter=None, read_filter=None):
-    query = """
-    SELECT a.id, JSON_EXTRACT(a.annot_data, '$.highlighted_text') as highlighted_text,
-           JSON_EXTRACT(a.annot_data, '$.notes') as notes,
-           JSON_EXTRACT(a.annot_data, '$.spine_index') as spine_index,
-           JSON_EXTRACT(a.annot_data, '$.start_cfi') as start_cfi,
-           JSON_EXTRACT(a.annot_data, '$.toc_family_titles') as chapter_array,
-           a.timestamp, b.id as book_id, b.title as book_title
-    FROM annotations a
-    JOIN books b ON a.book = b.id
-    WHERE JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-    ORDER BY a.timestamp DESC, b.title;
+        books.append(
+            {
+                "book_id": row["book_id"],
+                "book_title": row["title"],
+                "annotation_count": row["annotation_count"],
+            }
+        )
+        heapq.heappush(recent, (row["latest_annotation"], row["book_id"], row["title"]))
+        if len(recent) > RECENT_BOOKS:
+            heapq.heappop(recent)
+
+    stats = _book_stats[index_path] = {
+        "version": version,
+        "books": books,
+        "recent_books": [
+            {
+                "book_id": book_id,
+                "book_title": title,
+                "latest_annotation": latest_annotation,
+            }
+            for latest_annotation, book_id, title in sorted(recent, reverse=True)
+        ],
+    }
+    return stats
+
+
+# Orders of the paged listings, as (column, row key) pairs. Each ends with
+# the annotation id so it is total, which keyset pagination needs.
+BOOK_ORDER = (("a.timestamp", "timestamp"), ("a.id", "id"))
+NOTES_ORDER = (("a.title", "book_title"), ("a.book_id", "book_id"), ("a.timestamp", "timestamp"), ("a.id", "id"))
+STREAM_BATCH = 200
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, order):
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if (
+        not isinstance(values, list)
+        or len(values) != len(order)
+        or not all(isinstance(value, (int, float, str)) for value in values)
+    ):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return values
+
+
+class AnnotationStream:
+    """The annotations matching where, in the given order, read from the index
+    STREAM_BATCH at a time so memory doesn't grow with the result.
+
+    Starts after the cursor after, if given, and stops after limit annotations.
+    Once iterated, next_cursor is where to continue from, or None if nothing
+    is left. connect(call_site) opens the index connections.
     """
 
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query)
-        rows = cur.fetchall()
+    def __init__(
+        self, where, params, order, favorite_filter=None, read_filter=None, after=None, limit=None, *,
+        call_site, connect=get_index_connection,
+    ):
+        self.call_site = call_site
+        self.connect = connect
+        self.params = params
+        self.order = order
+        self.after = None if after is None else decode_cursor(after, order)
+        self.limit = limit
+        self.next_cursor = None
+
+        join, state_where = state_filter_sql(favorite_filter, read_filter)
+        columns = ", ".join(column for column, _ in order)
+        query = f"""
+        SELECT {ANNOTATION_COLUMNS}
+        FROM annotations a
+        {join}
+        WHERE {where} AND {state_where} AND {{keyset}}
+        ORDER BY {columns}
+        LIMIT ?;
+        """
+        self._first_query = query.format(keyset="1")
+        self._next_query = query.format(keyset=f"({columns}) > ({', '.join('?' * len(order))})")
+
+    def __iter__(self):
+        after, remaining = self.after, self.limit
+        while True:
+            # One row past the limit tells whether there is a next page.
+            size = STREAM_BATCH if remaining is None else min(STREAM_BATCH, remaining + 1)
+            with self.connect(self.call_site) as conn:
+                if after is None:
+                    rows = conn.execute(self._first_query, (*self.params, size)).fetchall()
+                else:
+                    rows = conn.execute(self._next_query, (*self.params, *after, size)).fetchall()
+            more = len(rows) == size
+            count_rows(len(rows))
+            if remaining is not None:
+                rows = rows[:remaining]
+                remaining -= len(rows)
+
+            for row in rows:
+                yield annotation_from_row(row)
+
+            if not more:
+                return
+            after = [rows[-1][key] for _, key in self.order]
+            if remaining == 0:
+                self.next_cursor = encode_cursor(after)
+                return
+
+    def by_book(self):
+        """(book_id, {"book_title", "annotations"}) pairs, like group_by_book,
+        for an order that keeps each book's annotations together."""
+        for book_id, annotations in groupby(self, key=itemgetter("book_id")):
+            first = next(annotations)
+            yield book_id, {"book_title": first["book_title"], "annotations": chain([first], annotations)}
+
+
+def stream_book_annotations(book_id, favorite_filter=None, read_filter=None, after=None, limit=None):
+    with get_index_connection("stream_book_annotations") as conn:
+        book = conn.execute("SELECT title FROM annotations WHERE book_id = ? LIMIT 1", (book_id,)).fetchone()
+    if book is None:
+        return None
 
-    annotations = [
-        {
-            "id": row["id"],
-            "text": row["highlighted_text"],
-            "notes": row["notes"],
-            "spine_index": row["spine_index"],
-            "start_cfi": row["start_cfi"],
-            "timestamp": row["timestamp"],
-            "book_id": row["book_id"],
-            "book_title": row["book_title"],
-            "chapter_name": chapter_array_to_str(row["chapter_array"]),
-            "is_favorite": is_favorite(row["id"]),
-            "last_read": get_last_read(row["id"]),
-        }
-        for row in rows
-    ]
+    return {
+        "book_title": book["title"],
+        "book_id": book_id,
+        "annotations": AnnotationStream(
+            "a.book_id = ?", (book_id,), BOOK_ORDER, favorite_filter, read_filter, after, limit,
+            call_site="stream_book_annotations",
+        ),
+    }
 
-    return filter_annotations(annotations, favorite_filter, read_filter)
 
+def get_filtered_annotation_ids(book_id=None, favorite_filter=None, read_filter=None):
+    """Ids of the highlights, of one book or of all, that pass the filters."""
+    join, state_where = state_filter_sql(favorite_filter, read_filter)
+    where, params = ("a.book_id = ?", (book_id,)) if book_id is not None else ("1", ())
+    with get_index_connection("get_filtered_annotation_ids") as conn:
+        rows = conn.execute(f"SELECT a.id FROM annotations a {join} WHERE {where} AND {state_where}", params)
+        return [row[0] for row in rows]
 
-def get_recent_books():
-    query = """
-    WITH RankedBooks AS (
-        SELECT 
-            b.id AS book_id,
-            b.title AS book_title,
-            MAX(a.timestamp) AS latest_annotation,
-            ROW_NUMBER() OVER (ORDER BY MAX(a.timestamp) DESC) AS rank
-        FROM 
-            books b
-            JOIN annotations a ON b.id = a.book
-        WHERE 
-            JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-        GROUP BY 
-            b.id, b.title
+
+def get_book_annotations(book_id, favorite_filter=None, read_filter=None):
+    book_data = stream_book_annotations(book_id, favorite_filter, read_filter)
+    if book_data is not None:
+        book_data["annotations"] = list(book_data["annotations"])
+    return book_data
+
+
+def stream_export(book_id=None, since=None, until=None, favorites=False, notes=False, sync=True):
+    """Every annotation matching the export filters with its state, grouped by
+    book. since and until are timestamps; until is exclusive. Without sync,
+    the index is read as it is."""
+    conditions, params = [], []
+    for condition, value in (
+        ("a.book_id = ?", book_id),
+        ("a.timestamp >= ?", since),
+        ("a.timestamp < ?", until),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    if notes:
+        conditions.append("a.has_notes = 1")
+    # A single book is already together, and its own index keeps it in order.
+    order = BOOK_ORDER if book_id is not None else NOTES_ORDER
+    return AnnotationStream(
+        " AND ".join(conditions) or "1", tuple(params), order, True if favorites else None,
+        call_site="stream_export", connect=partial(get_index_connection, sync=sync),
     )
-    SELECT book_id, book_title, latest_annotation
-    FROM RankedBooks
-    WHERE rank <= 3
-    ORDER BY latest_annotation DESC;
+
+
+def get_favorited_annotations():
+    query = f"""
+    SELECT {ANNOTATION_COLUMNS}
+    FROM state.state s
+    JOIN annotations a ON a.id = s.id
+    WHERE s.favorite = 1
+    ORDER BY a.title, a.book_id, a.timestamp, a.id;
     """
 
-    with get_db_connection() as conn:
+    with get_index_connection("get_favorited_annotations") as conn:
         cur = conn.cursor()
         cur.execute(query)
         rows = cur.fetchall()
 
-    return [
-        {
-            "book_id": row["book_id"],
-            "book_title": row["book_title"],
-            "latest_annotation": row["latest_annotation"],
-        }
-        for row in rows
-    ]
+    count_rows(len(rows))
+    return group_by_book(annotation_from_row(row) for row in rows)
 
 
-def get_flashback_annotations():
-    years_ago = random.choice([1, 2, 3])
-    current_date = datetime.now()
-    target_date = current_date.replace(year=current_date.year - years_ago)
-    date_range = 10  # Days before and after the target date
+def get_focused_annotations(book_id=None, annotation_id=None, index=0):
+    """The annotation at index (or with annotation_id) of the focused view, and
+    its neighbours, without hydrating the rest of the library or book."""
+    snapshot = get_snapshot()
 
-    query = """
-    SELECT DISTINCT b.id as book_id, b.title as book_title, a.id as annotation_id,
-           JSON_EXTRACT(a.annot_data, '$.highlighted_text') as highlighted_text,
-           JSON_EXTRACT(a.annot_data, '$.notes') as notes,
-           JSON_EXTRACT(a.annot_data, '$.spine_index') as spine_index,
-           JSON_EXTRACT(a.annot_data, '$.start_cfi') as start_cfi,
-           JSON_EXTRACT(a.annot_data, '$.toc_family_titles') as chapter_array,
-           a.timestamp
-    FROM annotations a
-    JOIN books b ON a.book = b.id
-    WHERE JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-      AND a.timestamp BETWEEN ? AND ?
-    ORDER BY RANDOM()
-    LIMIT 1;
-    """
+    if book_id:
+        rows = snapshot.book_rows(book_id)
+        if rows is None:
+            return None
+        book_title = snapshot.book_titles[book_id]
+    else:
+        rows = snapshot.recent_order
+        book_title = "All Books"
 
-    start_date = target_date - timedelta(days=date_range)
-    end_date = target_date + timedelta(days=date_range)
+    total = len(rows)
+    if total == 0:
+        return None
 
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query, (start_date.timestamp(), end_date.timestamp()))
-        rows = cur.fetchall()
+    if annotation_id:
+        row = snapshot.row_of(annotation_id)
+        if row is None:
+            index = 0
+        elif book_id:
+            index = snapshot.book_position(row) if snapshot.book_ids[row] == book_id else 0
+        else:
+            index = snapshot.recent_position(row)
+    elif index < 0:
+        index = 0
+    elif index >= total:
+        index = total - 1
+
+    neighbours = [i for i in (index - 1, index, index + 1) if 0 <= i < total]
+    annotations = dict(zip(neighbours, hydrate(snapshot, [rows[i] for i in neighbours])))
 
-    flashback_books = []
-    for row in rows:
-        flashback_books.append(
-            {
-                "book_id": row["book_id"],
-                "book_title": row["book_title"],
-                "annotation_id": row["annotation_id"],
-                "text": row["highlighted_text"],
-                "notes": row["notes"],
-                "spine_index": row["spine_index"],
-                "start_cfi": row["start_cfi"],
-                "timestamp": row["timestamp"],
-                "chapter_name": chapter_array_to_str(row["chapter_array"]),
-                "is_favorite": is_favorite(row["annotation_id"]),
-                "last_read": get_last_read(row["annotation_id"]),
-            }
-        )
+    return {
+        "book_id": book_id,
+        "book_title": book_title,
+        "index": index,
+        "total": total,
+        "annotation": annotations[index],
+        "previous": annotations.get(index - 1),
+        "next": annotations.get(index + 1),
+    }
 
-    return {"years_ago": years_ago, "books": flashback_books}
 
+def get_recent_books():
+    return get_book_stats()["recent_books"]
 
-def get_highlights_with_notes(favorite_filter=None, read_filter=None):
-    query = """
-    SELECT a.id, JSON_EXTRACT(a.annot_data, '$.highlighted_text') as highlighted_text,
-           JSON_EXTRACT(a.annot_data, '$.notes') as notes,
-           JSON_EXTRACT(a.annot_data, '$.spine_index') as spine_index,
-           JSON_EXTRACT(a.annot_data, '$.start_cfi') as start_cfi,
-           JSON_EXTRACT(a.annot_data, '$.toc_family_titles') as chapter_array,
-           a.timestamp, b.id as book_id, b.title as book_title
-    FROM annotations a
-    JOIN books b ON a.book = b.id
-    WHERE JSON_EXTRACT(a.annot_data, '$.highlighted_text') != ''
-      AND JSON_EXTRACT(a.annot_data, '$.notes') != ''
-    ORDER BY b.title, a.timestamp;
+
+FLASHBACK_PER_YEAR = 20
+
+
+def get_flashback_annotations(days=None, per_year=1, today=None):
+    """Highlights made within days of today's date in earlier years, up to
+    per_year of them for each year, newest year first.
+
+    The picks are random but the same all day, so a day's flashback can be
+    cached like any other page.
     """
+    today = today or date.today()
+    if days is None:
+        days = current_app.config["FLASHBACK_DAYS"]
+    snapshot = get_snapshot()
+
+    years = {}
+    for year, rows in snapshot.calendar_rows(today.month, today.day, days):
+        if year < today.year:
+            years.setdefault(year, []).append(rows)
+
+    rnd = random.Random(today.toordinal())
+    picked = []
+    for year in sorted(years, reverse=True):
+        rows = list(chain.from_iterable(years[year]))
+        rows = rnd.sample(rows, min(per_year, len(rows)))
+        picked.append((today.year - year, sorted(rows, key=snapshot.timestamps.__getitem__)))
+
+    annotations = iter(hydrate(snapshot, [row for _, rows in picked for row in rows]))
+    return {
+        "days": days,
+        "years": [
+            {"years_ago": years_ago, "annotations": [next(annotations) for _ in rows]}
+            for years_ago, rows in picked
+        ],
+    }
 
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        cur.execute(query)
-        rows = cur.fetchall()
 
-    highlights_with_notes = {}
+def stream_highlights_with_notes(favorite_filter=None, read_filter=None, after=None, limit=None):
+    return AnnotationStream(
+        "a.has_notes = 1", (), NOTES_ORDER, favorite_filter, read_filter, after, limit,
+        call_site="stream_highlights_with_notes",
+    )
 
-    for row in rows:
-        annotation = {
-            "id": row["id"],
-            "book_id": row["book_id"],
-            "text": row["highlighted_text"],
-            "notes": row["notes"],
-            "spine_index": row["spine_index"],
-            "start_cfi": row["start_cfi"],
-            "timestamp": row["timestamp"],
-            "is_favorite": is_favorite(row["id"]),
-            "last_read": get_last_read(row["id"]),
-            "chapter_name": chapter_array_to_str(row["chapter_array"]),
-        }
-        
-        if filter_annotation(annotation, favorite_filter, read_filter):
-            book_id = row["book_id"]
-            if book_id not in highlights_with_notes:
-                highlights_with_notes[book_id] = {
-                    "book_title": row["book_title"],
-                    "annotations": [],
-                }
-            highlights_with_notes[book_id]["annotations"].append(annotation)
-
-    return highlights_with_notes
-
-
-def filter_annotations(annotations, favorite_filter, read_filter):
-    return [
-        annotation for annotation in annotations
-        if filter_annotation(annotation, favorite_filter, read_filter)
-    ]
 
+SEARCH_LIMIT = 50
+
+
+def search_annotations(text, favorite_filter=None, read_filter=None, limit=SEARCH_LIMIT, offset=0):
+    """Best matches for text in highlights, notes, chapter names and book
+    titles, with the matching words of the highlight and notes marked."""
+    query = fts_query(text)
+    if query is None:
+        return []
+
+    # Ranking only reads the full-text index; joining the annotations in
+    # before the LIMIT would look up every match instead of just the top
+    # ones. Snippets come back with the matches between \x02 and \x03, which
+    # are turned into <mark>s once the rest of the text is escaped.
+    join, where = "", "1"
+    if favorite_filter is not None or read_filter is not None:
+        join, where = state_filter_sql(favorite_filter, read_filter, "annotations_fts.rowid")
+    ranked = f"""
+    SELECT annotations_fts.rowid as id,
+           snippet(annotations_fts, 0, char(2), char(3), '…', 64) as text_snippet,
+           snippet(annotations_fts, 1, char(2), char(3), '…', 64) as notes_snippet
+    FROM annotations_fts
+    {join}
+    WHERE annotations_fts MATCH ? AND {where}
+    ORDER BY bm25(annotations_fts, 2.0, 2.0, 1.0, 1.0)
+    LIMIT ? OFFSET ?;
+    """
 
-def filter_annotation(annotation, favorite_filter, read_filter):
-    if favorite_filter is not None and annotation["is_favorite"] != favorite_filter:
-        return False
-    if read_filter is not None and is_read(annotation["id"]) != read_filter:
-        return False
-    return True
+    with get_index_connection("search_annotations") as conn:
+        try:
+            matches = conn.execute(ranked, (query, limit, offset)).fetchall()
+        except sqlite3.OperationalError:
+            # A query fts_query let through that FTS5 can't parse.
+            logging.getLogger(__name__).warning("Search for %r failed", query, exc_info=True)
+            return []
+        rows = conn.execute(
+            f"""
+            SELECT {ANNOTATION_COLUMNS}
+            FROM annotations a
+            LEFT JOIN state.state s ON s.id = a.id
+            WHERE a.id IN ({",".join("?" * len(matches))});
+            """,
+            [match["id"] for match in matches],
+        ).fetchall()
+
+    count_rows(len(rows))
+    rows = {row["id"]: row for row in rows}
+    annotations = []
+    for match in matches:
+        if match["id"] not in rows:
+            continue  # deleted by a sync between the two queries
+        annotation = annotation_from_row(rows[match["id"]])
+        for key in ("text_snippet", "notes_snippet"):
+            marked = str(escape(match[key] or "")).replace("\x02", "<mark>").replace("\x03", "</mark>")
+            annotation[key] = Markup(marked) if "<mark>" in marked else None
+        annotations.append(annotation)
+    return annotations
+
+
+def group_by_book(annotations):
+    books = {}
+    for annotation in annotations:
+        book_id = annotation["book_id"]
+        if book_id not in books:
+            books[book_id] = {
+                "book_title": annotation["book_title"],
+                "annotations": [],
+            }
+        books[book_id]["annotations"].append(annotation)
+    return books
@@ -0,0 +1,348 @@
+import heapq
+import logging
+import math
+import re
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process take turns
+    fcntl = None
+
+# Highlights are related by the cosine similarity of the TF-IDF vectors of
+# the words in their text and notes, and only to highlights in other books.
+# Each keeps this many neighbours, more than are shown so that a few being
+# deleted leaves enough.
+NEIGHBOURS = 8
+# Words in more than this share of highlights, or more than MAX_DF of them,
+# say little about what one is about and are left out like stop words.
+MAX_DF_SHARE = 0.05
+MAX_DF = 1000
+# A highlight is only compared through its QUERY_TERMS weightiest words, and
+# a word only reaches the POSTINGS_LIMIT highlights it weighs most in, so a
+# full build takes at most n * QUERY_TERMS * POSTINGS_LIMIT steps.
+QUERY_TERMS = 4
+POSTINGS_LIMIT = 64
+# A highlight updated on its own also becomes a neighbour of those of the
+# RECIPROCAL highlights most like it that it is closer to than one of their
+# own neighbours.
+RECIPROCAL = 32
+# Word frequencies drift as the library grows, so the neighbours are built
+# again from scratch once its size (or the number of highlights waiting to
+# be updated) is this share away from that of the last build.
+REBUILD_DRIFT = 0.1
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    """The words of text, split, lowercased and without accents the way the
+    full-text index's tokenizer does it."""
+    text = text.lower()
+    if not text.isascii():
+        text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    return _WORD.findall(text)
+
+
+def term_counts(text, notes):
+    counts = Counter(tokenize(text))
+    if notes:
+        counts.update(tokenize(notes))
+    return counts
+
+
+def max_df(size):
+    return max(2, min(size * MAX_DF_SHARE, MAX_DF))
+
+
+def pack(neighbours):
+    """(score, id) pairs, best first, as the neighbours and scores blobs of
+    the related table."""
+    return (
+        array("q", [annotation_id for _, annotation_id in neighbours]).tobytes(),
+        array("f", [score for score, _ in neighbours]).tobytes(),
+    )
+
+
+def unpack(ids, scores):
+    return list(zip(array("f", scores), array("q", ids)))
+
+
+def build_related(conn):
+    """Work out the neighbours of every highlight in the index from scratch."""
+    terms = {}
+    ids, books = array("q"), array("q")
+    # Each highlight's words and their counts, highlight after highlight,
+    # with highlight i's at starts[i]:starts[i + 1].
+    starts, words, counts = array("l", [0]), array("l"), array("l")
+    conn.execute("BEGIN")
+    try:
+        version = conn.execute("SELECT value FROM meta WHERE key = 'sync_version'").fetchone()[0]
+        for annotation_id, book_id, text, notes in conn.execute("SELECT id, book_id, text, notes FROM annotations"):
+            ids.append(annotation_id)
+            books.append(book_id)
+            for term, count in term_counts(text, notes).items():
+                words.append(terms.setdefault(term, len(terms)))
+                counts.append(count)
+            starts.append(len(words))
+    finally:
+        conn.execute("COMMIT")
+
+    size = len(ids)
+    df = array("l", bytes(array("l").itemsize * len(terms)))
+    for term in words:
+        df[term] += 1
+    limit = max_df(size)
+    idf = array("d", [math.log(size / n) if 2 <= n <= limit else 0.0 for n in df])
+
+    # Unit-length TF-IDF vectors, in the same layout, and an inverted index
+    # of the highlights each word weighs most in.
+    weights = array("d", bytes(8 * len(words)))
+    norms = array("d", bytes(8 * size))
+    postings = [array("l") for _ in range(len(terms))]
+    for doc in range(size):
+        total = 0.0
+        for i in range(starts[doc], starts[doc + 1]):
+            if idf[words[i]]:
+                weight = weights[i] = (1 + math.log(counts[i])) * idf[words[i]]
+                total += weight * weight
+                postings[words[i]].append(i)
+        norm = norms[doc] = math.sqrt(total)
+        for i in range(starts[doc], starts[doc + 1]):
+            weights[i] = weights[i] / norm if norm else 0.0
+    del counts, df
+
+    docs = array("l", bytes(array("l").itemsize * len(words)))
+    for doc in range(size):
+        for i in range(starts[doc], starts[doc + 1]):
+            docs[i] = doc
+    posting_starts, posting_docs, posting_weights = array("l", [0]), array("l"), array("d")
+    for entries in postings:
+        for i in heapq.nlargest(POSTINGS_LIMIT, entries, key=weights.__getitem__):
+            posting_docs.append(docs[i])
+            posting_weights.append(weights[i])
+        posting_starts.append(len(posting_docs))
+    del postings, docs
+
+    rows = []
+    for doc in range(size):
+        scores = {}
+        get = scores.get
+        query = heapq.nlargest(QUERY_TERMS, range(starts[doc], starts[doc + 1]), key=weights.__getitem__)
+        for i in query:
+            weight = weights[i]
+            if not weight:
+                break
+            start, end = posting_starts[words[i]], posting_starts[words[i] + 1]
+            for other, other_weight in zip(posting_docs[start:end], posting_weights[start:end]):
+                scores[other] = get(other, 0.0) + weight * other_weight
+        book_id = books[doc]
+        best = heapq.nlargest(
+            NEIGHBOURS, ((score, ids[other]) for other, score in scores.items() if books[other] != book_id)
+        )
+        rows.append((norms[doc], *pack(best), ids[doc]))
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM related")
+        # Only highlights that weren't deleted while this ran.
+        conn.executemany(
+            "INSERT INTO related (id, norm, neighbours, scores) SELECT id, ?, ?, ? FROM annotations WHERE id = ?",
+            rows,
+        )
+        # Highlights changed by syncs after the one read above stay queued.
+        conn.execute("DELETE FROM related_stale WHERE version < ?", (version,))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('related_size', ?)", (size,))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return size
+
+
+def find_neighbours(conn, book_id, text, notes, size, known):
+    """The norm of a highlight's vector and up to RECIPROCAL (score, id) of
+    the highlights in known ({id: (book_id, norm)}) most like it.
+
+    Rather than every highlight's words, this reads the full-text index's
+    list of highlights with each of its words, through annotations_vocab.
+    """
+    limit = max_df(size)
+    weights, postings = {}, {}
+    for term, count in term_counts(text, notes).items():
+        # At least as many highlights as have it in either column, and
+        # cheap to look up, unlike every occurrence of a common word.
+        least = conn.execute(
+            "SELECT MAX(doc) FROM annotations_vocab_columns WHERE term = ? AND col IN ('text', 'notes')", (term,)
+        ).fetchone()[0]
+        if least is None or least > limit:
+            continue
+        found = conn.execute(
+            """
+            SELECT doc, COUNT(*) FROM annotations_vocab
+            WHERE term = ? AND col IN ('text', 'notes')
+            GROUP BY doc
+            """,
+            (term,),
+        ).fetchall()
+        if 2 <= len(found) <= limit:
+            idf = math.log(size / len(found))
+            weights[term] = (1 + math.log(count)) * idf
+            postings[term] = (idf, found)
+
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    scores = {}
+    for term in heapq.nlargest(QUERY_TERMS, weights, key=weights.get):
+        idf, found = postings[term]
+        weight = weights[term] / norm
+        for other, count in found:
+            other_book, other_norm = known.get(other, (book_id, 0.0))
+            if other_book != book_id and other_norm:
+                scores[other] = scores.get(other, 0.0) + weight * (1 + math.log(count)) * idf / other_norm
+    return norm, heapq.nlargest(RECIPROCAL, ((score, other) for other, score in scores.items()))
+
+
+def update_related(conn):
+    """Bring the related table up to date: rebuild it if it was never built
+    or is too far out of date, otherwise work out the neighbours of just
+    the highlights added or edited since, one by one."""
+    size = conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+    built = conn.execute("SELECT value FROM meta WHERE key = 'related_size'").fetchone()
+    stale = conn.execute(
+        """
+        SELECT s.id, s.version, a.book_id, a.text, a.notes
+        FROM related_stale s
+        JOIN annotations a ON a.id = s.id
+        """
+    ).fetchall()
+    if built is None or abs(size - built[0]) > REBUILD_DRIFT * built[0] or len(stale) > REBUILD_DRIFT * size:
+        return build_related(conn)
+    if not stale:
+        return 0
+
+    known = {
+        annotation_id: (book_id, norm)
+        for annotation_id, book_id, norm in conn.execute(
+            "SELECT r.id, a.book_id, r.norm FROM related r JOIN annotations a ON a.id = r.id"
+        )
+    }
+    for annotation_id, version, book_id, text, notes in stale:
+        known.pop(annotation_id, None)
+        norm, similar = find_neighbours(conn, book_id, text, notes, size, known)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(
+                """
+                INSERT OR REPLACE INTO related (id, norm, neighbours, scores)
+                SELECT id, ?, ?, ? FROM annotations WHERE id = ?
+                """,
+                (norm, *pack(similar[:NEIGHBOURS]), annotation_id),
+            )
+            if cursor.rowcount:
+                for score, other in similar:
+                    row = conn.execute("SELECT neighbours, scores FROM related WHERE id = ?", (other,)).fetchone()
+                    if row is None:
+                        continue
+                    neighbours = [n for n in unpack(*row) if n[1] != annotation_id]
+                    if len(neighbours) == NEIGHBOURS and score <= neighbours[-1][0]:
+                        continue
+                    neighbours = sorted(neighbours + [(score, annotation_id)], reverse=True)[:NEIGHBOURS]
+                    conn.execute(
+                        "UPDATE related SET neighbours = ?, scores = ? WHERE id = ?", (*pack(neighbours), other)
+                    )
+            # Unless it changed again in the meantime.
+            conn.execute("DELETE FROM related_stale WHERE id = ? AND version = ?", (annotation_id, version))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        known[annotation_id] = (book_id, norm)
+    return len(stale)
+
+
+@contextmanager
+def _exclusive(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RelatedIndex:
+    """Keeps the related table of a sidecar index up to date from a
+    background thread. Processes take turns through a lock file next to the
+    index, so only one works on the table at a time."""
+
+    def __init__(self, sidecar):
+        self.sidecar = sidecar
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._thread = None
+        self._version = None
+        self._stopped = False
+
+    def refresh(self, version):
+        """Start bringing the table up to date with sync version version,
+        unless that is done or under way."""
+        with self._lock:
+            if self._stopped or self._version == version or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._version = version
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self.update()
+        except Exception:
+            logging.getLogger(__name__).exception("Updating related highlights in %s failed", self.sidecar.path)
+            with self._lock:
+                self._version = None
+
+    def stop(self):
+        """Wait for an update under way, for an index that is no longer
+        used."""
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def update(self):
+        with self._file_lock, _exclusive(f"{self.sidecar.path}.related.lock"):
+            with self.sidecar.connect() as conn:
+                return update_related(conn)
+
+    @staticmethod
+    def neighbours(conn, annotation_id):
+        """Ids of the highlights most like annotation_id, most alike first."""
+        row = conn.execute("SELECT neighbours FROM related WHERE id = ?", (annotation_id,)).fetchone()
+        return [] if row is None else list(array("q", row[0]))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_related_index(sidecar):
+    with _indexes_lock:
+        index = _indexes.get(sidecar.path)
+        if index is None:
+            index = _indexes[sidecar.path] = RelatedIndex(sidecar)
+    return index
+
+
+def release_related_index(path):
+    with _indexes_lock:
+        index = _indexes.pop(path, None)
+    if index is not None:
+        index.stop()
@@ -0,0 +1,179 @@
+import threading
+
+# Spaced repetition, scheduled the SM-2 way (as Anki does). A highlight's
+# state entry gets "due" (a timestamp), "interval" (days) and "ease" once it
+# is first graded; until then it is new.
+GRADES = ("again", "hard", "good", "easy")
+DAY = 24 * 60 * 60
+# A highlight graded "again" comes back this many seconds later.
+RELEARN_DELAY = 10 * 60
+INITIAL_EASE = 2.5
+MIN_EASE = 1.3
+# Days until the second review, by the grade of the first.
+FIRST_INTERVALS = {"hard": 1, "good": 1, "easy": 4}
+
+
+def schedule(entry, grade, now):
+    """The due, interval and ease of a highlight with state entry, graded
+    grade at time now."""
+    ease = entry.get("ease", INITIAL_EASE)
+    interval = entry.get("interval")
+    if grade == "again":
+        ease -= 0.2
+        interval = 0
+    elif not interval:
+        interval = FIRST_INTERVALS[grade]
+    elif grade == "hard":
+        ease -= 0.15
+        interval *= 1.2
+    elif grade == "good":
+        interval *= ease
+    else:
+        ease += 0.15
+        interval *= ease * 1.3
+    due = now + (interval * DAY if interval else RELEARN_DELAY)
+    return {"due": due, "interval": round(interval, 2), "ease": round(max(ease, MIN_EASE), 2)}
+
+
+class DueHeap:
+    """A min-heap of (due, annotation_id) that knows where each id is, so an
+    id can be moved or removed in place in O(log n)."""
+
+    def __init__(self, items=()):
+        self._heap = list(items)
+        self._positions = {annotation_id: i for i, (_, annotation_id) in enumerate(self._heap)}
+        for i in reversed(range(len(self._heap) // 2)):
+            self._sift_down(i)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def peek(self):
+        return self._heap[0] if self._heap else None
+
+    def set(self, annotation_id, due):
+        i = self._positions.get(annotation_id)
+        if i is None:
+            self._heap.append((due, annotation_id))
+            self._positions[annotation_id] = len(self._heap) - 1
+            self._sift_up(len(self._heap) - 1)
+            return
+        self._heap[i] = (due, annotation_id)
+        self._sift_up(i)
+        self._sift_down(self._positions[annotation_id])
+
+    def remove(self, annotation_id):
+        i = self._positions.pop(annotation_id, None)
+        if i is None:
+            return
+        last = self._heap.pop()
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._positions[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self._positions[last[1]])
+
+    def _move(self, item, i):
+        self._heap[i] = item
+        self._positions[item[1]] = i
+
+    def _sift_up(self, i):
+        item = self._heap[i]
+        while i > 0:
+            parent = (i - 1) // 2
+            if self._heap[parent] <= item:
+                break
+            self._move(self._heap[parent], i)
+            i = parent
+        self._move(item, i)
+
+    def _sift_down(self, i):
+        item = self._heap[i]
+        size = len(self._heap)
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            if child + 1 < size and self._heap[child + 1] < self._heap[child]:
+                child += 1
+            if item <= self._heap[child]:
+                break
+            self._move(self._heap[child], i)
+            i = child
+        self._move(item, i)
+
+
+class ReviewQueue:
+    """The highlights being reviewed, by due time, kept in step with a
+    StateStore like RandomSampler is. New highlights are taken in book
+    order."""
+
+    def __init__(self, store):
+        self._lock = threading.Lock()
+        self._new_snapshot = None
+        self._new_position = 0
+        with store.locked() as entries:
+            self._load(entries)
+            store.subscribe(self._on_state_change)
+
+    def _load(self, entries):
+        self._heap = DueHeap(
+            (entry["due"], int(annotation_id))
+            for annotation_id, entry in entries.items()
+            if entry.get("due") is not None
+        )
+
+    def _on_state_change(self, changes, entries):
+        with self._lock:
+            if changes is None:
+                self._load(entries)
+                return
+            for annotation_id, entry in changes.items():
+                if entry.get("due") is None:
+                    self._heap.remove(int(annotation_id))
+                else:
+                    self._heap.set(int(annotation_id), entry["due"])
+
+    def __len__(self):
+        return len(self._heap)
+
+    def next_due(self, snapshot):
+        """(due, annotation_id) of the highlight due first, or None."""
+        with self._lock:
+            while True:
+                top = self._heap.peek()
+                if top is None or snapshot.row_of(top[1]) is not None:
+                    return top
+                # Deleted from Calibre since it was reviewed.
+                self._heap.remove(top[1])
+
+    def next_new(self, snapshot, entries):
+        """The id of the first highlight in book order that was never
+        reviewed, or None. Highlights only stop being new, so the search
+        carries on from where the last one ended."""
+        with self._lock:
+            if self._new_snapshot is not snapshot:
+                self._new_snapshot, self._new_position = snapshot, 0
+            while self._new_position < len(snapshot):
+                annotation_id = snapshot.ids[snapshot.book_order[self._new_position]]
+                if entries.get(str(annotation_id), {}).get("due") is None:
+                    return annotation_id
+                self._new_position += 1
+            return None
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_review_queue(store):
+    with _queues_lock:
+        queue = _queues.get(store.snapshot_file)
+        if queue is None:
+            queue = _queues[store.snapshot_file] = ReviewQueue(store)
+    return queue
+
+
+def release_review_queue(snapshot_file):
+    with _queues_lock:
+        _queues.pop(snapshot_file, None)
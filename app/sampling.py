@@ -0,0 +1,284 @@
+import random
+import threading
+import time
+from array import array
+
+# Resurfacing weighs each highlight by the time since it was last read (or
+# made, if it never was), plus this many seconds so that one read just now
+# can still come up.
+RESURFACE_FLOOR = 24 * 60 * 60
+
+
+def state_code(entry):
+    return 2 * bool(entry.get("favorite", False)) + bool(entry.get("last_read"))
+
+
+def matching_codes(favorite_filter, read_filter):
+    return [
+        2 * favorite + read
+        for favorite in (False, True)
+        for read in (False, True)
+        if favorite_filter in (None, favorite) and read_filter in (None, read)
+    ]
+
+
+class StateBuckets:
+    """Snapshot rows split by (favorite, read) state.
+
+    Every row sits in exactly one of four buckets, at buckets[code][positions[row]],
+    so moving a row when its state changes is an O(1) swap-remove and append.
+    """
+
+    def __init__(self, snapshot, entries):
+        self.snapshot = snapshot
+        self.codes = bytearray(len(snapshot))
+        self.positions = array("l", bytes(array("l").itemsize * len(snapshot)))
+        self.buckets = [array("l") for _ in range(4)]
+        for row, annotation_id in enumerate(snapshot.ids):
+            entry = entries.get(str(annotation_id))
+            code = state_code(entry) if entry else 0
+            self.codes[row] = code
+            self.positions[row] = len(self.buckets[code])
+            self.buckets[code].append(row)
+
+    def update(self, annotation_id, entry):
+        row = self.snapshot.row_of(int(annotation_id))
+        if row is None:
+            return
+        code = state_code(entry)
+        old_code = self.codes[row]
+        if code == old_code:
+            return
+        bucket = self.buckets[old_code]
+        last = bucket.pop()
+        if last != row:
+            bucket[self.positions[row]] = last
+            self.positions[last] = self.positions[row]
+        self.codes[row] = code
+        self.positions[row] = len(self.buckets[code])
+        self.buckets[code].append(row)
+
+    def sample(self, favorite_filter, read_filter, k):
+        buckets = [self.buckets[code] for code in matching_codes(favorite_filter, read_filter)]
+        # Pick k distinct positions in the concatenation of the matching
+        # buckets, which is uniform over every row that matches the filters.
+        total = sum(len(bucket) for bucket in buckets)
+        rows = []
+        for position in random.sample(range(total), min(k, total)):
+            for bucket in buckets:
+                if position < len(bucket):
+                    rows.append(bucket[position])
+                    break
+                position -= len(bucket)
+        return rows
+
+
+class LinearFenwickTree:
+    """A Fenwick tree over positions 0..size-1 whose weights are linear in
+    time: slope * now - offset. It keeps sums of both parts, so the total
+    weight of any prefix at any time takes O(log n), as do updates and
+    finding where a running total is reached."""
+
+    def __init__(self, size):
+        self.slopes = array("d", bytes(8 * (size + 1)))
+        self.offsets = array("d", bytes(8 * (size + 1)))
+
+    def finish(self):
+        """Turn the slopes and offsets set position by position (at index
+        position + 1) into the tree, in O(n)."""
+        size = len(self.slopes)
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                self.slopes[parent] += self.slopes[i]
+                self.offsets[parent] += self.offsets[i]
+
+    def add(self, position, slope, offset):
+        i = position + 1
+        while i < len(self.slopes):
+            self.slopes[i] += slope
+            self.offsets[i] += offset
+            i += i & -i
+
+    def sums(self, end):
+        """Sums of the slopes and offsets of positions before end."""
+        slope = offset = 0.0
+        while end > 0:
+            slope += self.slopes[end]
+            offset += self.offsets[end]
+            end -= end & -end
+        return slope, offset
+
+    def weight(self, start, end, now):
+        start_slope, start_offset = self.sums(start)
+        end_slope, end_offset = self.sums(end)
+        return (end_slope - start_slope) * now - (end_offset - start_offset)
+
+    def search(self, target, now):
+        """The first position at which the running weight from position 0
+        exceeds target."""
+        position, step = 0, 1 << (len(self.slopes) - 1).bit_length()
+        while step:
+            i = position + step
+            if i < len(self.slopes):
+                weight = self.slopes[i] * now - self.offsets[i]
+                if weight <= target:
+                    target -= weight
+                    position = i
+            step >>= 1
+        return position
+
+
+class ResurfacingWeights:
+    """Weights that favour highlights left unread for long, over snapshot
+    rows in book order, so a book's rows are a contiguous range.
+
+    There is a tree per (favorite, read) state, as in StateBuckets, and a
+    row only has weight in the tree of its state.
+    """
+
+    def __init__(self, snapshot, entries, favorite_weight):
+        self.snapshot = snapshot
+        self.favorite_weight = favorite_weight
+        self.codes = bytearray(len(snapshot))
+        self.trees = [LinearFenwickTree(len(snapshot)) for _ in range(4)]
+        now = time.time()
+        for position, row in enumerate(snapshot.book_order):
+            entry = entries.get(str(snapshot.ids[row])) or {}
+            code = self.codes[position] = state_code(entry) if entry else 0
+            slope, offset = self._weight(row, entry, now)
+            self.trees[code].slopes[position + 1] = slope
+            self.trees[code].offsets[position + 1] = offset
+        for tree in self.trees:
+            tree.finish()
+
+    def _weight(self, row, entry, now):
+        # Capped at now, so that no weight goes negative as time moves on.
+        since = min(entry.get("last_read") or self.snapshot.timestamps[row], now)
+        slope = self.favorite_weight if entry.get("favorite") else 1.0
+        return slope, slope * (since - RESURFACE_FLOOR)
+
+    def _point(self, tree, position):
+        end_slope, end_offset = tree.sums(position + 1)
+        start_slope, start_offset = tree.sums(position)
+        return end_slope - start_slope, end_offset - start_offset
+
+    def update(self, annotation_id, entry):
+        row = self.snapshot.row_of(int(annotation_id))
+        if row is None:
+            return
+        position = self.snapshot.book_ranges[self.snapshot.book_ids[row]][0] + self.snapshot.book_position(row)
+        tree = self.trees[self.codes[position]]
+        slope, offset = self._point(tree, position)
+        tree.add(position, -slope, -offset)
+        code = self.codes[position] = state_code(entry)
+        self.trees[code].add(position, *self._weight(row, entry, time.time()))
+
+    def sample(self, codes, k, start, end):
+        """Up to k distinct rows from positions start..end-1 in the trees of
+        codes, each picked with probability proportional to its weight."""
+        now = time.time()
+        trees = [self.trees[code] for code in codes]
+        rows, taken = [], []
+        attempts = 0
+        while len(rows) < k and attempts < 4 * k:
+            attempts += 1
+            weights = [tree.weight(start, end, now) for tree in trees]
+            total = sum(weights)
+            if total <= 0:
+                break
+            target = random.random() * total
+            for tree, weight in zip(trees, weights):
+                if target < weight:
+                    break
+                target -= weight
+            position = tree.search(tree.weight(0, start, now) + target, now)
+            # Rounding can land next to the range or on a row without weight.
+            if not start <= position < end:
+                continue
+            slope, offset = self._point(tree, position)
+            if slope * now - offset <= 0:
+                continue
+            # Taken out until the others are picked, so rows are distinct.
+            tree.add(position, -slope, -offset)
+            taken.append((tree, position, slope, offset))
+            rows.append(self.snapshot.book_order[position])
+        for tree, position, slope, offset in taken:
+            tree.add(position, slope, offset)
+        return rows
+
+
+class RandomSampler:
+    """Keeps StateBuckets for the current snapshot in step with a StateStore."""
+
+    def __init__(self, store):
+        self.store = store
+        self._buckets = None
+        self._weights = None
+        self._lock = threading.Lock()
+        store.subscribe(self._on_state_change)
+
+    def _on_state_change(self, changes, entries):
+        with self._lock:
+            if changes is None:
+                self._buckets = None
+                self._weights = None
+                return
+            for annotation_id, entry in changes.items():
+                if self._buckets is not None:
+                    self._buckets.update(annotation_id, entry)
+                if self._weights is not None:
+                    self._weights.update(annotation_id, entry)
+
+    def sample(self, snapshot, favorite_filter=None, read_filter=None, k=3):
+        self.store.refresh()
+        with self._lock:
+            if self._buckets is not None and self._buckets.snapshot is snapshot:
+                return self._buckets.sample(favorite_filter, read_filter, k)
+        # Lock order is store, then sampler, same as in _on_state_change.
+        with self.store.locked() as entries:
+            with self._lock:
+                if self._buckets is None or self._buckets.snapshot is not snapshot:
+                    self._buckets = StateBuckets(snapshot, entries)
+                return self._buckets.sample(favorite_filter, read_filter, k)
+
+    def resurface(self, snapshot, favorite_filter=None, read_filter=None, k=3, book_id=None, favorite_weight=1.0):
+        """Like sample, but favouring highlights left unread for long, and
+        optionally only from one book."""
+        codes = matching_codes(favorite_filter, read_filter)
+        if book_id is None:
+            start, end = 0, len(snapshot)
+        elif book_id in snapshot.book_ranges:
+            start, end = snapshot.book_ranges[book_id]
+        else:
+            return []
+
+        def current(weights):
+            return weights is not None and weights.snapshot is snapshot and weights.favorite_weight == favorite_weight
+
+        self.store.refresh()
+        with self._lock:
+            if current(self._weights):
+                return self._weights.sample(codes, k, start, end)
+        with self.store.locked() as entries:
+            with self._lock:
+                if not current(self._weights):
+                    self._weights = ResurfacingWeights(snapshot, entries, favorite_weight)
+                return self._weights.sample(codes, k, start, end)
+
+
+_samplers = {}
+_samplers_lock = threading.Lock()
+
+
+def get_sampler(store):
+    with _samplers_lock:
+        sampler = _samplers.get(store.snapshot_file)
+        if sampler is None:
+            sampler = _samplers[store.snapshot_file] = RandomSampler(store)
+    return sampler
+
+
+def release_sampler(snapshot_file):
+    with _samplers_lock:
+        _samplers.pop(snapshot_file, None)
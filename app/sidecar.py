@@ -0,0 +1,312 @@
+import sqlite3
+import threading
+
+from app.db import get_pool, release_pool
+from app.utils import chapter_array_to_str
+
+
+# Calibre's metadata.db is opened read-only, so Capsule keeps its own copy of
+# the highlight data with the annot_data JSON extracted into real, indexed
+# columns. It is derived data: deleting the file just causes a full re-sync.
+SCHEMA_VERSION = 7
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+-- (id, timestamp) of every row in Calibre's annotations table, highlights
+-- or not, to tell which rows were added, edited or deleted since last sync.
+CREATE TABLE source_rows (id INTEGER PRIMARY KEY, timestamp REAL NOT NULL);
+CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT NOT NULL);
+CREATE TABLE annotations (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    text TEXT NOT NULL,
+    notes TEXT,
+    spine_index INTEGER,
+    start_cfi TEXT,
+    chapter TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    has_notes INTEGER NOT NULL
+);
+CREATE INDEX annotations_book ON annotations (book_id, timestamp);
+CREATE INDEX annotations_timestamp ON annotations (timestamp);
+CREATE INDEX annotations_notes ON annotations (has_notes, title, book_id, timestamp);
+CREATE INDEX annotations_title ON annotations (title, book_id, timestamp);
+-- Per-book aggregates for /books, kept current by the triggers below so a
+-- sync only touches the books whose highlights changed.
+CREATE TABLE book_stats (
+    book_id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    annotation_count INTEGER NOT NULL,
+    latest_annotation REAL NOT NULL
+);
+CREATE TRIGGER annotations_insert AFTER INSERT ON annotations BEGIN
+    INSERT INTO book_stats (book_id, title, annotation_count, latest_annotation)
+    VALUES (new.book_id, new.title, 1, new.timestamp)
+    ON CONFLICT (book_id) DO UPDATE SET
+        title = new.title,
+        annotation_count = annotation_count + 1,
+        latest_annotation = MAX(latest_annotation, new.timestamp);
+END;
+CREATE TRIGGER annotations_delete AFTER DELETE ON annotations BEGIN
+    UPDATE book_stats SET
+        annotation_count = annotation_count - 1,
+        latest_annotation = COALESCE(
+            (SELECT MAX(timestamp) FROM annotations WHERE book_id = old.book_id), 0
+        )
+    WHERE book_id = old.book_id;
+    DELETE FROM book_stats WHERE book_id = old.book_id AND annotation_count = 0;
+END;
+CREATE TRIGGER annotations_update AFTER UPDATE OF book_id, title, timestamp ON annotations BEGIN
+    UPDATE book_stats SET
+        annotation_count = annotation_count - 1,
+        latest_annotation = COALESCE(
+            (SELECT MAX(timestamp) FROM annotations WHERE book_id = old.book_id), 0
+        )
+    WHERE book_id = old.book_id;
+    DELETE FROM book_stats WHERE book_id = old.book_id AND annotation_count = 0;
+    INSERT INTO book_stats (book_id, title, annotation_count, latest_annotation)
+    VALUES (new.book_id, new.title, 1, new.timestamp)
+    ON CONFLICT (book_id) DO UPDATE SET
+        title = new.title,
+        annotation_count = annotation_count + 1,
+        latest_annotation = MAX(latest_annotation, new.timestamp);
+END;
+-- Full-text index over the annotations table, which it reads its content
+-- from; the triggers keep it current as syncs change rows.
+CREATE VIRTUAL TABLE annotations_fts USING fts5(
+    text, notes, chapter, title,
+    content = 'annotations', content_rowid = 'id',
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+);
+CREATE TRIGGER annotations_fts_insert AFTER INSERT ON annotations BEGIN
+    INSERT INTO annotations_fts (rowid, text, notes, chapter, title)
+    VALUES (new.id, new.text, new.notes, new.chapter, new.title);
+END;
+CREATE TRIGGER annotations_fts_delete AFTER DELETE ON annotations BEGIN
+    INSERT INTO annotations_fts (annotations_fts, rowid, text, notes, chapter, title)
+    VALUES ('delete', old.id, old.text, old.notes, old.chapter, old.title);
+END;
+CREATE TRIGGER annotations_fts_update AFTER UPDATE OF text, notes, chapter, title ON annotations BEGIN
+    INSERT INTO annotations_fts (annotations_fts, rowid, text, notes, chapter, title)
+    VALUES ('delete', old.id, old.text, old.notes, old.chapter, old.title);
+    INSERT INTO annotations_fts (rowid, text, notes, chapter, title)
+    VALUES (new.id, new.text, new.notes, new.chapter, new.title);
+END;
+-- The full-text index's words, by the highlights and columns they occur in
+-- (see app.related).
+CREATE VIRTUAL TABLE annotations_vocab USING fts5vocab(annotations_fts, instance);
+CREATE VIRTUAL TABLE annotations_vocab_columns USING fts5vocab(annotations_fts, col);
+-- Each highlight's most similar highlights in other books, as packed arrays
+-- of ids and scores, and the norm of its TF-IDF vector. Worked out in the
+-- background by app.related, which related_stale queues highlights for when
+-- they are added or edited, with the sync version they changed in.
+CREATE TABLE related (
+    id INTEGER PRIMARY KEY,
+    norm REAL NOT NULL,
+    neighbours BLOB NOT NULL,
+    scores BLOB NOT NULL
+);
+CREATE TABLE related_stale (id INTEGER PRIMARY KEY, version INTEGER NOT NULL);
+-- Upserts rather than INSERT OR REPLACE, which the ON CONFLICT clause of the
+-- sync's own upsert into annotations would override.
+CREATE TRIGGER related_insert AFTER INSERT ON annotations BEGIN
+    INSERT INTO related_stale (id, version)
+    VALUES (new.id, (SELECT value FROM meta WHERE key = 'sync_version'))
+    ON CONFLICT (id) DO UPDATE SET version = excluded.version;
+END;
+CREATE TRIGGER related_update AFTER UPDATE OF book_id, text, notes ON annotations BEGIN
+    INSERT INTO related_stale (id, version)
+    VALUES (new.id, (SELECT value FROM meta WHERE key = 'sync_version'))
+    ON CONFLICT (id) DO UPDATE SET version = excluded.version;
+END;
+CREATE TRIGGER related_delete AFTER DELETE ON annotations BEGIN
+    DELETE FROM related WHERE id = old.id;
+    DELETE FROM related_stale WHERE id = old.id;
+END;
+INSERT INTO meta (key, value) VALUES ('sync_version', 0);
+"""
+
+SOURCE_QUERY = """
+SELECT a.id, a.book, a.timestamp,
+       JSON_EXTRACT(a.annot_data, '$.highlighted_text') as highlighted_text,
+       JSON_EXTRACT(a.annot_data, '$.notes') as notes,
+       JSON_EXTRACT(a.annot_data, '$.spine_index') as spine_index,
+       JSON_EXTRACT(a.annot_data, '$.start_cfi') as start_cfi,
+       JSON_EXTRACT(a.annot_data, '$.toc_family_titles') as chapter_array
+FROM annotations a
+WHERE a.id IN ({});
+"""
+
+# Stay well below SQLite's limit on bound parameters.
+CHUNK_SIZE = 500
+
+
+class Sidecar:
+    def __init__(self, path):
+        self.path = path
+        # Queries attach the state database to the connections of pool.
+        # connect() hands out connections without it for syncing and other
+        # writes, since a write transaction locks every attached database
+        # and would hold up state changes until it commits.
+        self.pool = get_pool(path, readonly=False, isolation_level=None)
+        self._write_pool = get_pool(path, key=f"{path}#write", readonly=False, isolation_level=None)
+        with self.connect() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._create(conn)
+
+    def connect(self):
+        return self._write_pool.connection()
+
+    @staticmethod
+    def _create(conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tables = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+            # Dropping an FTS table drops its shadow tables with it.
+            for table in tables:
+                conn.execute(f"DROP TABLE IF EXISTS {table['name']}")
+            statement = ""
+            for line in SCHEMA.splitlines(keepends=True):
+                statement += line
+                if sqlite3.complete_statement(statement):
+                    conn.execute(statement)
+                    statement = ""
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def sync_version(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE key = 'sync_version'").fetchone()[0]
+
+    def sync(self, calibre):
+        """Bring the sidecar up to date with Calibre's database.
+
+        Only rows whose id is new or whose timestamp changed are read (and
+        their JSON parsed); rows gone from Calibre are deleted. Returns the
+        ids of highlights that were added, changed and deleted, or None if
+        nothing changed.
+        """
+        source = dict(calibre.execute("SELECT id, timestamp FROM annotations"))
+        titles = dict(calibre.execute("SELECT id, title FROM books"))
+
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                delta = self._apply(conn, calibre, source, titles)
+                if delta is None:
+                    conn.execute("ROLLBACK")
+                else:
+                    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'sync_version'")
+                    conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return delta
+
+    def _apply(self, conn, calibre, source, titles):
+        known = dict(conn.execute("SELECT id, timestamp FROM source_rows"))
+        updated = [i for i, timestamp in source.items() if known.get(i) != timestamp]
+        removed = [i for i in known if i not in source]
+
+        renamed = [
+            (titles[book_id], book_id)
+            for book_id, title in conn.execute("SELECT id, title FROM books")
+            if book_id in titles and titles[book_id] != title
+        ]
+        if not updated and not removed and not renamed:
+            return None
+
+        highlights = {row[0] for row in conn.execute("SELECT id FROM annotations")}
+        delta = {"added": [], "changed": [], "deleted": []}
+
+        for start in range(0, len(updated), CHUNK_SIZE):
+            chunk = updated[start:start + CHUNK_SIZE]
+            rows = calibre.execute(SOURCE_QUERY.format(",".join("?" * len(chunk))), chunk)
+            for row in rows:
+                annotation_id = row["id"]
+                conn.execute(
+                    "INSERT OR REPLACE INTO source_rows (id, timestamp) VALUES (?, ?)",
+                    (annotation_id, row["timestamp"]),
+                )
+                # Same rows the old JOIN ... WHERE highlighted_text != '' kept.
+                if not row["highlighted_text"] or row["book"] not in titles:
+                    if annotation_id in highlights:
+                        conn.execute("DELETE FROM annotations WHERE id = ?", (annotation_id,))
+                        delta["deleted"].append(annotation_id)
+                    continue
+                conn.execute(
+                    "INSERT OR IGNORE INTO books (id, title) VALUES (?, ?)",
+                    (row["book"], titles[row["book"]]),
+                )
+                # An upsert rather than INSERT OR REPLACE, so the update
+                # trigger fires instead of a silent delete.
+                conn.execute(
+                    """
+                    INSERT INTO annotations
+                        (id, book_id, title, text, notes, spine_index, start_cfi, chapter, timestamp, has_notes)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        book_id = excluded.book_id,
+                        title = excluded.title,
+                        text = excluded.text,
+                        notes = excluded.notes,
+                        spine_index = excluded.spine_index,
+                        start_cfi = excluded.start_cfi,
+                        chapter = excluded.chapter,
+                        timestamp = excluded.timestamp,
+                        has_notes = excluded.has_notes
+                    """,
+                    (
+                        annotation_id,
+                        row["book"],
+                        titles[row["book"]],
+                        row["highlighted_text"],
+                        row["notes"],
+                        row["spine_index"],
+                        row["start_cfi"],
+                        chapter_array_to_str(row["chapter_array"]),
+                        row["timestamp"],
+                        bool(row["notes"]),
+                    ),
+                )
+                delta["changed" if annotation_id in highlights else "added"].append(annotation_id)
+
+        for annotation_id in removed:
+            conn.execute("DELETE FROM source_rows WHERE id = ?", (annotation_id,))
+            if annotation_id in highlights:
+                conn.execute("DELETE FROM annotations WHERE id = ?", (annotation_id,))
+                delta["deleted"].append(annotation_id)
+
+        for title, book_id in renamed:
+            conn.execute("UPDATE books SET title = ? WHERE id = ?", (title, book_id))
+            changed = conn.execute(
+                "UPDATE annotations SET title = ? WHERE book_id = ? RETURNING id", (title, book_id)
+            ).fetchall()
+            delta["changed"].extend(row[0] for row in changed)
+
+        delta["changed"] = sorted(set(delta["changed"]) - set(delta["added"]))
+        return delta
+
+
+_sidecars = {}
+_sidecars_lock = threading.Lock()
+
+
+def get_sidecar(path):
+    with _sidecars_lock:
+        sidecar = _sidecars.get(path)
+        if sidecar is None:
+            sidecar = _sidecars[path] = Sidecar(path)
+    return sidecar
+
+
+def release_sidecar(path):
+    with _sidecars_lock:
+        _sidecars.pop(path, None)
+    release_pool(f"{path}#write")
@@ -0,0 +1,504 @@
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process loads its own snapshot
+    fcntl = None
+
+# Days are numbered through a leap year, so every month and day (February
+# 29th included) has its own slot in the calendar index.
+CALENDAR_DAYS = 366
+_MONTH_STARTS = (0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335)
+
+
+def calendar_day(month, day):
+    return _MONTH_STARTS[month - 1] + day - 1
+
+
+# A saved snapshot is a header, the source it was loaded from, then a fixed
+# sequence of sections, each a typecode and byte length followed by the data
+# (native byte order) and padding to a multiple of 8 bytes. Loading maps the
+# file and uses the sections in place.
+SNAPSHOT_MAGIC = b"CAPSNAP\0"
+SNAPSHOT_FORMAT = 2
+_HEADER = struct.Struct("<8sIqI")
+_SECTION = struct.Struct("<c7xq")
+
+
+class _Strings:
+    """A column of strings stored as UTF-8 one after another, with their
+    offsets and which ones are None. Strings are decoded as they are read,
+    so a column takes little more memory than its text."""
+
+    __slots__ = ("offsets", "data", "nulls")
+
+    def __init__(self, offsets=None, data=None, nulls=None):
+        self.offsets = array("q", [0]) if offsets is None else offsets
+        self.data = bytearray() if data is None else data
+        self.nulls = bytearray() if nulls is None else nulls
+
+    @classmethod
+    def of(cls, strings):
+        column = cls()
+        for string in strings:
+            column.append(string)
+        return column
+
+    def append(self, string):
+        self.nulls.append(string is None)
+        if string is not None:
+            self.data += string.encode("utf-8", "surrogatepass")
+        self.offsets.append(len(self.data))
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def __getitem__(self, index):
+        if self.nulls[index]:
+            return None
+        return str(self.data[self.offsets[index]:self.offsets[index + 1]], "utf-8", "surrogatepass")
+
+    def sections(self):
+        return [("q", self.offsets), ("B", self.data), ("B", self.nulls)]
+
+
+class _Interned:
+    """A column of values stored as indexes into a table of distinct values."""
+
+    __slots__ = ("indexes", "values")
+
+    def __init__(self, indexes, values):
+        self.indexes = indexes
+        self.values = values
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        return self.values[self.indexes[index]]
+
+
+class Snapshot:
+    """All highlights of the Calibre library, loaded once and kept in columns.
+
+    version is the sidecar sync_version the snapshot was loaded at. Rows are
+    ordered by annotation id. recent_order and book_order hold row
+    numbers in the orders the pages list them in: newest first, and grouped by
+    book title with each book's highlights oldest first. calendar holds, for
+    every day of the year, the rows made on that day (in local time) by year,
+    so the highlights around a date in every year are found directly.
+
+    changes holds the ids the sync that produced the snapshot (from
+    version - 1 to version) added, changed and deleted, or None for a
+    snapshot loaded from scratch. source is the Calibre change counter the
+    snapshot was saved as current for, if any.
+    """
+
+    __slots__ = (
+        "version",
+        "ids",
+        "book_ids",
+        "timestamps",
+        "spine_indexes",
+        "texts",
+        "notes",
+        "start_cfis",
+        "chapter_names",
+        "book_titles",
+        "recent_order",
+        "book_order",
+        "book_ranges",
+        "calendar",
+        "changes",
+        "source",
+    )
+
+    def __init__(self, version, rows, changes=None):
+        self.version = version
+        self.changes = changes
+        self.source = None
+        self.ids = array("q")
+        self.book_ids = array("q")
+        self.timestamps = array("d")
+        self.spine_indexes = array("q")
+        self.texts = _Strings()
+        self.notes = _Strings()
+        self.start_cfis = _Strings()
+        # Many highlights share a chapter, so each name is kept once.
+        self.chapter_names = _Interned(array("q"), [])
+        self.book_titles = {}
+
+        chapter_indexes = {}
+        for row in rows:
+            self.ids.append(row["id"])
+            self.book_ids.append(row["book_id"])
+            self.timestamps.append(row["timestamp"])
+            # Calibre always writes spine_index; -1 marks the odd row without one.
+            spine_index = row["spine_index"]
+            self.spine_indexes.append(-1 if spine_index is None else spine_index)
+            self.texts.append(row["text"])
+            self.notes.append(row["notes"])
+            self.start_cfis.append(row["start_cfi"])
+            chapter_index = chapter_indexes.get(row["chapter"])
+            if chapter_index is None:
+                chapter_index = chapter_indexes[row["chapter"]] = len(self.chapter_names.values)
+                self.chapter_names.values.append(row["chapter"])
+            self.chapter_names.indexes.append(chapter_index)
+            self.book_titles[row["book_id"]] = row["title"]
+
+        rows = range(len(self.ids))
+        titles = [self.book_titles[book_id] for book_id in self.book_ids]
+        self.recent_order = array("l", sorted(rows, key=self._recent_key))
+        self.book_order = array(
+            "l", sorted(rows, key=lambda row: (titles[row], self.book_ids[row], self.timestamps[row]))
+        )
+        self.book_ranges = {}
+        for position, row in enumerate(self.book_order):
+            book_id = self.book_ids[row]
+            start = self.book_ranges.get(book_id, (position,))[0]
+            self.book_ranges[book_id] = (start, position + 1)
+
+        self.calendar = [{} for _ in range(CALENDAR_DAYS)]
+        for row in reversed(self.recent_order):
+            made = time.localtime(self.timestamps[row])
+            years = self.calendar[calendar_day(made.tm_mon, made.tm_mday)]
+            rows_of_year = years.get(made.tm_year)
+            if rows_of_year is None:
+                rows_of_year = years[made.tm_year] = array("l")
+            rows_of_year.append(row)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, path):
+        """Write the snapshot to path, with its source."""
+        book_ids = list(self.book_ranges)
+        calendar = [(slot, year, rows) for slot, years in enumerate(self.calendar) for year, rows in years.items()]
+        calendar_ends = array("q")
+        for _, _, rows in calendar:
+            calendar_ends.append((calendar_ends[-1] if calendar_ends else 0) + len(rows))
+
+        sections = [
+            ("q", self.ids),
+            ("q", self.book_ids),
+            ("d", self.timestamps),
+            ("q", self.spine_indexes),
+            ("q", array("q", self.recent_order)),
+            ("q", array("q", self.book_order)),
+            *self.texts.sections(),
+            *self.notes.sections(),
+            *self.start_cfis.sections(),
+            ("q", self.chapter_names.indexes),
+            *_Strings.of(self.chapter_names.values).sections(),
+            ("q", array("q", book_ids)),
+            *_Strings.of(self.book_titles[book_id] for book_id in book_ids).sections(),
+            ("q", array("q", (self.book_ranges[book_id][0] for book_id in book_ids))),
+            ("q", array("q", (self.book_ranges[book_id][1] for book_id in book_ids))),
+            ("q", array("q", (slot for slot, _, _ in calendar))),
+            ("q", array("q", (year for _, year, _ in calendar))),
+            ("q", calendar_ends),
+            ("q", array("q", (row for _, _, rows in calendar for row in rows))),
+            ("B", bytes([self.changes is not None])),
+            *(("q", array("q", (self.changes or {}).get(kind, ()))) for kind in ("added", "changed", "deleted")),
+        ]
+
+        source = (self.source or "").encode()
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, self.version, len(source)))
+            f.write(source + bytes(-(_HEADER.size + len(source)) % 8))
+            for typecode, data in sections:
+                data = memoryview(data)
+                f.write(_SECTION.pack(typecode.encode(), data.nbytes))
+                f.write(data)
+                f.write(bytes(-data.nbytes % 8))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """The snapshot saved at path, or None if there is no usable one.
+        Columns are read straight from the mapped file, so this takes about
+        as long whatever the library size."""
+        try:
+            with open(path, "rb") as f:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            magic, file_format, version, source_length = _HEADER.unpack_from(view)
+            if magic != SNAPSHOT_MAGIC or file_format != SNAPSHOT_FORMAT:
+                return None
+            offset = _HEADER.size
+            source = str(view[offset:offset + source_length], "utf-8")
+            offset += source_length + -(_HEADER.size + source_length) % 8
+
+            def section():
+                nonlocal offset
+                typecode, size = _SECTION.unpack_from(view, offset)
+                start = offset + _SECTION.size
+                offset = start + size + -size % 8
+                if offset > len(view):
+                    raise ValueError("truncated snapshot")
+                return view[start:start + size].cast(typecode.decode())
+
+            def strings():
+                return _Strings(section(), section(), section())
+
+            snapshot = cls.__new__(cls)
+            snapshot.version = version
+            snapshot.changes = None
+            snapshot.source = source
+            snapshot.ids = section()
+            snapshot.book_ids = section()
+            snapshot.timestamps = section()
+            snapshot.spine_indexes = section()
+            snapshot.recent_order = section()
+            snapshot.book_order = section()
+            snapshot.texts = strings()
+            snapshot.notes = strings()
+            snapshot.start_cfis = strings()
+            chapter_indexes = section()
+            chapter_names = strings()
+            snapshot.chapter_names = _Interned(chapter_indexes, [chapter_names[i] for i in range(len(chapter_names))])
+            book_ids = section()
+            titles = strings()
+            snapshot.book_titles = {book_id: titles[i] for i, book_id in enumerate(book_ids)}
+            snapshot.book_ranges = dict(zip(book_ids, zip(section(), section())))
+            snapshot.calendar = [{} for _ in range(CALENDAR_DAYS)]
+            slots, years, ends, rows = section(), section(), section(), section()
+            start = 0
+            for slot, year, end in zip(slots, years, ends):
+                snapshot.calendar[slot][year] = rows[start:end]
+                start = end
+            has_changes, added, changed, deleted = section(), section(), section(), section()
+            if has_changes[0]:
+                snapshot.changes = {"added": list(added), "changed": list(changed), "deleted": list(deleted)}
+        except (OSError, ValueError, TypeError, IndexError, struct.error):
+            return None
+        return snapshot
+
+    def row_of(self, annotation_id):
+        row = bisect_left(self.ids, annotation_id)
+        if row < len(self.ids) and self.ids[row] == annotation_id:
+            return row
+        return None
+
+    def book_rows(self, book_id):
+        if book_id not in self.book_ranges:
+            return None
+        start, end = self.book_ranges[book_id]
+        return self.book_order[start:end]
+
+    def calendar_rows(self, month, day, window):
+        """(year, rows) for the highlights made within window days of
+        month/day in each year, oldest first. Near New Year the window
+        reaches into the year before or after; year is that of the month/day
+        the rows are nearest to, not the one they were made in."""
+        center = calendar_day(month, day)
+        start = center - min(window, CALENDAR_DAYS // 2)
+        # A window of half a year or more covers each slot once, not both
+        # ends of it twice.
+        end = min(center + window + 1, start + CALENDAR_DAYS)
+        for slot in range(start, end):
+            shift = -1 if slot < 0 else 1 if slot >= CALENDAR_DAYS else 0
+            for year, rows in self.calendar[slot % CALENDAR_DAYS].items():
+                yield year - shift, rows
+
+    def recent_position(self, row):
+        """Index of row in recent_order, by binary search on its sort key."""
+        return bisect_left(self.recent_order, self._recent_key(row), key=self._recent_key)
+
+    def book_position(self, row):
+        """Index of row among its book's rows."""
+        start, end = self.book_ranges[self.book_ids[row]]
+        return bisect_left(self.book_order, self._book_key(row), start, end, key=self._book_key) - start
+
+    # Sort keys of the two orders; the row number breaks ties, as in the
+    # stable sorts that built them.
+    def _recent_key(self, row):
+        return (-self.timestamps[row], self.book_titles[self.book_ids[row]], row)
+
+    def _book_key(self, row):
+        return (self.timestamps[row], row)
+
+    def annotation(self, row):
+        book_id = self.book_ids[row]
+        spine_index = self.spine_indexes[row]
+        return {
+            "id": self.ids[row],
+            "text": self.texts[row],
+            "notes": self.notes[row],
+            "spine_index": None if spine_index == -1 else spine_index,
+            "start_cfi": self.start_cfis[row],
+            "book_title": self.book_titles[book_id],
+            "book_id": book_id,
+            "timestamp": self.timestamps[row],
+            "chapter_name": self.chapter_names[row],
+        }
+
+
+class SnapshotManager:
+    """Keeps the snapshot of one Calibre database current.
+
+    The database is checked on every access, but a changed database is
+    synced and re-read on a background thread while requests keep being
+    served from the previous snapshot. Only the very first load blocks.
+
+    loader(previous) syncs the sidecar and returns a new snapshot, or
+    previous if the sidecar didn't change. Subscribers are called with each
+    new snapshot that replaces a previous one.
+
+    restore(), if given, is tried before the first load: it returns a saved
+    snapshot and whether it is still current, or None. A snapshot that
+    isn't current is served while it is rebuilt in the background.
+    """
+
+    def __init__(self, db_path, loader, restore=None):
+        self.db_path = db_path
+        self.loader = loader
+        self.restore = restore
+        self._snapshot = None
+        self._source_version = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._watch_conn = None
+        self._listeners = []
+        self._watching = False
+        self._threads = []
+        self._stopped = threading.Event()
+
+    def db_version(self):
+        # data_version changes whenever another connection (Calibre included)
+        # commits, but only as seen from one long-lived connection, so the
+        # file stats cover a watcher that had to be reopened.
+        stats = []
+        for path in (self.db_path, f"{self.db_path}-wal"):
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stats.append(None)
+        with self._lock:
+            if self._watch_conn is None:
+                self._watch_conn = sqlite3.connect(
+                    f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False
+                )
+            data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+        return (data_version, *stats)
+
+    def current(self):
+        version = self.db_version()
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    restored = self.restore() if self.restore is not None else None
+                    if restored is None:
+                        self._snapshot = self.loader(None)
+                        self._source_version = version
+                    else:
+                        self._snapshot, up_to_date = restored
+                        self._source_version = version if up_to_date else None
+        if version != self._source_version:
+            self.rebuild_in_background(version)
+        return self._snapshot
+
+    def rebuild_in_background(self, version):
+        with self._lock:
+            if self._rebuilding or self._stopped.is_set():
+                return
+            self._rebuilding = True
+            self._start(self._rebuild, version)
+
+    def _start(self, target, *args):
+        # Called with the lock held.
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _rebuild(self, version):
+        try:
+            previous = self._snapshot
+            self._snapshot = self.loader(previous)
+            self._source_version = version
+        finally:
+            self._rebuilding = False
+        if self._snapshot is not previous:
+            for listener in self._listeners:
+                listener(self._snapshot)
+
+    def subscribe(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def watch(self, interval):
+        """Check the database every interval seconds from a background
+        thread, so subscribers hear about changes without waiting for a
+        request to come in."""
+        def poll():
+            while not self._stopped.wait(interval):
+                try:
+                    self.current()
+                except Exception:
+                    logging.getLogger(__name__).exception("Checking %s for changes failed", self.db_path)
+
+        with self._lock:
+            if self._watching or self._stopped.is_set():
+                return
+            self._watching = True
+            self._start(poll)
+
+    def stop(self):
+        """Stop watching the database and wait for a rebuild under way, for a
+        manager that is no longer used."""
+        self._stopped.set()
+        # No thread starts once stopped is set, so these are all of them.
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        with self._lock:
+            if self._watch_conn is not None:
+                self._watch_conn.close()
+                self._watch_conn = None
+
+
+@contextmanager
+def snapshot_lock(path):
+    """Hold an exclusive lock on the snapshot saved at path, across
+    processes."""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_snapshot_manager(db_path, loader, restore=None):
+    with _managers_lock:
+        manager = _managers.get(db_path)
+        if manager is None:
+            manager = _managers[db_path] = SnapshotManager(db_path, loader, restore)
+    return manager
+
+
+def release_snapshot_manager(db_path):
+    with _managers_lock:
+        manager = _managers.pop(db_path, None)
+    if manager is not None:
+        manager.stop()
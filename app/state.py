@@ -0,0 +1,378 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+
+from app.libraries import current_library
+
+try:
+    import fcntl
+except ImportError:  # Windows: locking falls back to this process only
+    fcntl = None
+
+
+# Favorite/last-read state is kept in two files next to STATE_FILE:
+#
+#   state.json          snapshot: {"format": 2, "generation": N, "annotations": {...}}
+#   state.json.journal  header line {"generation": N}, then one JSON record per
+#                       mutation, e.g. {"id": "12", "favorite": true}
+#
+# Mutations are appended to the journal and fsynced in groups. The snapshot is
+# only rewritten by compaction, which folds the journal into a new snapshot
+# with generation N+1 and then starts an empty journal for N+1. A journal whose
+# generation doesn't match the snapshot was already folded in and is ignored,
+# so a crash at any point during compaction leaves a consistent state.
+#
+# Older versions of Capsule stored the bare {"<id>": {...}} dict in state.json.
+# That format is still read as generation 0 and is rewritten on the next
+# compaction (or explicitly with migrate_legacy_state).
+
+SNAPSHOT_FORMAT = 2
+DEFAULT_ENTRY = {"favorite": False, "last_read": None}
+
+
+def _fsync_dir(path):
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+def read_snapshot(path):
+    """Return (generation, annotations) from a snapshot in either format."""
+    if not os.path.exists(path):
+        return 0, {}
+    with open(path, "r") as f:
+        data = json.load(f)
+    if data.get("format") == SNAPSHOT_FORMAT:
+        return data["generation"], data["annotations"]
+    return 0, data
+
+
+class StateStore:
+    def __init__(self, state_file, compact_after=1000):
+        self.snapshot_file = state_file
+        self.journal_file = f"{state_file}.journal"
+        self.lock_file = f"{state_file}.lock"
+        self.compact_after = compact_after
+
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._generation = 0
+        self._journal_fd = None
+        self._journal_inode = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._journal_stale = False
+
+        # Group commit bookkeeping: every append gets a sequence number and
+        # one fsync covers every append written before it started.
+        self._sync_cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+
+        self._compacting = False
+        self._flock_exclusive = None
+        self._listeners = []
+
+        with self._lock:
+            self._refresh()
+
+    # Reading
+
+    def get(self, annotation_id):
+        self.refresh()
+        return self._entries.get(str(annotation_id), DEFAULT_ENTRY)
+
+    def entries(self):
+        """The current {"<id>": entry} mapping. Treat it as read-only."""
+        self.refresh()
+        return self._entries
+
+    @property
+    def version(self):
+        """Changes whenever the state does, and is the same in every process."""
+        self.refresh()
+        return f"{self._generation}.{self._journal_offset}"
+
+    def subscribe(self, listener):
+        """Call listener(changes, entries) whenever state changes.
+
+        changes maps each changed "<id>" to its new entry, or is None when
+        the whole state was reloaded; entries is the full current mapping.
+        Listeners run with the store's lock held and must not call back into
+        the store.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    @contextmanager
+    def locked(self):
+        """Hold off state changes, e.g. to build an index that subscribes."""
+        with self._lock:
+            self._refresh()
+            yield self._entries
+
+    def _notify(self, records):
+        if records is None:
+            changes = None
+        else:
+            changes = {record["id"]: self._entries[record["id"]] for record in records}
+        for listener in self._listeners:
+            listener(changes, self._entries)
+
+    def refresh(self):
+        try:
+            stat = os.stat(self.journal_file)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and stat.st_ino == self._journal_inode and stat.st_size == self._journal_offset:
+            return
+        with self._lock:
+            self._refresh()
+
+    @contextmanager
+    def _file_lock(self, exclusive):
+        # Cross-process lock on state.json.lock. Callers hold self._lock, and a
+        # lock that is already held (at least as strongly) is reused, since a
+        # second flock() from this process would wait on itself.
+        if fcntl is None or self._flock_exclusive is not None:
+            assert not exclusive or self._flock_exclusive in (None, True)
+            yield
+            return
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._flock_exclusive = exclusive
+            yield
+        finally:
+            self._flock_exclusive = None
+            os.close(fd)
+
+    def _refresh(self):
+        if not os.path.exists(self.journal_file):
+            # Only a (possibly legacy) snapshot exists so far.
+            with self._file_lock(exclusive=True):
+                if not os.path.exists(self.journal_file):
+                    generation, _ = read_snapshot(self.snapshot_file)
+                    _write_atomic(self.journal_file, self._header(generation))
+        with self._file_lock(exclusive=False):
+            fd = os.open(self.journal_file, os.O_RDWR | os.O_APPEND)
+            inode = os.fstat(fd).st_ino
+            if inode != self._journal_inode:
+                self._reload(fd, inode)
+                self._notify(None)
+            else:
+                os.close(fd)
+                records = self._replay_from(self._journal_offset)
+                if records:
+                    self._notify(records)
+
+    def _reload(self, fd, inode):
+        generation, entries = read_snapshot(self.snapshot_file)
+        self._set_journal_fd(fd)
+        self._entries = dict(entries)
+        self._generation = generation
+        self._journal_inode = inode
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._journal_stale = False
+        self._replay_from(0)
+
+    def _set_journal_fd(self, fd):
+        # Wait for an in-flight group fsync before closing the old journal.
+        with self._sync_cond:
+            while self._syncing:
+                self._sync_cond.wait()
+            if self._journal_fd is not None:
+                os.close(self._journal_fd)
+            self._journal_fd = fd
+
+    def _replay_from(self, offset):
+        with open(self.journal_file, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # A trailing record without a newline is a torn write from a crashed
+        # writer; it is skipped here and truncated by the next mutate().
+        end = data.rfind(b"\n") + 1
+        applied = []
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            # Corruption that still parses is skipped like any other.
+            if not isinstance(record, dict):
+                continue
+            if "id" not in record:
+                if "generation" not in record:
+                    continue
+                if record["generation"] != self._generation:
+                    # Compaction crashed after writing the snapshot, so this
+                    # journal is already folded in. mutate() replaces it.
+                    self._journal_stale = True
+                    break
+                continue
+            self._apply(record)
+            applied.append(record)
+            self._journal_records += 1
+        self._journal_offset = offset + end
+        return applied
+
+    def _apply(self, record):
+        record = dict(record)
+        annotation_id = record.pop("id")
+        # Entries are replaced rather than mutated so readers never see a
+        # half-applied record.
+        self._entries[annotation_id] = {**self._entries.get(annotation_id, DEFAULT_ENTRY), **record}
+
+    @staticmethod
+    def _header(generation):
+        return (json.dumps({"generation": generation}) + "\n").encode()
+
+    # Writing
+
+    def mutate(self, build):
+        """Apply the records returned by build(entries) as one journal append.
+
+        build runs under an exclusive lock on an up-to-date view of the state,
+        so read-modify-write updates such as toggles don't lose each other's
+        changes across threads or processes.
+        """
+        with self._lock:
+            with self._file_lock(exclusive=True):
+                self._refresh()
+                if self._journal_stale:
+                    _write_atomic(self.journal_file, self._header(self._generation))
+                    self._refresh()
+                if os.fstat(self._journal_fd).st_size != self._journal_offset:
+                    # Drop a torn record so the next one starts on a new line.
+                    os.ftruncate(self._journal_fd, self._journal_offset)
+                records = build(self._entries)
+                data = "".join(json.dumps(record) + "\n" for record in records).encode()
+                os.write(self._journal_fd, data)
+                self._journal_offset += len(data)
+                for record in records:
+                    self._apply(record)
+                self._journal_records += len(records)
+                self._notify(records)
+                with self._sync_cond:
+                    self._written += 1
+                    sequence = self._written
+                needs_compaction = self._journal_records >= self.compact_after
+        self._sync(sequence)
+        if needs_compaction:
+            self.compact_in_background()
+        return records
+
+    def set(self, annotation_id, **fields):
+        return self.mutate(lambda entries: [{"id": str(annotation_id), **fields}])[0]
+
+    def _sync(self, sequence):
+        with self._sync_cond:
+            while self._synced < sequence:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                target = self._written
+                fd = self._journal_fd
+                self._sync_cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                    self._sync_cond.notify_all()
+                self._synced = max(self._synced, target)
+
+    # Compaction
+
+    def compact_in_background(self):
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        try:
+            with self._lock:
+                with self._file_lock(exclusive=True):
+                    self._refresh()
+                    generation = self._generation + 1
+                    snapshot = {
+                        "format": SNAPSHOT_FORMAT,
+                        "generation": generation,
+                        "annotations": self._entries,
+                    }
+                    _write_atomic(self.snapshot_file, json.dumps(snapshot).encode())
+                    _write_atomic(self.journal_file, self._header(generation))
+                    self._refresh()
+                    with self._sync_cond:
+                        # Everything written so far is now in the snapshot.
+                        self._synced = self._written
+        finally:
+            self._compacting = False
+
+    def close(self):
+        with self._lock:
+            self._set_journal_fd(None)
+            self._journal_inode = None
+
+
+def migrate_legacy_state(state_file):
+    """Rewrite a pre-journal state.json in the snapshot format.
+
+    The original file is kept next to it as state.json.bak. Returns the number
+    of annotations migrated, or None if the file was already migrated.
+    """
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, "r") as f:
+        data = json.load(f)
+    if data.get("format") == SNAPSHOT_FORMAT:
+        return None
+    with open(f"{state_file}.bak", "w") as f:
+        json.dump(data, f)
+    store = StateStore(state_file)
+    store.compact()
+    store.close()
+    return len(data)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_state_store():
+    state_file = current_library().state_file
+    with _stores_lock:
+        store = _stores.get(state_file)
+        if store is None:
+            store = StateStore(state_file, current_app.config["STATE_COMPACT_AFTER"])
+            _stores[state_file] = store
+    return store
+
+
+def release_state_store(state_file):
+    with _stores_lock:
+        store = _stores.pop(state_file, None)
+    if store is not None:
+        store.close()
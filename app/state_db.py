@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+class StateDatabase:
+    """An in-memory SQLite copy of a StateStore that queries can join against.
+
+    The copy lives in a shared-cache memory database, which index connections
+    ATTACH as "state", and is kept in step by subscribing to the store. Readers
+    use read_uncommitted so they never wait on the table lock of a write in
+    progress.
+    """
+
+    def __init__(self, store):
+        digest = hashlib.sha1(os.path.abspath(store.snapshot_file).encode()).hexdigest()[:16]
+        self.uri = f"file:capsule-state-{digest}?mode=memory&cache=shared"
+        self.store = store
+        self._lock = threading.Lock()
+        # Also keeps the memory database alive between queries.
+        self._conn = sqlite3.connect(self.uri, uri=True, isolation_level=None, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS state (
+                id INTEGER PRIMARY KEY,
+                favorite INTEGER NOT NULL,
+                is_read INTEGER NOT NULL,
+                last_read REAL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS state_flags ON state (favorite, is_read)")
+        with store.locked() as entries:
+            self._load(entries)
+            store.subscribe(self._on_state_change)
+
+    @staticmethod
+    def _row(annotation_id, entry):
+        last_read = entry.get("last_read")
+        last_read = float(last_read) if last_read else None
+        return (int(annotation_id), bool(entry.get("favorite", False)), last_read is not None, last_read)
+
+    def _write(self, sql, rows):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if sql is None:
+                    self._conn.execute("DELETE FROM state")
+                    sql = "INSERT INTO state (id, favorite, is_read, last_read) VALUES (?, ?, ?, ?)"
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _load(self, entries):
+        self._write(None, [self._row(i, entry) for i, entry in list(entries.items())])
+
+    def _on_state_change(self, changes, entries):
+        if changes is None:
+            self._load(entries)
+            return
+        self._write(
+            "INSERT OR REPLACE INTO state (id, favorite, is_read, last_read) VALUES (?, ?, ?, ?)",
+            [self._row(i, entry) for i, entry in changes.items()],
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def attach(self, conn):
+        conn.execute("ATTACH DATABASE ? AS state", (self.uri,))
+        conn.execute("PRAGMA read_uncommitted = 1")
+
+
+def state_filter_sql(favorite_filter, read_filter, id_column="a.id"):
+    """JOIN and WHERE clauses applying the session filters to the annotations
+    whose ids are in id_column.
+
+    Rows without a state entry are neither favorite nor read, so positive
+    filters can use an inner join driven by the state (favorite, is_read)
+    index, while negative ones need a LEFT JOIN.
+    """
+    conditions = []
+    inner = favorite_filter is True or read_filter is True
+    for column, value in (("favorite", favorite_filter), ("is_read", read_filter)):
+        if value is True:
+            conditions.append(f"s.{column} = 1")
+        elif value is False:
+            conditions.append(f"COALESCE(s.{column}, 0) = 0")
+    join = f"JOIN state.state s ON s.id = {id_column}" if inner else f"LEFT JOIN state.state s ON s.id = {id_column}"
+    return join, " AND ".join(conditions) or "1"
+
+
+_state_dbs = {}
+_state_dbs_lock = threading.Lock()
+
+
+def get_state_db(store):
+    with _state_dbs_lock:
+        state_db = _state_dbs.get(store.snapshot_file)
+        if state_db is None:
+            state_db = _state_dbs[store.snapshot_file] = StateDatabase(store)
+    return state_db
+
+
+def release_state_db(snapshot_file):
+    with _state_dbs_lock:
+        state_db = _state_dbs.pop(snapshot_file, None)
+    if state_db is not None:
+        state_db.close()
@@ -1,4 +1,83 @@
-// Favorite and  last read toggle event listeners
+// Favorite and read changes are queued and sent together once clicks stop
+// for STATE_BATCH_DELAY ms, so a burst of them is one request and one write.
+// A later change to the same highlight replaces the queued one, keeping the
+// first one's undo, which goes back to what the server has.
+const STATE_BATCH_DELAY = 400;
+const STATE_RETRY_DELAY = 5000;
+const STATE_BATCH_MAX = 1000;
+const pendingState = new Map();
+let stateTimer = null;
+
+function queueState(op, annotationId, undo) {
+    const key = `${op === 'read' ? 'read' : 'favorite'}:${annotationId}`;
+    const queued = pendingState.get(key);
+    pendingState.set(key, { op: op, id: Number(annotationId), undo: queued ? queued.undo : undo });
+    clearTimeout(stateTimer);
+    if (pendingState.size >= STATE_BATCH_MAX) {
+        flushState();
+    } else {
+        stateTimer = setTimeout(flushState, STATE_BATCH_DELAY);
+    }
+}
+
+function flushState(keepalive = false) {
+    clearTimeout(stateTimer);
+    if (pendingState.size === 0) return Promise.resolve();
+    const batch = new Map(pendingState);
+    pendingState.clear();
+    return fetch(`${SCRIPT_ROOT}/api/state`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ operations: [...batch.values()].map(({ op, id }) => ({ op: op, id: id })) }),
+        keepalive: keepalive,
+    }).then(response => {
+        if (!response.ok) {
+            // Rejected, so none of it was saved: show the buttons as they were.
+            console.error('Error:', response.status);
+            batch.forEach(change => change.undo());
+            return;
+        }
+        return response.json().then(data => {
+            Object.entries(data.states).forEach(([id, state]) => {
+                showFavorite(id, state.is_favorite);
+                if (state.last_read) showLastRead(id, state.last_read);
+            });
+        });
+    }, error => {
+        // Never got there: queue it again, under any newer change to the
+        // same highlights, and try again later.
+        console.error('Error:', error);
+        batch.forEach((change, key) => {
+            const newer = pendingState.get(key);
+            pendingState.set(key, newer ? { ...newer, undo: change.undo } : change);
+        });
+        clearTimeout(stateTimer);
+        stateTimer = setTimeout(flushState, STATE_RETRY_DELAY);
+    });
+}
+
+// Whatever is still queued goes out as the page is left.
+window.addEventListener('pagehide', () => flushState(true));
+
+function showFavorite(annotationId, isFavorite) {
+    document.querySelectorAll(`.favorite-btn[data-annotation-id="${annotationId}"]`).forEach(btn => {
+        btn.dataset.isFavorite = isFavorite.toString();
+        btn.querySelector('svg').style.fill = isFavorite ? 'currentColor' : 'none';
+    });
+}
+
+function showLastReadText(annotationId, text) {
+    document.querySelectorAll(`.last-read-btn[data-annotation-id="${annotationId}"] .last-read`).forEach(el => {
+        el.textContent = text;
+    });
+}
+
+function showLastRead(annotationId, timestamp) {
+    showLastReadText(annotationId, new Date(timestamp * 1000).toISOString().slice(0, 19).replace('T', ' '));
+}
+
+// Favorite and last read buttons show the change right away; the server's
+// answer to the batch then confirms or undoes it.
 document.addEventListener('click', function(e) {
     if (e.target.closest('.favorite-btn')) {
         const btn = e.target.closest('.favorite-btn');
@@ -6,40 +85,146 @@ document.addEventListener('click', function(e) {
         const isFavorite = btn.dataset.isFavorite === 'true';
 
         if (confirm("Are you sure you want to " + (isFavorite ? "unfavorite" : "favorite") + " this annotation?")) {
-            fetch(`/toggle_favorite/${annotationId}`, { method: 'POST' })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        btn.dataset.isFavorite = (!isFavorite).toString();
-                        btn.querySelector('svg').style.fill = isFavorite ? 'none' : 'currentColor';
-                    }
-                });
+            showFavorite(annotationId, !isFavorite);
+            queueState(isFavorite ? 'unfavorite' : 'favorite', annotationId, () => showFavorite(annotationId, isFavorite));
         }
     }
 
     if (e.target.closest('.last-read-btn')) {
         const btn = e.target.closest('.last-read-btn');
         const annotationId = btn.dataset.annotationId;
+        const previous = btn.querySelector('.last-read').textContent;
+        showLastRead(annotationId, Date.now() / 1000);
+        queueState('read', annotationId, () => showLastReadText(annotationId, previous));
+    }
 
-        fetch(`/update_last_read/${annotationId}`, { method: 'POST' })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    const date = new Date(data.new_timestamp * 1000);
-                    const formattedDate = date.toISOString().slice(0, 19).replace('T', ' ');
-                    btn.querySelector('.last-read').textContent = formattedDate;
-                }
-            });
+// "Mark all read" for a book or for the current filters
+    if (e.target.closest('.mark-read-btn')) {
+        const btn = e.target.closest('.mark-read-btn');
+        if (confirm(btn.dataset.confirm)) {
+            flushState()
+                .then(() => fetch(btn.dataset.url, { method: 'POST' }))
+                .then(response => {
+                    if (response.ok) { location.reload(); }
+                })
+                .catch(error => console.error('Error:', error));
+        }
     }
 });
 
+// Related highlights, fetched the first time they are asked for and then
+// shown or hidden
+document.addEventListener('click', function(e) {
+    const btn = e.target.closest('.related-btn');
+    if (!btn) return;
+
+    const highlight = btn.closest('.highlight');
+    const shown = highlight.querySelector('.related');
+    if (shown) {
+        shown.classList.toggle('hidden');
+        return;
+    }
+    btn.disabled = true;
+    fetch(`${SCRIPT_ROOT}/api/related/${btn.dataset.annotationId}`)
+        .then(response => response.json())
+        .then(data => highlight.insertAdjacentHTML('beforeend', data.html))
+        .catch(error => console.error('Error:', error))
+        .finally(() => { btn.disabled = false; });
+});
+
+// "Load more" buttons on paged book and notes pages
+document.addEventListener('click', function(e) {
+    const btn = e.target.closest('.load-more');
+    if (!btn) return;
+
+    btn.disabled = true;
+    const params = new URLSearchParams({ after: btn.dataset.next });
+    fetch(`${btn.dataset.url}?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            const target = document.getElementById(btn.dataset.target);
+            const template = document.createElement('template');
+            if (data.books) {
+                template.innerHTML = data.books.map(book => book.html).join('');
+                // A book cut off by the previous page continues in its section.
+                const first = template.content.querySelector('.book-section');
+                const last = target.querySelector('.book-section:last-child');
+                if (first && last && first.dataset.bookId === last.dataset.bookId) {
+                    last.querySelector('.book-annotations').append(...first.querySelector('.book-annotations').children);
+                    first.remove();
+                }
+            } else {
+                template.innerHTML = data.annotations.map(annotation => `<div class="">${annotation.html}</div>`).join('');
+            }
+            target.append(template.content);
+
+            if (data.next) {
+                btn.dataset.next = data.next;
+                btn.disabled = false;
+            } else {
+                btn.remove();
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            btn.disabled = false;
+        });
+});
+
+// Live updates as Calibre syncs highlights
+if (window.EventSource) {
+    const events = new EventSource(`${SCRIPT_ROOT}/events`);
+    let newHighlights = 0;
+
+    function showLiveNotice(text) {
+        const notice = document.getElementById('live-notice');
+        notice.textContent = text;
+        notice.classList.remove('hidden');
+    }
+
+    events.addEventListener('sync', function(e) {
+        const data = JSON.parse(e.data);
+        const template = document.createElement('template');
+
+        data.deleted.forEach(id => {
+            document.querySelectorAll(`.highlight[data-annotation-id="${id}"]`).forEach(el => el.remove());
+        });
+        data.changed.forEach(annotation => {
+            document.querySelectorAll(`.highlight[data-annotation-id="${annotation.id}"]`).forEach(el => {
+                const inBook = el.closest('#book-annotations, .book-annotations');
+                template.innerHTML = inBook ? annotation.book_html : annotation.html;
+                el.replaceWith(template.content);
+            });
+        });
+        data.added.forEach(annotation => {
+            // New highlights are the newest, so they go last on a book page
+            // that shows all of its highlights; elsewhere they're announced.
+            const list = document.querySelector(`#book-annotations[data-book-id="${annotation.book_id}"]`);
+            if (list && !document.querySelector('.load-more')) {
+                template.innerHTML = `<div class="">${annotation.book_html}</div>`;
+                list.append(template.content);
+            } else {
+                newHighlights += 1;
+            }
+        });
+        if (newHighlights) {
+            showLiveNotice(`${newHighlights} new highlight${newHighlights > 1 ? 's' : ''}`);
+        }
+    });
+
+    events.addEventListener('reload', function() {
+        events.close();
+        showLiveNotice('library changed, reload');
+    });
+}
+
 function toggleChapterName(element) {
     const chapterName = element.previousElementSibling;
     chapterName.classList.toggle('hidden');
 }
 
 function toggleFilter(filterType) {
-    fetch(`/toggle_filter/${filterType}`, { method: 'GET' })
+    fetch(`${SCRIPT_ROOT}/toggle_filter/${filterType}`, { method: 'GET' })
         .then(response => {
             if (response.ok) { location.reload(); }
         })
@@ -63,8 +248,9 @@ document.addEventListener('DOMContentLoaded', function() {
     applyFiltersButton.addEventListener('click', function() {
       const readFilter = document.querySelector('input[name="read_filter"]:checked').value;
       const favoriteFilter = document.querySelector('input[name="favorite_filter"]:checked').value;
+      const pick = document.querySelector('input[name="pick"]:checked').value;
   
-      applyFilters(readFilter, favoriteFilter);
+      applyFilters(readFilter, favoriteFilter, pick);
     });
   
     // Close the dropdown when clicking outside of it
@@ -75,12 +261,13 @@ document.addEventListener('DOMContentLoaded', function() {
     });
   });
   
-  function applyFilters(readFilter, favoriteFilter) {
+  function applyFilters(readFilter, favoriteFilter, pick) {
     const params = new URLSearchParams();
     params.append('read_filter', readFilter);
     params.append('favorite_filter', favoriteFilter);
+    params.append('pick', pick);
   
-    fetch('/apply_filters?' + params.toString(), { method: 'GET' })
+    fetch(`${SCRIPT_ROOT}/apply_filters?` + params.toString(), { method: 'GET' })
       .then(response => {
         if (response.ok) { 
           location.reload();
@@ -99,8 +286,6 @@ document.addEventListener('DOMContentLoaded', function() {
 // Highlight navigation buttons
 ///////////////////////////////
 
-// Get all highlight elements
-const highlights = document.querySelectorAll('.highlight');
 let currentHighlightIndex = -1;
 
 // Add event listeners to buttons
@@ -108,6 +293,8 @@ document.getElementById('prevHighlight').addEventListener('click', () => navigat
 document.getElementById('nextHighlight').addEventListener('click', () => navigateHighlights('next'));
 
 function navigateHighlights(direction) {
+  // Looked up each time, as "Load more" can add highlights.
+  const highlights = document.querySelectorAll('.highlight');
   if (highlights.length === 0) return;
 
   // Remove outline from the previous highlight
@@ -1,59 +1,117 @@
 import json
-import os
+import re
 from datetime import datetime
 
-from flask import current_app, url_for
+from flask import url_for
+
+from app.libraries import current_library
+from app.metrics import state_operation
+from app.review import schedule
+from app.state import get_state_store
 
 
 def to_datetime(value, format="%Y-%m-%d %H:%M:%S"):
     return datetime.fromtimestamp(value).strftime(format)
 
 
+@state_operation("read")
 def load_state():
-    state_file = current_app.config["STATE_FILE"]
-    if os.path.exists(state_file):
-        with open(state_file, "r") as f:
-            return json.load(f)
-    return {}
-
-
-def save_state(state):
-    state_file = current_app.config["STATE_FILE"]
-    with open(state_file, "w") as f:
-        json.dump(state, f)
+    return get_state_store().entries()
 
 
+@state_operation("read")
+def get_annotation_states(annotation_ids):
+    """Look up favorite and last-read state for many annotations at once."""
+    state = load_state()
+    states = {}
+    for annotation_id in annotation_ids:
+        entry = state.get(str(annotation_id), {})
+        last_read = entry.get("last_read", None)
+        states[annotation_id] = {
+            "is_favorite": entry.get("favorite", False),
+            "last_read": float(last_read) if last_read else None,
+        }
+    return states
+
+
+@state_operation("read")
 def is_favorite(annotation_id):
     state = load_state()
     return state.get(str(annotation_id), {}).get("favorite", False)
 
 
+@state_operation("write")
 def toggle_favorite(annotation_id):
-    state = load_state()
     annotation_id_str = str(annotation_id)
 
-    if annotation_id_str not in state:
-        state[annotation_id_str] = {"favorite": False, "last_read": None}
-
-    state[annotation_id_str]["favorite"] = not state[annotation_id_str]["favorite"]
+    def toggle(entries):
+        favorite = entries.get(annotation_id_str, {}).get("favorite", False)
+        return [{"id": annotation_id_str, "favorite": not favorite}]
 
-    save_state(state)
+    get_state_store().mutate(toggle)
     return True
 
 
+@state_operation("write")
 def update_last_read(annotation_id):
-    state = load_state()
-    annotation_id_str = str(annotation_id)
+    record = get_state_store().set(annotation_id, last_read=datetime.now().timestamp())
+    return record["last_read"]
+
+
+STATE_OPERATIONS = ("favorite", "unfavorite", "toggle_favorite", "read")
+
 
-    if annotation_id_str not in state:
-        state[annotation_id_str] = {"favorite": False, "last_read": None}
+@state_operation("write")
+def apply_state_operations(operations):
+    """Apply (operation, annotation_id) pairs in order as one journal append,
+    so a batch costs one write and one fsync, and lands all at once.
 
-    state[annotation_id_str]["last_read"] = datetime.now().timestamp()
+    Operations on the same highlight are folded into one record. Returns the
+    resulting states of the highlights touched, like get_annotation_states.
+    """
+    if not operations:
+        return {}
+    now = datetime.now().timestamp()
 
-    save_state(state)
-    return state[annotation_id_str]["last_read"]
+    def build(entries):
+        records = {}
+        for operation, annotation_id in operations:
+            annotation_id_str = str(annotation_id)
+            record = records.setdefault(annotation_id_str, {"id": annotation_id_str})
+            if operation == "read":
+                record["last_read"] = now
+            elif operation == "toggle_favorite":
+                record["favorite"] = not record.get("favorite", entries.get(annotation_id_str, {}).get("favorite", False))
+            else:
+                record["favorite"] = operation == "favorite"
+        return list(records.values())
 
+    records = get_state_store().mutate(build)
+    return get_annotation_states(int(record["id"]) for record in records)
 
+
+@state_operation("write")
+def mark_read(annotation_ids):
+    """Mark many highlights read at once, in one journal append."""
+    now = datetime.now().timestamp()
+    get_state_store().mutate(lambda entries: [{"id": str(annotation_id), "last_read": now} for annotation_id in annotation_ids])
+    return now
+
+
+@state_operation("write")
+def grade_review(annotation_id, grade):
+    """Reschedule a highlight after a review; it also counts as read."""
+    annotation_id_str = str(annotation_id)
+    now = datetime.now().timestamp()
+
+    def grade_entry(entries):
+        entry = entries.get(annotation_id_str, {})
+        return [{"id": annotation_id_str, "last_read": now, **schedule(entry, grade, now)}]
+
+    return get_state_store().mutate(grade_entry)[0]
+
+
+@state_operation("read")
 def get_last_read(annotation_id):
     state = load_state()
     last_read = state.get(str(annotation_id), {}).get("last_read", None)
@@ -62,14 +120,41 @@ def get_last_read(annotation_id):
     return None
 
 
+@state_operation("read")
 def is_read(annotation_id):
     return bool(get_last_read(annotation_id))
 
 
 def generate_calibre_url(book_id, spine_index, start_cfi):
-    return f"calibre://view-book/books/{book_id}/EPUB?open_at=epubcfi(/{(spine_index + 1) * 2}{start_cfi})"
+    library_id = current_library().calibre_id
+    return f"calibre://view-book/{library_id}/{book_id}/EPUB?open_at=epubcfi(/{(spine_index + 1) * 2}{start_cfi})"
 
 
 # Calibre stores chapter title as a json array, this function joins it into a string
 def chapter_array_to_str(array):
     return " ".join(json.loads(array) if array else [])
+
+
+def fts_query(text):
+    """Turn what was typed into the search box into an FTS5 query.
+
+    Every word or "quoted phrase" must match. Words are matched as prefixes
+    if they end in *, as is the last word, so results show up while typing.
+    Returns None if there is nothing to search for. Control characters
+    count as spaces: FTS5 takes a NUL for the end of the query.
+    """
+    text = re.sub(r"[\x00-\x1f\x7f]", " ", text)
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"?|(\S+)', text):
+        if phrase.strip():
+            terms.append('"' + phrase.strip() + '"')
+        elif word:
+            prefix = word.endswith("*")
+            word = word.replace('"', "").rstrip("*")
+            if word:
+                terms.append('"' + word + '"' + ("*" if prefix else ""))
+    if not terms:
+        return None
+    if not text[-1].isspace() and not text.endswith('"') and not terms[-1].endswith("*"):
+        terms[-1] += "*"
+    return " ".join(terms)
@@ -0,0 +1,101 @@
+"""Time from a fresh process to its first response, with and without a saved snapshot.
+
+    python -m benchmarks.coldstart --size 100k --runs 5 --output coldstart.json
+
+Each run starts a new Python process against a synthetic library (see
+benchmarks.library) and times its first request through Flask's test
+client. The sidecar index is built once beforehand, so "rebuild" is a start
+that re-reads every highlight from it and "restore" one that maps the
+snapshot the previous start saved.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.library import SIZES, generate_library
+
+PATHS = ("/", "/books")
+
+FIRST_REQUEST = """
+import json, sys, time
+started = time.perf_counter()
+from app import app
+library, path = sys.argv[1:]
+app.config.update(
+    DB_PATH=f"{library}/metadata.db",
+    STATE_FILE=f"{library}/state.json",
+    INDEX_PATH=f"{library}/capsule-index.db",
+)
+imported = time.perf_counter()
+with app.test_client().get(path) as response:
+    response.get_data()
+print(json.dumps({"status": response.status_code, "import_s": imported - started,
+                  "first_request_s": time.perf_counter() - imported}))
+"""
+
+
+def first_request(library, path):
+    output = subprocess.run(
+        [sys.executable, "-c", FIRST_REQUEST, library, path],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run(library, runs):
+    snapshot_path = os.path.join(library, "capsule-index.db.snapshot")
+    # Builds the index and saves a snapshot.
+    first_request(library, "/books")
+
+    results = {}
+    for path in PATHS:
+        for mode in ("rebuild", "restore"):
+            timings = []
+            for _ in range(runs):
+                if mode == "rebuild" and os.path.exists(snapshot_path):
+                    os.remove(snapshot_path)
+                elif mode == "restore" and not os.path.exists(snapshot_path):
+                    first_request(library, path)
+                timings.append(first_request(library, path))
+            name = f"{mode} GET {path}"
+            results[name] = {
+                "status": timings[-1]["status"],
+                "import_ms": statistics.median(t["import_s"] for t in timings) * 1000,
+                "first_request_ms": statistics.median(t["first_request_s"] for t in timings) * 1000,
+            }
+            print(
+                f"{name:20} {results[name]['status']} import {results[name]['import_ms']:7.1f} ms  "
+                f"first request {results[name]['first_request_ms']:8.1f} ms"
+            )
+    return {"runs": runs, "snapshot_bytes": os.path.getsize(snapshot_path), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="10k", type=str.lower)
+    parser.add_argument("--library", help="reuse a library made by benchmarks.library")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        library = args.library
+        if library is None:
+            library = tmp
+            generate_library(library, SIZES[args.size])
+        results = run(os.path.abspath(library), args.runs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""Generate a synthetic Calibre library and a matching state file.
+
+    python -m benchmarks.library /tmp/library --size 100k
+
+Writes metadata.db (Calibre's books and annotations tables, with annot_data
+as the e-book viewer stores it) and state.json into the directory.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timezone
+
+from app.state import SNAPSHOT_FORMAT
+
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+# The parts of Calibre's schema Capsule reads, as created by calibre itself.
+SCHEMA = """
+CREATE TABLE books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL DEFAULT 'Unknown' COLLATE NOCASE,
+    sort TEXT COLLATE NOCASE,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    pubdate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    series_index REAL NOT NULL DEFAULT 1.0,
+    author_sort TEXT COLLATE NOCASE,
+    isbn TEXT DEFAULT "" COLLATE NOCASE,
+    lccn TEXT DEFAULT "" COLLATE NOCASE,
+    path TEXT NOT NULL DEFAULT "",
+    flags INTEGER NOT NULL DEFAULT 1,
+    uuid TEXT,
+    has_cover BOOL DEFAULT 0,
+    last_modified TIMESTAMP NOT NULL DEFAULT "2000-01-01 00:00:00+00:00"
+);
+CREATE TABLE annotations (
+    id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE,
+    user_type TEXT NOT NULL,
+    user TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    annot_id TEXT NOT NULL,
+    annot_type TEXT NOT NULL,
+    annot_data TEXT NOT NULL,
+    searchable_text TEXT NOT NULL DEFAULT "",
+    UNIQUE(book, user_type, user, format, annot_type, annot_id)
+);
+CREATE INDEX annot_idx ON annotations (book);
+"""
+
+FUNCTION_WORDS = (
+    "the of and to a in is that it was for on with as by at from this but not "
+    "be are have one all we there what so out if about who which their will"
+).split()
+CONTENT_WORDS = (
+    "memory attention habit river stone light garden city language silence time "
+    "reading mind history body machine letter music friend night winter journey "
+    "idea question answer pattern system small large quiet bright old new"
+).split()
+SYLLABLES = "ba be bi bo da de di do ka ke ki ko la le li lo ma me mi mo na ne ni no ra re ri ro sa se si so ta te ti to".split()
+
+
+def _vocabulary(size=20_000):
+    # Real words, then made-up ones, in order of how common they are; word
+    # frequencies in text roughly follow Zipf's law, 1 / rank.
+    rnd = random.Random(0)
+    words = FUNCTION_WORDS + CONTENT_WORDS
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    cumulative = list(itertools.accumulate(1 / rank for rank in range(1, size + 1)))
+    return words, cumulative
+
+
+VOCABULARY, CUMULATIVE_WEIGHTS = _vocabulary()
+COLORS = ("yellow", "green", "blue", "red", "purple")
+
+
+def sentence(rnd, low, high):
+    words = rnd.choices(VOCABULARY, cum_weights=CUMULATIVE_WEIGHTS, k=rnd.randint(low, high))
+    return " ".join(words).capitalize() + "."
+
+
+def annot_data(rnd, annot_id, timestamp, spine_index, chapter_titles):
+    position = rnd.randint(1, 60)
+    start_cfi = f"/2/4/{2 * position}/1:{rnd.randint(0, 400)}"
+    data = {
+        "annot_id": annot_id,
+        "annot_type": "highlight",
+        "highlighted_text": " ".join(sentence(rnd, 6, 30) for _ in range(rnd.choice((1, 1, 1, 2, 3)))),
+        "pos": f"epubcfi(/{2 * spine_index + 2}{start_cfi})",
+        "pos_type": "epub",
+        "spine_index": spine_index,
+        "spine_name": f"text/part{spine_index:04d}.xhtml",
+        "start_cfi": start_cfi,
+        "end_cfi": f"/2/4/{2 * position}/1:{rnd.randint(401, 900)}",
+        "style": {"kind": "color", "type": "builtin", "which": rnd.choice(COLORS)},
+        "timestamp": datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="milliseconds"),
+        "toc_family_titles": chapter_titles,
+        "uuid": annot_id,
+    }
+    # About one in five highlights has a note; the viewer leaves the key out
+    # of the others.
+    if rnd.random() < 0.2:
+        data["notes"] = sentence(rnd, 3, 25)
+    return data
+
+
+def generate_library(directory, annotations, books=None, seed=0, years=5):
+    """Write metadata.db and state.json for a library of the given size.
+
+    Books are read one after another over the last years years, each in a run
+    of highlights, so every book has highlights and they are spread evenly
+    enough over time for every date to have a flashback. Returns the paths.
+    """
+    rnd = random.Random(seed)
+    books = min(books or max(3, min(annotations // 40, 5000)), annotations)
+    os.makedirs(directory, exist_ok=True)
+    db_path = os.path.join(directory, "metadata.db")
+    state_file = os.path.join(directory, "state.json")
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    titles = [f"{sentence(rnd, 1, 4)[:-1]} {book_id}" for book_id in range(1, books + 1)]
+    conn.executemany(
+        "INSERT INTO books (id, title, sort, author_sort, path, uuid) VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            (book_id, title, title, "Author, Synthetic", f"Synthetic Author/{title} ({book_id})", str(uuid.UUID(int=book_id)))
+            for book_id, title in enumerate(titles, 1)
+        ),
+    )
+
+    # Split the annotations into one run per book, each at least one long.
+    cuts = sorted(rnd.sample(range(1, annotations), books - 1)) if books > 1 else []
+    run_lengths = [end - start for start, end in zip([0, *cuts], [*cuts, annotations])]
+    reading_order = list(range(1, books + 1))
+    rnd.shuffle(reading_order)
+
+    now = time.time()
+    start = now - years * 365 * 86400
+    step = (now - start) / annotations
+
+    def rows():
+        annotation_id = 0
+        for book_id, length in zip(reading_order, run_lengths):
+            chapters = [f"Chapter {number}" for number in range(1, rnd.randint(5, 40))]
+            for _ in range(length):
+                annotation_id += 1
+                timestamp = start + (annotation_id - rnd.random()) * step
+                spine_index = rnd.randint(0, len(chapters))
+                chapter_titles = [chapters[min(spine_index, len(chapters) - 1)]]
+                if rnd.random() < 0.3:
+                    chapter_titles.insert(0, f"Part {spine_index // 10 + 1}")
+                annot_id = uuid.UUID(int=rnd.getrandbits(128)).hex
+                data = annot_data(rnd, annot_id, timestamp, spine_index, chapter_titles)
+                searchable = "\n".join(filter(None, (data["highlighted_text"], data.get("notes"))))
+                yield (
+                    annotation_id, book_id, "EPUB", "local", "viewer", timestamp,
+                    annot_id, "highlight", json.dumps(data), searchable,
+                )
+
+    conn.executemany(
+        """
+        INSERT INTO annotations
+            (id, book, format, user_type, user, timestamp, annot_id, annot_type, annot_data, searchable_text)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows(),
+    )
+    conn.commit()
+    conn.close()
+
+    # Roughly what a year or so of use looks like: a few percent favorited,
+    # a quarter read.
+    state = {}
+    for annotation_id in range(1, annotations + 1):
+        favorite = rnd.random() < 0.03
+        last_read = now - rnd.random() * 365 * 86400 if rnd.random() < 0.25 else None
+        if favorite or last_read:
+            state[str(annotation_id)] = {"favorite": favorite, "last_read": last_read}
+    for path in (state_file, f"{state_file}.journal", f"{state_file}.lock"):
+        if os.path.exists(path):
+            os.remove(path)
+    with open(state_file, "w") as f:
+        json.dump({"format": SNAPSHOT_FORMAT, "generation": 0, "annotations": state}, f)
+
+    return db_path, state_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--size", choices=SIZES, default="10k", type=str.lower)
+    parser.add_argument("--books", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    db_path, state_file = generate_library(args.directory, SIZES[args.size], args.books, args.seed)
+    print(f"{SIZES[args.size]} annotations in {db_path}, state in {state_file} "
+          f"({time.perf_counter() - started:.1f} s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Time building and updating related highlights, and looking them up.
+
+    python -m benchmarks.related --size 100k --added 100 --output related.json
+
+Against a synthetic library (see benchmarks.library) whose index is synced
+beforehand, a fresh process builds every highlight's neighbours from
+scratch, reporting the time, its peak memory over what it used before and
+the lookup time. Then --added highlights copied from others into another
+book are added to metadata.db, and a second process syncs and updates the
+neighbours of just those.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.library import SIZES, generate_library
+
+STEP = """
+import json, random, resource, sys, time
+from app import app
+library, step = sys.argv[1:]
+app.config.update(
+    DB_PATH=f"{library}/metadata.db",
+    STATE_FILE=f"{library}/state.json",
+    INDEX_PATH=f"{library}/capsule-index.db",
+)
+from app.db import get_calibre_pool
+from app.related import RelatedIndex, build_related, update_related
+from app.sidecar import get_sidecar
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+sidecar = get_sidecar(app.config["INDEX_PATH"])
+with app.app_context(), get_calibre_pool().connection() as calibre:
+    sidecar.sync(calibre)
+result = {}
+with sidecar.connect() as conn:
+    before = peak_mb()
+    started = time.perf_counter()
+    result["highlights"] = (build_related if step == "build" else update_related)(conn)
+    result["seconds"] = time.perf_counter() - started
+    result["peak_mb"] = peak_mb() - before
+    ids = [row[0] for row in conn.execute("SELECT id FROM annotations")]
+    lookups = random.Random(0).choices(ids, k=10_000)
+    started = time.perf_counter()
+    for annotation_id in lookups:
+        RelatedIndex.neighbours(conn, annotation_id)
+    result["lookup_us"] = (time.perf_counter() - started) / len(lookups) * 1e6
+    result["table_bytes"] = conn.execute(
+        "SELECT SUM(8 + LENGTH(neighbours) + LENGTH(scores)) FROM related"
+    ).fetchone()[0]
+print(json.dumps(result))
+"""
+
+
+def run_step(library, step):
+    output = subprocess.run(
+        [sys.executable, "-c", STEP, library, step],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def add_highlights(db_path, count, seed=0):
+    """Copy count random highlights into the book after theirs, as new
+    highlights."""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    books = [row[0] for row in conn.execute("SELECT id FROM books ORDER BY id")]
+    top = conn.execute("SELECT MAX(id) FROM annotations").fetchone()[0]
+    rows = conn.execute("SELECT id, book, annot_data FROM annotations").fetchall()
+    for offset, (_, book_id, data) in enumerate(rnd.sample(rows, count), 1):
+        other = books[(books.index(book_id) + 1) % len(books)]
+        conn.execute(
+            """
+            INSERT INTO annotations (id, book, format, user_type, user, timestamp, annot_id, annot_type, annot_data)
+            VALUES (?, ?, 'EPUB', 'local', 'viewer', ?, ?, 'highlight', ?)
+            """,
+            (top + offset, other, time.time(), f"copy-{top + offset}", data),
+        )
+    conn.commit()
+    conn.close()
+
+
+def report(name, result):
+    print(
+        f"{name:8} {result['highlights']:7} highlights in {result['seconds']:7.2f} s  "
+        f"peak +{result['peak_mb']:6.1f} MB  lookup {result['lookup_us']:5.1f} µs  "
+        f"table {result['table_bytes'] / 1024 / 1024:5.1f} MB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="10k", type=str.lower)
+    parser.add_argument("--library", help="use a copy of a library made by benchmarks.library")
+    parser.add_argument("--added", type=int, default=100)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as library:
+        if args.library:
+            for name in ("metadata.db", "state.json"):
+                with open(os.path.join(args.library, name), "rb") as src, open(os.path.join(library, name), "wb") as dst:
+                    dst.write(src.read())
+        else:
+            generate_library(library, SIZES[args.size])
+        results = {"build": run_step(library, "build")}
+        report("build", results["build"])
+        add_highlights(os.path.join(library, "metadata.db"), args.added)
+        results["update"] = run_step(library, "update")
+        report("update", results["update"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Latency, queries, state file reads and memory of every route.
+
+    python -m benchmarks.routes --size 10k --requests 200 --output after.json
+    python -m benchmarks.routes --compare before.json after.json
+
+Runs every route of the app against a synthetic library (see
+benchmarks.library) through Flask's test client. Queries are the SQL
+statements counted by app.metrics; state reads are opens of the state
+files. Peak RSS is the process peak after each route, so a route only shows
+growth if it needs more memory than every route before it.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from flask import url_for
+
+from app import app
+from app.metrics import statements_run
+from benchmarks.library import SIZES, generate_library
+
+# Query strings for routes that take them, by endpoint.
+QUERY_STRINGS = {
+    "focused_view": {"book_id": "{book_id}", "index": 3},
+    "focused_api": {"book_id": "{book_id}", "index": 3},
+    "apply_filters": {"read_filter": "off", "favorite_filter": "off"},
+}
+# The live feed never ends.
+SKIP_ENDPOINTS = {"static", "live_events"}
+
+
+class Counters:
+    def __init__(self, state_file):
+        self.state_prefix = os.path.abspath(state_file)
+        self.state_reads = 0
+
+    def audit(self, event, args):
+        if event == "open" and isinstance(args[0], (str, bytes)):
+            path = os.fsdecode(args[0])
+            if os.path.abspath(path).startswith(self.state_prefix):
+                self.state_reads += 1
+
+
+def sample_ids(db_path):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    # The book with the most highlights, and a highlight in the middle of it.
+    book_id, count = conn.execute(
+        "SELECT book, COUNT(*) FROM annotations GROUP BY book ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    annotation_id = conn.execute(
+        "SELECT id FROM annotations WHERE book = ? ORDER BY id LIMIT 1 OFFSET ?", (book_id, count // 2)
+    ).fetchone()[0]
+    conn.close()
+    return {"book_id": book_id, "annotation_id": annotation_id}
+
+
+def route_requests(app, ids):
+    """(name, method, url) for every route, with ids filled in."""
+    requests = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint in SKIP_ENDPOINTS:
+            continue
+        if any(argument not in ids for argument in rule.arguments):
+            print(f"skipping {rule.rule}: no sample value for {sorted(rule.arguments)}", file=sys.stderr)
+            continue
+        query = {key: str(value).format(**ids) for key, value in QUERY_STRINGS.get(rule.endpoint, {}).items()}
+        with app.test_request_context():
+            url = url_for(rule.endpoint, **{argument: ids[argument] for argument in rule.arguments}, **query)
+        for method in sorted(rule.methods - {"HEAD", "OPTIONS"}):
+            requests.append((f"{method} {rule.rule}", method, url))
+    return requests
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(library, requests_per_route, warmup):
+    db_path = os.path.join(library, "metadata.db")
+    state_file = os.path.join(library, "state.json")
+    app.config.update(
+        DB_PATH=db_path,
+        STATE_FILE=state_file,
+        INDEX_PATH=os.path.join(library, "capsule-index.db"),
+    )
+
+    started = time.perf_counter()
+    client = app.test_client()
+    with client.get("/books") as response:
+        response.get_data()
+    startup = time.perf_counter() - started
+
+    counters = Counters(state_file)
+    sys.addaudithook(counters.audit)
+    ids = sample_ids(db_path)
+    routes = {}
+    for name, method, url in route_requests(app, ids):
+        for _ in range(warmup):
+            with client.open(url, method=method) as response:
+                response.get_data()
+
+        queries, state_reads = statements_run(), counters.state_reads
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        latencies = []
+        for _ in range(requests_per_route):
+            start = time.perf_counter()
+            with client.open(url, method=method) as response:
+                response.get_data()
+            latencies.append(time.perf_counter() - start)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        routes[name] = {
+            "url": url,
+            "status": response.status_code,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "mean_ms": statistics.fmean(latencies) * 1000,
+            "queries_per_request": (statements_run() - queries) / requests_per_route,
+            "state_reads_per_request": (counters.state_reads - state_reads) / requests_per_route,
+            "peak_rss_kib": rss_after,
+            "peak_rss_growth_kib": rss_after - rss_before,
+        }
+        print(
+            f"{name:45} {response.status_code} p50 {routes[name]['p50_ms']:8.2f} ms  "
+            f"p99 {routes[name]['p99_ms']:8.2f} ms  queries {routes[name]['queries_per_request']:6.1f}  "
+            f"state reads {routes[name]['state_reads_per_request']:5.1f}"
+        )
+
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        annotations = conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+        books = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+    return {
+        "library": {"annotations": annotations, "books": books},
+        "requests_per_route": requests_per_route,
+        "startup_s": startup,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "routes": routes,
+    }
+
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    print(f"{'route':45} {'p50 ms':>19} {'p99 ms':>19} {'queries':>13}")
+    for name, new in after["routes"].items():
+        old = before["routes"].get(name)
+        if old is None:
+            print(f"{name:45} (new)")
+            continue
+        print(
+            f"{name:45} {old['p50_ms']:8.2f} -> {new['p50_ms']:8.2f} {old['p99_ms']:8.2f} -> {new['p99_ms']:8.2f} "
+            f"{old['queries_per_request']:5.1f} -> {new['queries_per_request']:5.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=SIZES, default="10k", type=str.lower)
+    parser.add_argument("--library", help="reuse a library made by benchmarks.library")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        library = args.library
+        if library is None:
+            library = tmp
+            generate_library(library, SIZES[args.size])
+        results = run(library, args.requests, args.warmup)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Write throughput of the journaled state store vs. whole-file rewrites.
+
+    python -m benchmarks.state_writes --annotations 20000 --writes 2000 --threads 8
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from app.state import StateStore
+
+
+def make_state(annotations):
+    return {
+        str(i): {"favorite": i % 13 == 0, "last_read": time.time() if i % 3 == 0 else None}
+        for i in range(1, annotations + 1)
+    }
+
+
+def rewrite_writes(path, annotations, writes, threads):
+    # What save_state used to do: read, modify and rewrite the whole file.
+    lock = threading.Lock()
+
+    def worker(count):
+        for _ in range(count):
+            with lock:
+                with open(path) as f:
+                    state = json.load(f)
+                state[str(random.randint(1, annotations))]["last_read"] = time.time()
+                with open(path, "w") as f:
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    return run_threads(worker, writes, threads)
+
+
+def journal_writes(path, annotations, writes, threads):
+    store = StateStore(path, compact_after=writes * 2)
+
+    def worker(count):
+        for _ in range(count):
+            store.set(random.randint(1, annotations), last_read=time.time())
+
+    elapsed = run_threads(worker, writes, threads)
+    compact_start = time.perf_counter()
+    store.compact()
+    compact_time = time.perf_counter() - compact_start
+    store.close()
+    return elapsed, compact_time
+
+
+def run_threads(worker, writes, threads):
+    per_thread = writes // threads
+    pool = [threading.Thread(target=worker, args=(per_thread,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--annotations", type=int, default=20000)
+    parser.add_argument("--writes", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    state = make_state(args.annotations)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("rewrite", "journal"):
+            with open(os.path.join(tmp, f"{name}.json"), "w") as f:
+                json.dump(state, f)
+        size = os.path.getsize(os.path.join(tmp, "rewrite.json"))
+        print(f"{args.annotations} annotations, state file {size / 1024:.0f} KiB, "
+              f"{args.writes} writes on {args.threads} threads")
+
+        elapsed = rewrite_writes(os.path.join(tmp, "rewrite.json"), args.annotations, args.writes, args.threads)
+        print(f"rewrite: {args.writes / elapsed:8.0f} writes/s")
+
+        elapsed, compact_time = journal_writes(
+            os.path.join(tmp, "journal.json"), args.annotations, args.writes, args.threads
+        )
+        print(f"journal: {args.writes / elapsed:8.0f} writes/s (compaction {compact_time * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
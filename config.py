@@ -5,4 +5,47 @@ class Config:
     DEFAULT_DB_PATH = os.path.join(os.path.expanduser("~"), "R", "books", "metadata.db")
     DB_PATH = os.getenv("BOOKS_DB_PATH", DEFAULT_DB_PATH)
     STATE_FILE = os.getenv("HIGHLIGHTS_STATE_FILE", "state.json")
-    SECRET_KEY = os.getenv("SECRET_KEY", "secret")
\ No newline at end of file
+    SECRET_KEY = os.getenv("SECRET_KEY", "secret")
+    STATE_COMPACT_AFTER = int(os.getenv("HIGHLIGHTS_STATE_COMPACT_AFTER", 1000))
+    INDEX_PATH = os.getenv("HIGHLIGHTS_INDEX_PATH", "capsule-index.db")
+    # More Calibre libraries to serve, each under its own URL prefix, as
+    # name=path/to/metadata.db pairs separated by commas: "kids=/srv/kids/metadata.db"
+    # serves that library at /kids/. Their state files and indexes are kept
+    # in LIBRARY_DIR/<name>/.
+    LIBRARIES = dict(
+        pair.strip().split("=", 1) for pair in os.getenv("HIGHLIGHTS_LIBRARIES", "").split(",") if pair.strip()
+    )
+    LIBRARY_DIR = os.getenv("HIGHLIGHTS_LIBRARY_DIR", "libraries")
+    # Roughly how much memory the libraries' highlights and state may take;
+    # past it, the least recently used libraries that aren't serving a
+    # request are unloaded until they are asked for again. 0 keeps them all.
+    LIBRARY_MEMORY_BUDGET = int(os.getenv("HIGHLIGHTS_LIBRARY_MEMORY_BUDGET", 1024 * 1024 * 1024))
+    # Highlights shown on the book and notes pages before a "Load more"
+    # button; 0 streams every highlight in one page.
+    PAGE_SIZE = int(os.getenv("HIGHLIGHTS_PAGE_SIZE", 0))
+    # How many days either side of today's date count as "on this day" for
+    # flashbacks.
+    FLASHBACK_DAYS = int(os.getenv("HIGHLIGHTS_FLASHBACK_DAYS", 10))
+    # Seconds between checks of metadata.db for new highlights to push to
+    # open pages.
+    LIVE_POLL_INTERVAL = float(os.getenv("HIGHLIGHTS_LIVE_POLL_INTERVAL", 2))
+    # How much more likely a favorite is to resurface than another highlight
+    # left unread as long.
+    RESURFACE_FAVORITE_WEIGHT = float(os.getenv("HIGHLIGHTS_RESURFACE_FAVORITE_WEIGHT", 1))
+    # Highlights from other books shown as related to a highlight.
+    RELATED_COUNT = int(os.getenv("HIGHLIGHTS_RELATED_COUNT", 3))
+    # Memory for rendered highlights kept to build pages from.
+    FRAGMENT_CACHE_BYTES = int(os.getenv("HIGHLIGHTS_FRAGMENT_CACHE_BYTES", 64 * 1024 * 1024))
+    # Tuning for the pooled read-only connections to metadata.db. A negative
+    # cache size is in KiB. CALIBRE_IMMUTABLE skips SQLite's locking entirely
+    # and reopens connections when the file changes instead; only use it if
+    # the library isn't in WAL mode.
+    CALIBRE_MMAP_SIZE = int(os.getenv("CALIBRE_MMAP_SIZE", 256 * 1024 * 1024))
+    CALIBRE_CACHE_SIZE = int(os.getenv("CALIBRE_CACHE_SIZE", -16000))
+    CALIBRE_QUERY_ONLY = os.getenv("CALIBRE_QUERY_ONLY", "1") == "1"
+    CALIBRE_IMMUTABLE = os.getenv("CALIBRE_IMMUTABLE", "0") == "1"
+    # Profile the views of requests with cProfile and save the profiles of
+    # those slower than this many seconds to PROFILE_DIR. 0 turns profiling
+    # off.
+    PROFILE_SLOW_REQUESTS = float(os.getenv("HIGHLIGHTS_PROFILE_SLOW_REQUESTS", 0))
+    PROFILE_DIR = os.getenv("HIGHLIGHTS_PROFILE_DIR", "profiles")
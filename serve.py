@@ -0,0 +1,80 @@
+"""Run Capsule with several worker processes sharing one port.
+
+    python3 serve.py --workers 4 --port 8000
+
+Workers map the snapshot of the library saved next to the index rather
+than each loading their own copy, and only the first of them to notice a
+change in Calibre's database rebuilds it; the others then switch to the
+new file. Workers that die are replaced.
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+from app import app
+
+
+def run_worker(host, port, sock):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+
+def serve(host, port, workers):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.create_server((host, port), family=family, backlog=128)
+    print(f"Serving on {host}:{port} with {workers} workers", file=sys.stderr)
+    if workers == 1 or not hasattr(os, "fork"):
+        run_worker(host, port, sock)
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(host, port, sock)
+            finally:
+                os._exit(1)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited ({status}), starting another", file=sys.stderr)
+            time.sleep(1)
+            spawn()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    serve(args.host, args.port, max(1, args.workers))
+
+
+if __name__ == "__main__":
+    main()
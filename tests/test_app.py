@@ -1,17 +1,58 @@
+import csv
+import gzip
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from app import app
+from app import app, metrics
+from config import Config
 from app.models import (
     get_random_annotations,
     get_books_with_annotations,
     get_book_annotations,
     get_favorited_annotations,
-    get_all_annotations,
     get_recent_books,
-    get_flashback_annotations
+    get_flashback_annotations,
+    get_snapshot,
+    get_focused_annotations,
+    stream_book_annotations,
 )
-from app.utils import is_favorite, toggle_favorite, load_favorites
+from app.db import release_pool
+from app.fragments import FragmentCache
+from app.libraries import ENVIRON_KEY, get_libraries
+from app.related import get_related_index, tokenize
+from app.review import DAY
+from app.sampling import LinearFenwickTree, StateBuckets
+from app.sidecar import SCHEMA_VERSION, Sidecar, get_sidecar, release_sidecar
+from app.snapshot import Snapshot, SnapshotManager
+from app.state import StateStore, get_state_store, read_snapshot
+from app.utils import fts_query, generate_calibre_url, get_annotation_states, is_favorite, toggle_favorite, load_state
+from benchmarks.library import generate_library
 import json
 
+# Book 2 of the generated library; every generated book has highlights.
+BOOK_ID = 2
+
+
+def setUpModule():
+    global library
+    library = tempfile.TemporaryDirectory()
+    db_path, state_file = generate_library(library.name, 1000)
+    app.config.update(
+        DB_PATH=db_path,
+        STATE_FILE=state_file,
+        INDEX_PATH=os.path.join(library.name, "capsule-index.db"),
+    )
+
+
+def tearDownModule():
+    library.cleanup()
+
+
 class TestApp(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
@@ -30,18 +71,120 @@ class TestApp(unittest.TestCase):
         self.assertIn(b'All books with highlights', response.data)
 
     def test_book_annotations_route(self):
-        # Assuming there's at least one book with ID 1
-        response = self.client.get('/book/55')
+        response = self.client.get(f'/book/{BOOK_ID}')
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'focus', response.data)
 
+    def test_book_annotations_api_route(self):
+        response = self.client.get(f'/api/book/{BOOK_ID}?limit=2')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertTrue(len(data['annotations']) <= 2)
+        if data['next']:
+            response = self.client.get(f'/api/book/{BOOK_ID}', query_string={'after': data['next'], 'limit': 2})
+            self.assertEqual(response.status_code, 200)
+
     def test_toggle_favorite_route(self):
-        # Assuming there's an annotation with ID 1
         response = self.client.post('/toggle_favorite/1')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         self.assertIn('success', data)
 
+    def test_state_batch_route(self):
+        with app.app_context():
+            toggled = is_favorite(12)
+        response = self.client.post('/api/state', json={'operations': [
+            {'op': 'favorite', 'id': 11}, {'op': 'read', 'id': 11},
+            {'op': 'toggle_favorite', 'id': 12}, {'op': 'toggle_favorite', 'id': 12}, {'op': 'toggle_favorite', 'id': 12},
+            {'op': 'favorite', 'id': 13}, {'op': 'unfavorite', 'id': 13},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        states = json.loads(response.data)['states']
+        self.assertEqual(sorted(states), ['11', '12', '13'])
+        self.assertTrue(states['11']['is_favorite'])
+        self.assertIsNotNone(states['11']['last_read'])
+        self.assertEqual(states['12']['is_favorite'], not toggled)
+        self.assertFalse(states['13']['is_favorite'])
+
+        # A bad operation rejects the whole batch.
+        response = self.client.post('/api/state', json={'operations': [{'op': 'unfavorite', 'id': 11}, {'op': 'star', 'id': 11}]})
+        self.assertEqual(response.status_code, 400)
+        with app.app_context():
+            self.assertTrue(is_favorite(11))
+
+    def test_mark_read_routes(self):
+        book_id = BOOK_ID + 1
+        response = self.client.post(f'/book/{book_id}/mark_read')
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            book_data = get_book_annotations(book_id)
+            self.assertEqual(json.loads(response.data)['count'], len(book_data['annotations']))
+            self.assertTrue(all(annotation['last_read'] for annotation in book_data['annotations']))
+        self.assertEqual(self.client.post('/book/999999/mark_read').status_code, 404)
+
+        with self.client.session_transaction() as session:
+            session['favorite_filter'] = True
+        try:
+            response = self.client.post('/mark_read')
+        finally:
+            with self.client.session_transaction() as session:
+                session.pop('favorite_filter')
+        with app.app_context():
+            favorites = [a for book in get_favorited_annotations().values() for a in book['annotations']]
+        self.assertEqual(json.loads(response.data)['count'], len(favorites))
+        self.assertTrue(all(annotation['last_read'] for annotation in favorites))
+
+    def test_conditional_get(self):
+        for path in ['/books', '/flashback', f'/book/{BOOK_ID}', '/favorites', '/highlights_with_notes', '/search?q=the']:
+            with self.client.get(path) as response:
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+            self.assertEqual('Cookie' in response.vary, path not in ('/books', '/flashback', '/favorites'))
+            again = self.client.get(path, headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.data, b'')
+            self.assertEqual(again.headers['ETag'], response.headers['ETag'])
+        for path in ['/', '/review', f'/focused?book_id={BOOK_ID}&index=0']:
+            with self.client.get(path) as response:
+                self.assertEqual(response.headers['Cache-Control'], 'no-store')
+            self.assertNotIn('ETag', response.headers)
+
+        # A state change or other session filters give another ETag.
+        with self.client.get(f'/book/{BOOK_ID}') as response:
+            etag = response.headers['ETag']
+        with self.client.session_transaction() as session:
+            session['favorite_filter'] = True
+        try:
+            with self.client.get(f'/book/{BOOK_ID}', headers={'If-None-Match': etag}) as response:
+                self.assertEqual(response.status_code, 200)
+        finally:
+            with self.client.session_transaction() as session:
+                session.pop('favorite_filter')
+        self.client.post('/toggle_favorite/22')
+        try:
+            with self.client.get(f'/book/{BOOK_ID}', headers={'If-None-Match': etag}) as response:
+                self.assertEqual(response.status_code, 200)
+        finally:
+            self.client.post('/toggle_favorite/22')
+
+    def test_conditional_get_after_change_in_same_second(self):
+        with app.app_context():
+            store = get_state_store()
+        paths = [app.config['DB_PATH'], store.snapshot_file, store.journal_file]
+        second = 1_700_000_000
+        for path in paths:
+            os.utime(path, (second, second))
+        first = self.client.get('/favorites')
+        self.client.post('/toggle_favorite/21')
+        os.utime(store.journal_file, (second + 0.5, second + 0.5))
+        try:
+            response = self.client.get('/favorites', headers={'If-Modified-Since': first.headers['Last-Modified']})
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get('/favorites', headers={'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+        finally:
+            self.client.post('/toggle_favorite/21')
+
     def test_favorites_route(self):
         response = self.client.get('/favorites')
         self.assertEqual(response.status_code, 200)
@@ -49,14 +192,752 @@ class TestApp(unittest.TestCase):
 
     def test_focused_view_route(self):
         # Test with book_id
-        response = self.client.get('/focused?book_id=55&index=0')
+        response = self.client.get(f'/focused?book_id={BOOK_ID}&index=0')
         self.assertEqual(response.status_code, 200)
-        self.assertIn(b'Next >', response.data)
+        self.assertIn(b'id="next-link"', response.data)
 
         # Test without book_id
         response = self.client.get('/focused?index=0')
         self.assertEqual(response.status_code, 200)
-        self.assertIn(b'Next >', response.data)
+        self.assertIn(b'id="next-link"', response.data)
+
+    def test_state_filters_in_sql(self):
+        with app.app_context():
+            store = get_state_store()
+            book_ids = [annotation['id'] for annotation in get_book_annotations(BOOK_ID)['annotations']]
+            first = book_ids[0]
+            original = dict(store.get(first))
+            for favorite, last_read in ((True, None), (False, 2.0), (True, 3.0), (False, None)):
+                # Changes show up in the next query.
+                store.set(first, favorite=favorite, last_read=last_read)
+                entries = store.entries()
+                for favorite_filter in (None, True, False):
+                    for read_filter in (None, True, False):
+                        expected = [
+                            annotation_id for annotation_id in book_ids
+                            if favorite_filter in (None, bool(entries.get(str(annotation_id), {}).get('favorite')))
+                            and read_filter in (None, bool(entries.get(str(annotation_id), {}).get('last_read')))
+                        ]
+                        found = stream_book_annotations(BOOK_ID, favorite_filter, read_filter)['annotations']
+                        self.assertEqual([annotation['id'] for annotation in found], expected)
+            store.set(first, **original)
+
+    def test_focused_positions(self):
+        with app.app_context():
+            snapshot = get_snapshot()
+            recent_ids = [snapshot.ids[row] for row in snapshot.recent_order]
+            book_ids = [snapshot.ids[row] for row in snapshot.book_rows(BOOK_ID)]
+            for index in (0, 1, len(recent_ids) // 2, len(recent_ids) - 1):
+                focused = get_focused_annotations(annotation_id=recent_ids[index])
+                self.assertEqual((focused['index'], focused['total']), (index, len(recent_ids)))
+                self.assertEqual(focused['annotation']['id'], recent_ids[index])
+                self.assertEqual(focused['previous'] and focused['previous']['id'], recent_ids[index - 1] if index else None)
+                self.assertEqual(
+                    focused['next'] and focused['next']['id'],
+                    recent_ids[index + 1] if index + 1 < len(recent_ids) else None,
+                )
+            for index, annotation_id in enumerate(book_ids):
+                focused = get_focused_annotations(BOOK_ID, annotation_id)
+                self.assertEqual(focused['index'], index)
+                self.assertEqual(get_focused_annotations(BOOK_ID, index=index)['annotation']['id'], annotation_id)
+            # Out of range indexes are clamped, and a highlight of another
+            # book starts the book from the top.
+            self.assertEqual(get_focused_annotations(index=-5)['index'], 0)
+            self.assertEqual(get_focused_annotations(index=10**6)['index'], len(recent_ids) - 1)
+            other = next(i for i in recent_ids if i not in book_ids)
+            self.assertEqual(get_focused_annotations(BOOK_ID, other)['index'], 0)
+            self.assertIsNone(get_focused_annotations(999999))
+
+    def test_focused_api_route(self):
+        response = self.client.get(f'/api/focused?book_id={BOOK_ID}&index=1')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['index'], 1)
+        self.assertEqual(data['book_id'], BOOK_ID)
+        for key in ('annotation', 'previous'):
+            self.assertIn(f'data-annotation-id="{data[key]["id"]}"', data[key]['html'])
+        response = self.client.get('/api/focused', query_string={'annotation_id': data['annotation']['id']})
+        self.assertEqual(response.get_json()['annotation']['id'], data['annotation']['id'])
+        self.assertEqual(self.client.get('/api/focused?book_id=999999').status_code, 404)
+
+    def test_sampling_uniform_under_filters(self):
+        rows = [
+            {'id': i, 'book_id': i % 3, 'title': f'Book {i % 3}', 'text': 'text', 'notes': None, 'spine_index': 0,
+             'start_cfi': '/2', 'chapter': None, 'timestamp': 1_600_000_000 + i}
+            for i in range(1, 21)
+        ]
+        snapshot = Snapshot(1, rows)
+        entries = {str(i): {'favorite': i <= 5, 'last_read': 1.0 if 3 <= i <= 10 else None} for i in range(1, 21)}
+        buckets = StateBuckets(snapshot, entries)
+        random.seed(0)
+
+        def counts(favorite_filter, read_filter, draws=10_000):
+            found = {}
+            for _ in range(draws):
+                annotation_id = snapshot.ids[buckets.sample(favorite_filter, read_filter, 1)[0]]
+                found[annotation_id] = found.get(annotation_id, 0) + 1
+            return found
+
+        for (favorite_filter, read_filter), expected in (
+            ((True, None), {1, 2, 3, 4, 5}),
+            ((None, False), {1, 2} | set(range(11, 21))),
+            ((False, True), set(range(6, 11))),
+        ):
+            found = counts(favorite_filter, read_filter)
+            self.assertEqual(set(found), expected)
+            mean = 10_000 / len(expected)
+            for count in found.values():
+                self.assertLess(abs(count - mean), 0.15 * mean)
+
+        # A state change moves the highlight between buckets.
+        buckets.update('1', {'favorite': False, 'last_read': None})
+        self.assertEqual(set(counts(True, None, 1000)), {2, 3, 4, 5})
+        self.assertEqual(len(set(buckets.sample(None, None, 20))), 20)
+
+    def test_resurfacing(self):
+        response = self.client.get('/apply_filters?read_filter=off&favorite_filter=off&pick=resurface')
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count(b'highlight" data-annotation-id='), 3)
+        response = self.client.get(f'/focused?book_id={BOOK_ID}&random=1')
+        self.assertEqual(response.status_code, 200)
+
+        tree = LinearFenwickTree(5)
+        for position, (slope, offset) in enumerate([(1, 0), (0, 0), (2, 10), (1, 5), (1, 0)]):
+            tree.slopes[position + 1] = slope
+            tree.offsets[position + 1] = offset
+        tree.finish()
+        # Weights at now=10: 10, 0, 10, 5, 10.
+        self.assertEqual(tree.weight(0, 5, 10), 35)
+        self.assertEqual(tree.weight(1, 4, 10), 15)
+        self.assertEqual([tree.search(target, 10) for target in (0, 9.9, 10, 19.9, 20, 34.9)], [0, 0, 2, 2, 3, 4])
+        tree.add(2, -2, -10)
+        self.assertEqual(tree.search(10, 10), 3)
+
+    def test_review_routes(self):
+        response = self.client.get('/review')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Learn new highlights', response.data)
+
+        review = self.client.get('/api/review?new=1').get_json()
+        self.assertTrue(review['new'])
+        annotation_id = review['annotation']['id']
+        response = self.client.post(f'/api/review/{annotation_id}', json={'grade': 'good'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['interval'], 1)
+
+        review = self.client.get('/api/review').get_json()
+        self.assertIsNone(review['annotation'])
+        self.assertEqual(review['scheduled'], 1)
+        self.assertAlmostEqual(review['next_due'], response.get_json()['last_read'] + DAY, delta=1)
+        # Graded highlights are no longer new.
+        self.assertNotEqual(self.client.get('/api/review?new=1').get_json()['annotation']['id'], annotation_id)
+
+        response = self.client.post(f'/review/{annotation_id}', data={'grade': 'later'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_related_highlights(self):
+        with app.app_context():
+            get_snapshot()
+        sidecar = get_sidecar(app.config['INDEX_PATH'])
+        get_related_index(sidecar).update()
+        with sidecar.connect() as conn:
+            annotation_id, book_id = conn.execute('SELECT id, book_id FROM annotations LIMIT 1').fetchone()
+
+        response = self.client.get(f'/api/related/{annotation_id}')
+        self.assertEqual(response.status_code, 200)
+        related = response.get_json()['annotations']
+        self.assertTrue(0 < len(related) <= app.config['RELATED_COUNT'])
+        self.assertNotIn(book_id, [annotation['book_id'] for annotation in related])
+        self.assertEqual(self.client.get('/api/related/999999').status_code, 404)
+        response = self.client.get(f'/focused?annotation_id={annotation_id}')
+        self.assertIn(b'Related highlights', response.data)
+        self.assertEqual(tokenize('Café-au_lait, 2x'), ['cafe', 'au', 'lait', '2x'])
+
+    def test_book_stats_triggers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path, _ = generate_library(directory, 100, seed=2)
+            sidecar = Sidecar(os.path.join(directory, 'capsule-index.db'))
+            calibre = sqlite3.connect(db_path, isolation_level=None)
+            calibre.row_factory = sqlite3.Row
+
+            def check():
+                sidecar.sync(calibre)
+                with sidecar.connect() as conn:
+                    expected = conn.execute(
+                        """
+                        SELECT book_id, title, COUNT(*), MAX(timestamp) FROM annotations
+                        GROUP BY book_id ORDER BY book_id
+                        """
+                    ).fetchall()
+                    stats = conn.execute(
+                        "SELECT book_id, title, annotation_count, latest_annotation FROM book_stats ORDER BY book_id"
+                    ).fetchall()
+                self.assertEqual([tuple(row) for row in stats], [tuple(row) for row in expected])
+
+            check()
+            books = [row[0] for row in calibre.execute('SELECT id FROM books ORDER BY id')]
+            top = calibre.execute('SELECT MAX(id) FROM annotations').fetchone()[0]
+            # Insert, newest in its book.
+            calibre.execute(
+                """
+                INSERT INTO annotations (id, book, format, user_type, user, timestamp, annot_id, annot_type, annot_data)
+                SELECT ?, book, format, user_type, user, timestamp + 1e8, 'new', annot_type, annot_data
+                FROM annotations WHERE id = 1
+                """,
+                (top + 1,),
+            )
+            check()
+            # Update: edited, and moved to another book.
+            calibre.execute('UPDATE annotations SET timestamp = timestamp + 1 WHERE id = 2')
+            calibre.execute('UPDATE annotations SET book = ?, timestamp = timestamp + 2 WHERE id = 3', (books[-1],))
+            check()
+            # Delete, including the newest of a book and every highlight of another.
+            calibre.execute('DELETE FROM annotations WHERE id = ?', (top + 1,))
+            calibre.execute('DELETE FROM annotations WHERE book = ?', (books[0],))
+            check()
+            # Rename a book.
+            calibre.execute("UPDATE books SET title = 'Renamed' WHERE id = ?", (books[1],))
+            check()
+            with sidecar.connect() as conn:
+                self.assertEqual(
+                    conn.execute('SELECT title FROM book_stats WHERE book_id = ?', (books[1],)).fetchone()[0], 'Renamed'
+                )
+                self.assertIsNone(conn.execute('SELECT 1 FROM book_stats WHERE book_id = ?', (books[0],)).fetchone())
+            calibre.close()
+            release_sidecar(sidecar.path)
+            release_pool(sidecar.path)
+
+
+    def test_sidecar_incremental_sync(self):
+        columns = 'id, book_id, title, text, notes, spine_index, start_cfi, chapter, timestamp, has_notes'
+
+        def indexed(sidecar):
+            with sidecar.connect() as conn:
+                return [tuple(row) for row in conn.execute(f'SELECT {columns} FROM annotations ORDER BY id')]
+
+        with tempfile.TemporaryDirectory() as directory:
+            db_path, _ = generate_library(directory, 100, seed=5)
+            calibre = sqlite3.connect(db_path, isolation_level=None)
+            calibre.row_factory = sqlite3.Row
+            sidecar = Sidecar(os.path.join(directory, 'capsule-index.db'))
+            highlights = [row[0] for row in calibre.execute(
+                "SELECT id FROM annotations WHERE JSON_EXTRACT(annot_data, '$.highlighted_text') != '' ORDER BY id"
+            )]
+            self.assertEqual(sidecar.sync(calibre), {'added': highlights, 'changed': [], 'deleted': []})
+            self.assertIsNone(sidecar.sync(calibre))
+
+            book_id = calibre.execute('SELECT book FROM annotations WHERE id = ?', (highlights[2],)).fetchone()[0]
+            calibre.execute(
+                "UPDATE annotations SET annot_data = JSON_SET(annot_data, '$.highlighted_text', 'edited'), "
+                "timestamp = timestamp + 1 WHERE id = ?",
+                (highlights[0],),
+            )
+            calibre.execute(
+                "UPDATE annotations SET annot_data = JSON_SET(annot_data, '$.highlighted_text', ''), "
+                "timestamp = timestamp + 1 WHERE id = ?",
+                (highlights[1],),
+            )
+            calibre.execute('DELETE FROM annotations WHERE id = ?', (highlights[3],))
+            calibre.execute("UPDATE books SET title = 'Renamed' WHERE id = ?", (book_id,))
+            of_book = [row[0] for row in calibre.execute(
+                'SELECT id FROM annotations WHERE book = ? AND id IN ({})'.format(','.join('?' * len(highlights))),
+                (book_id, *highlights),
+            )]
+            delta = sidecar.sync(calibre)
+            self.assertEqual(delta['added'], [])
+            self.assertEqual(delta['changed'], sorted({highlights[0], *of_book} - {highlights[1], highlights[3]}))
+            self.assertEqual(sorted(delta['deleted']), sorted([highlights[1], highlights[3]]))
+            with sidecar.connect() as conn:
+                self.assertEqual(
+                    conn.execute('SELECT text FROM annotations WHERE id = ?', (highlights[0],)).fetchone()[0], 'edited'
+                )
+
+            # The same as syncing from scratch.
+            fresh = Sidecar(os.path.join(directory, 'fresh-index.db'))
+            fresh.sync(calibre)
+            self.assertEqual(indexed(sidecar), indexed(fresh))
+
+            # An index from another schema version is rebuilt.
+            with sidecar.connect() as conn:
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION - 1}')
+            rebuilt = Sidecar(sidecar.path)
+            self.assertEqual(indexed(rebuilt), [])
+            self.assertEqual(sorted(rebuilt.sync(calibre)['added']), [row[0] for row in indexed(fresh)])
+            self.assertEqual(indexed(rebuilt), indexed(fresh))
+
+            calibre.close()
+            for path in (sidecar.path, fresh.path):
+                release_sidecar(path)
+                release_pool(path)
+
+    def test_edit_queued_for_related(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path, _ = generate_library(directory, 50, seed=3)
+            sidecar = Sidecar(os.path.join(directory, 'capsule-index.db'))
+            calibre = sqlite3.connect(db_path, isolation_level=None)
+            calibre.row_factory = sqlite3.Row
+            sidecar.sync(calibre)
+            # Still queued from being added when it is edited.
+            with sidecar.connect() as conn:
+                version = sidecar.sync_version(conn)
+            calibre.execute(
+                "UPDATE annotations SET annot_data = JSON_SET(annot_data, '$.notes', 'edited'), "
+                "timestamp = timestamp + 1 WHERE id = 1"
+            )
+            self.assertEqual(sidecar.sync(calibre)['changed'], [1])
+            with sidecar.connect() as conn:
+                self.assertEqual(conn.execute('SELECT version FROM related_stale WHERE id = 1').fetchone()[0], version)
+            calibre.close()
+            release_sidecar(sidecar.path)
+            release_pool(sidecar.path)
+
+    def test_libraries(self):
+        db_path, state_file = generate_library(os.path.join(library.name, 'second'), 200, seed=1)
+        app.config.update(LIBRARIES={'second': db_path}, LIBRARY_DIR=library.name)
+        try:
+            with self.client.get('/second/books') as response:
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(b'href="/second/book/', response.data)
+            with app.test_request_context(environ_base={ENVIRON_KEY: 'second'}):
+                self.assertEqual(len(get_snapshot()), 200)
+                self.assertTrue(generate_calibre_url(2, 0, '/4').startswith('calibre://view-book/second/2/'))
+            with app.app_context():
+                self.assertEqual(len(get_snapshot()), 1000)
+                # The default library's links keep their old id.
+                self.assertTrue(generate_calibre_url(2, 0, '/4').startswith('calibre://view-book/books/2/'))
+
+            with self.client.post('/second/toggle_favorite/7'):
+                pass
+            with app.test_request_context(environ_base={ENVIRON_KEY: 'second'}):
+                second_favorite = is_favorite(7)
+            with app.app_context():
+                self.assertNotEqual(is_favorite(7), second_favorite)
+            with self.client.post('/second/toggle_favorite/7'):
+                pass
+
+            # Over budget, the library used longest ago is unloaded, then
+            # loaded again when asked for. An open event stream doesn't keep
+            # it loaded, and ends when it is unloaded.
+            events = self.client.get('/second/events')
+            chunks = events.response
+            self.assertEqual(next(chunks), b'retry: 5000\n\n')
+            app.config['LIBRARY_MEMORY_BUDGET'] = 1
+            with self.client.get('/books') as response:
+                response.get_data()
+            self.assertEqual(app.wsgi_app.loaded(), [None])
+            self.assertEqual(b''.join(chunks), b'retry: 60000\n\n')
+            events.close()
+            with self.client.get('/second/book/2') as response:
+                self.assertEqual(response.status_code, 200)
+        finally:
+            app.config.update(LIBRARIES={}, LIBRARY_MEMORY_BUDGET=Config.LIBRARY_MEMORY_BUDGET)
+
+    def test_unload_outside_dispatcher_lock(self):
+        db_path, _ = generate_library(os.path.join(library.name, 'third'), 50, seed=4)
+        app.config.update(LIBRARIES={'third': db_path}, LIBRARY_DIR=library.name)
+        dispatcher = app.wsgi_app
+        unload = dispatcher.unload
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_unload(library):
+            started.set()
+            finish.wait(10)
+            unload(library)
+
+        def evict():
+            with self.client.get('/books') as response:
+                response.get_data()
+
+        dispatcher.unload = slow_unload
+        try:
+            with self.client.get('/third/books') as response:
+                response.get_data()
+            app.config['LIBRARY_MEMORY_BUDGET'] = 1
+            thread = threading.Thread(target=evict)
+            thread.start()
+            self.assertTrue(started.wait(10))
+            # Other libraries are served while third is being unloaded.
+            other = threading.Thread(target=lambda: self.client.get(f'/book/{BOOK_ID}').close())
+            other.start()
+            other.join(5)
+            self.assertFalse(other.is_alive())
+            self.assertEqual(dispatcher.loaded(), [None])
+            finish.set()
+            thread.join()
+        finally:
+            finish.set()
+            dispatcher.unload = unload
+            app.config.update(LIBRARIES={}, LIBRARY_MEMORY_BUDGET=Config.LIBRARY_MEMORY_BUDGET)
+
+    def test_snapshot_manager_stop_waits_for_rebuild(self):
+        loading, finish = threading.Event(), threading.Event()
+
+        def loader(previous):
+            loading.set()
+            finish.wait(10)
+            return previous
+
+        manager = SnapshotManager(app.config['DB_PATH'], loader)
+        manager.rebuild_in_background(None)
+        self.assertTrue(loading.wait(10))
+        stopper = threading.Thread(target=manager.stop)
+        stopper.start()
+        stopper.join(0.2)
+        self.assertTrue(stopper.is_alive())
+        finish.set()
+        stopper.join(10)
+        self.assertFalse(stopper.is_alive())
+        # A stopped manager doesn't start another.
+        loading.clear()
+        manager.rebuild_in_background(None)
+        self.assertFalse(loading.wait(0.2))
+
+    def test_connections_reused_across_threads(self):
+        # The threaded server runs each request on a thread of its own.
+        def get():
+            with self.client.get(f'/book/{BOOK_ID}') as response:
+                response.get_data()
+
+        get()
+        before = {stats['db_path']: stats['opened'] for stats in self.client.get('/stats/db').get_json()}
+        for _ in range(10):
+            thread = threading.Thread(target=get)
+            thread.start()
+            thread.join()
+        after = {stats['db_path']: stats['opened'] for stats in self.client.get('/stats/db').get_json()}
+        self.assertEqual(after, {path: before.get(path, 0) for path in after})
+
+    def test_library_names_taken_by_routes(self):
+        for name in ('books', 'static', 'api'):
+            app.config['LIBRARIES'] = {name: app.config['DB_PATH']}
+            try:
+                with self.assertRaises(ValueError):
+                    get_libraries(app)
+            finally:
+                app.config['LIBRARIES'] = {}
+        self.assertEqual(self.client.get('/books').status_code, 200)
+
+    def test_metrics_route(self):
+        with self.client.get(f'/book/{BOOK_ID}') as response:
+            response.get_data()
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'capsule_request_seconds_bucket{endpoint="book_annotations"', response.data)
+        self.assertIn(b'capsule_sql_queries_total{call_site="stream_book_annotations"}', response.data)
+
+    def test_slow_requests_profiled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app.config.update(PROFILE_SLOW_REQUESTS=1e-9, PROFILE_DIR=directory)
+            try:
+                # An open event stream, as every page has, doesn't keep the
+                # profiler from the other requests.
+                events = self.client.get('/events')
+                self.assertEqual(next(events.response), b'retry: 5000\n\n')
+                with self.client.get('/books') as response:
+                    response.get_data()
+                self.assertEqual(sum('-books_list-' in name for name in os.listdir(directory)), 1)
+                # While another request is being profiled, one goes unprofiled.
+                with metrics._profile_lock:
+                    with self.client.get('/books') as response:
+                        self.assertEqual(response.status_code, 200)
+                self.assertEqual(sum('-books_list-' in name for name in os.listdir(directory)), 1)
+                events.close()
+            finally:
+                app.config.update(PROFILE_SLOW_REQUESTS=0)
+        response = self.client.get('/metrics')
+        self.assertIn(b'capsule_unprofiled_requests_total 1', response.data)
+
+    def test_search_route(self):
+        response = self.client.get('/search?q=memory')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<mark>', response.data)
+        response = self.client.get('/search?q=%22unbalanced')
+        self.assertEqual(response.status_code, 200)
+        # Control characters, a NUL most of all, don't reach FTS5.
+        response = self.client.get('/search?q=a%00b')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(fts_query('a\x00b\tc'), '"a" "b" "c"*')
+        self.assertEqual(fts_query('"x\x00y"'), '"x y"')
+        self.assertIsNone(fts_query('\x00'))
+
+    def test_live_events_route(self):
+        # A client that has seen a newer version of the index is told to
+        # reload, which ends the stream.
+        response = self.client.get('/events', headers={'Last-Event-ID': '1000000'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertIn(b'event: reload', response.data)
+
+    def test_export_route(self):
+        response = self.client.get(f'/export?book_id={BOOK_ID}')
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode().splitlines()
+        self.assertTrue(len(lines) > 0)
+        for line in lines:
+            annotation = json.loads(line)
+            self.assertEqual(annotation['book_id'], BOOK_ID)
+            self.assertIn('is_favorite', annotation)
+
+        response = self.client.get('/export?format=csv&gzip=1&notes=1')
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(response.data).decode())))
+        self.assertTrue(all(row['notes'] for row in rows))
+
+        response = self.client.get('/export?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_fragment_cache(self):
+        cache = FragmentCache(max_bytes=10)
+        cache.put('a', '12345')
+        cache.put('b', '12345')
+        cache.get('a')
+        cache.put('c', '12345')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), '12345')
+        self.assertEqual(cache.size, 10)
+
+        for _ in range(2):
+            with self.client.get(f'/book/{BOOK_ID}') as response:
+                response.get_data()
+        response = self.client.get('/metrics')
+        self.assertIn(b'capsule_fragment_cache_requests_total{result="hit"}', response.data)
+
+    def test_snapshot_save_and_load(self):
+        with app.app_context():
+            snapshot = get_snapshot()
+        path = os.path.join(library.name, 'test.snapshot')
+        snapshot.changes = {'added': [1, 2], 'changed': [], 'deleted': [3]}
+        snapshot.save(path)
+        snapshot.changes = None
+        loaded = Snapshot.load(path)
+        self.assertEqual(loaded.version, snapshot.version)
+        self.assertEqual(loaded.source, snapshot.source)
+        self.assertEqual(loaded.changes, {'added': [1, 2], 'changed': [], 'deleted': [3]})
+        self.assertEqual(list(loaded.book_order), list(snapshot.book_order))
+        for row in range(len(snapshot)):
+            self.assertEqual(loaded.annotation(row), snapshot.annotation(row))
+
+        with open(path, 'r+b') as f:
+            f.truncate(100)
+        self.assertIsNone(Snapshot.load(path))
+
+    def test_snapshot_lookups_after_load(self):
+        # Built from the index, saved, and mapped back from the file.
+        with app.app_context():
+            version = get_snapshot().version
+        sidecar = get_sidecar(app.config['INDEX_PATH'])
+        with sidecar.connect() as conn:
+            built = Snapshot(version, conn.execute(
+                'SELECT id, book_id, title, text, notes, spine_index, start_cfi, chapter, timestamp '
+                'FROM annotations ORDER BY id'
+            ))
+        path = os.path.join(library.name, 'lookups.snapshot')
+        built.save(path)
+        loaded = Snapshot.load(path)
+
+        self.assertEqual(len(loaded), len(built))
+        self.assertEqual(list(loaded.recent_order), list(built.recent_order))
+        timestamps = [loaded.timestamps[row] for row in loaded.recent_order]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+        for row in range(len(loaded)):
+            self.assertEqual(loaded.row_of(loaded.ids[row]), row)
+            self.assertEqual(loaded.recent_order[loaded.recent_position(row)], row)
+            book_id = loaded.book_ids[row]
+            self.assertEqual(loaded.book_rows(book_id)[loaded.book_position(row)], row)
+            self.assertEqual(loaded.annotation(row), built.annotation(row))
+        for book_id in built.book_ranges:
+            self.assertEqual(list(loaded.book_rows(book_id)), list(built.book_rows(book_id)))
+        self.assertIsNone(loaded.row_of(-1))
+        self.assertIsNone(loaded.book_rows(-1))
+
+        for month, day in ((1, 1), (2, 29), (6, 15), (12, 31)):
+            for window in (0, 3, 183):
+                self.assertEqual(
+                    [(year, list(rows)) for year, rows in loaded.calendar_rows(month, day, window)],
+                    [(year, list(rows)) for year, rows in built.calendar_rows(month, day, window)],
+                )
+        # Each day's rows are those made on it, oldest first.
+        for year, rows in loaded.calendar_rows(6, 15, 0):
+            for row in rows:
+                made = time.localtime(loaded.timestamps[row])
+                self.assertEqual((made.tm_year, made.tm_mon, made.tm_mday), (year, 6, 15))
+            self.assertEqual(list(rows), sorted(rows, key=lambda row: loaded.timestamps[row]))
+
+    def test_snapshot_manager_rebuilds_in_background(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path, _ = generate_library(directory, 10, seed=6)
+            first, second = object(), object()
+            calls, swapped, finish = [], threading.Event(), threading.Event()
+
+            def loader(previous):
+                calls.append(previous)
+                if previous is None:
+                    return first
+                finish.wait(10)
+                return second
+
+            manager = SnapshotManager(db_path, loader)
+            manager.subscribe(lambda snapshot: swapped.set())
+            self.assertIs(manager.current(), first)
+            self.assertIs(manager.current(), first)
+            self.assertEqual(calls, [None])
+
+            # A change is rebuilt from the previous snapshot, which is served
+            # until the new one replaces it.
+            calibre = sqlite3.connect(db_path)
+            with calibre:
+                calibre.execute('UPDATE annotations SET timestamp = timestamp + 1 WHERE id = 1')
+            calibre.close()
+            self.assertIs(manager.current(), first)
+            self.assertIs(manager.current(), first)
+            finish.set()
+            self.assertTrue(swapped.wait(10))
+            self.assertIs(manager.current(), second)
+            self.assertEqual(calls, [None, first])
+            manager.stop()
+
+            # A restored snapshot that isn't current is served while it is
+            # rebuilt.
+            restored = object()
+            calls.clear()
+            swapped.clear()
+            finish.clear()
+            manager = SnapshotManager(db_path, loader, restore=lambda: (restored, False))
+            manager.subscribe(lambda snapshot: swapped.set())
+            self.assertIs(manager.current(), restored)
+            finish.set()
+            self.assertTrue(swapped.wait(10))
+            self.assertIs(manager.current(), second)
+            self.assertEqual(calls, [restored])
+            manager.stop()
+
+    def test_state_change_during_index_write(self):
+        with app.app_context():
+            get_favorited_annotations()  # the state database is attached
+            conn = get_sidecar(app.config['INDEX_PATH']).connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                favorite = is_favorite(31)
+                toggle_favorite(31)
+                self.assertNotEqual(is_favorite(31), favorite)
+                toggle_favorite(31)
+            finally:
+                conn.execute('ROLLBACK')
+
+    def test_state_cached_and_looked_up_in_bulk(self):
+        with app.app_context():
+            state = load_state()
+            # Parsed once, until the state changes.
+            self.assertIs(load_state(), state)
+            ids = [int(annotation_id) for annotation_id in list(state)[:20]] + [999999]
+            states = get_annotation_states(ids)
+            for annotation_id in ids:
+                self.assertEqual(states[annotation_id]['is_favorite'], is_favorite(annotation_id))
+                last_read = state.get(str(annotation_id), {}).get('last_read')
+                self.assertEqual(states[annotation_id]['last_read'], last_read)
+            self.assertEqual(states[999999], {'is_favorite': False, 'last_read': None})
+
+            # A change made by another process is seen.
+            other = StateStore(app.config['STATE_FILE'])
+            favorite = is_favorite(ids[0])
+            other.set(ids[0], favorite=not favorite)
+            try:
+                self.assertEqual(get_annotation_states([ids[0]])[ids[0]]['is_favorite'], not favorite)
+            finally:
+                other.set(ids[0], favorite=favorite)
+            self.assertEqual(is_favorite(ids[0]), favorite)
+
+    def test_state_journal_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, 'state.json')
+            writer, reader = StateStore(state_file), StateStore(state_file)
+            writer.set(1, favorite=True)
+            writer.set(2, last_read=5.0)
+            self.assertTrue(reader.get(1)['favorite'])
+            self.assertEqual(reader.get(2)['last_read'], 5.0)
+            # Only the journal was written.
+            self.assertFalse(os.path.exists(state_file))
+
+            # A torn trailing record is skipped, then cut off by the next write.
+            with open(f'{state_file}.journal', 'ab') as f:
+                f.write(b'{"id": "3", "fav')
+            store = StateStore(state_file)
+            self.assertEqual(set(store.entries()), {'1', '2'})
+            store.set(4, favorite=True)
+            with open(f'{state_file}.journal') as f:
+                [json.loads(line) for line in f]
+            self.assertEqual(set(StateStore(state_file).entries()), {'1', '2', '4'})
+
+            # So are lines that parse but aren't records.
+            with open(f'{state_file}.journal', 'ab') as f:
+                f.write(b'{}\n[]\n7\n"x"\n{"id": "5", "favorite": true}\n')
+            self.assertEqual(set(StateStore(state_file).entries()), {'1', '2', '4', '5'})
+            self.assertEqual(set(store.entries()), {'1', '2', '4', '5'})
+
+    def test_state_compaction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, 'state.json')
+            store, other = StateStore(state_file), StateStore(state_file)
+            store.set(1, favorite=True)
+            store.compact()
+            self.assertEqual(read_snapshot(state_file), (1, {'1': {'favorite': True, 'last_read': None}}))
+            with open(f'{state_file}.journal') as f:
+                self.assertEqual(f.read(), '{"generation": 1}\n')
+            store.set(2, favorite=True)
+            self.assertEqual(set(other.entries()), {'1', '2'})
+
+            # A crash after the snapshot of generation 2 was written leaves a
+            # generation 1 journal that is already folded in.
+            with open(state_file, 'w') as f:
+                json.dump({'format': 2, 'generation': 2, 'annotations': {'5': {'favorite': True}}}, f)
+            store = StateStore(state_file)
+            self.assertEqual(set(store.entries()), {'5'})
+            store.set(6, favorite=True)
+            with open(f'{state_file}.journal') as f:
+                self.assertEqual(json.loads(f.readline()), {'generation': 2})
+            self.assertEqual(set(StateStore(state_file).entries()), {'5', '6'})
+
+    def test_state_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, 'state.json')
+            # Two stores stand in for two processes; they only share the files.
+            stores = [StateStore(state_file), StateStore(state_file)]
+
+            def increment(entries):
+                return [{'id': '9', 'count': entries.get('9', {}).get('count', 0) + 1}]
+
+            def write(store):
+                for _ in range(50):
+                    store.mutate(increment)
+
+            threads = [threading.Thread(target=write, args=(stores[i % 2],)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(StateStore(state_file).get(9)['count'], 200)
+
+    def test_migrate_state_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_file = os.path.join(directory, 'state.json')
+            legacy = {'1': {'favorite': True, 'last_read': None}, '2': {'favorite': False, 'last_read': 3.0}}
+            with open(state_file, 'w') as f:
+                json.dump(legacy, f)
+            runner = app.test_cli_runner()
+            default_state_file = app.config['STATE_FILE']
+            app.config['STATE_FILE'] = state_file
+            try:
+                result = runner.invoke(args=['migrate-state'])
+                self.assertEqual(result.output, 'Migrated state for 2 annotations.\n')
+                self.assertEqual(read_snapshot(state_file), (1, legacy))
+                with open(f'{state_file}.bak') as f:
+                    self.assertEqual(json.load(f), legacy)
+                result = runner.invoke(args=['migrate-state'])
+                self.assertEqual(result.output, 'Nothing to migrate.\n')
+            finally:
+                app.config['STATE_FILE'] = default_state_file
 
     def test_get_random_annotations(self):
         with app.app_context():
@@ -80,8 +961,7 @@ class TestApp(unittest.TestCase):
 
     def test_get_book_annotations(self):
         with app.app_context():
-            # Assuming there's at least one book with ID 1
-            book_data = get_book_annotations(55)
+            book_data = get_book_annotations(BOOK_ID)
             self.assertIsNotNone(book_data)
             self.assertIn('book_title', book_data)
             self.assertIn('book_id', book_data)
@@ -97,17 +977,6 @@ class TestApp(unittest.TestCase):
                 self.assertIn('annotations', book_data)
                 self.assertTrue(len(book_data['annotations']) > 0)
 
-    def test_get_all_annotations(self):
-        with app.app_context():
-            annotations = get_all_annotations()
-            self.assertTrue(len(annotations) > 0)
-            for annotation in annotations:
-                self.assertIn('id', annotation)
-                self.assertIn('text', annotation)
-                self.assertIn('timestamp', annotation)
-                self.assertIn('book_id', annotation)
-                self.assertIn('book_title', annotation)
-
     def test_get_recent_books(self):
         with app.app_context():
             recent_books = get_recent_books()
@@ -120,23 +989,39 @@ class TestApp(unittest.TestCase):
     def test_get_flashback_annotations(self):
         with app.app_context():
             flashback = get_flashback_annotations()
-            self.assertIn('years_ago', flashback)
-            self.assertIn('books', flashback)
-            self.assertTrue(len(flashback['books']) > 0)
+            self.assertTrue(len(flashback['years']) > 0)
+            for year in flashback['years']:
+                self.assertTrue(year['years_ago'] >= 1)
+                self.assertEqual(len(year['annotations']), 1)
+
+    def test_calendar_rows_whole_year(self):
+        with app.app_context():
+            snapshot = get_snapshot()
+        for month, day in ((1, 1), (2, 29), (7, 2), (12, 31)):
+            for window in (182, 183, 1000):
+                rows = [row for _, rows in snapshot.calendar_rows(month, day, window) for row in rows]
+                self.assertEqual(len(rows), len(set(rows)))
+                if window >= 183:
+                    self.assertEqual(sorted(rows), list(range(len(snapshot))))
+
+    def test_flashback_route(self):
+        response = self.client.get('/flashback?days=30')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'years ago', response.data)
 
     def test_favorites_functionality(self):
         with app.app_context():
             # Test toggling favorites
-            annotation_id = 12  # Assuming there's an annotation with ID 12
+            annotation_id = 12
             initial_state = is_favorite(annotation_id)
             toggle_favorite(annotation_id)
             self.assertNotEqual(initial_state, is_favorite(annotation_id))
             toggle_favorite(annotation_id)
             self.assertEqual(initial_state, is_favorite(annotation_id))
 
-            # Test loading favorites
-            favorites = load_favorites()
-            self.assertIsInstance(favorites, dict)
+            # Test loading state
+            state = load_state()
+            self.assertIsInstance(state, dict)
 
 if __name__ == '__main__':
     unittest.main()